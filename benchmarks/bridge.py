@@ -0,0 +1,222 @@
+"""
+bridge.py
+
+Purpose: Checks and measures bridges between brokers (see bridge.py in
+the repository root). Starts brokers as subprocesses on consecutive
+ports and runs three scenarios:
+
+  pair       two brokers, the second bridged to the first. Messages are
+             published on each broker, and every subscriber of both must
+             get every message exactly once. Reports the messages per
+             second that crossed the bridge.
+  ring       three brokers bridged in a ring, so every message reaches
+             every broker over two paths. Every subscriber must still get
+             every message exactly once, the second copies are dropped
+             and counted as bridged_duplicates.
+  reconnect  two brokers, the first is stopped and started again. The
+             bridge of the second must open again by itself, and reports
+             how long it took until messages crossed it again.
+
+Exits with status 1 if any scenario lost or duplicated a message.
+
+e.g., python benchmarks/bridge.py --messages 20000
+"""
+
+import argparse
+import collections
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from connection import Connection
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+TOPIC = 'WEATHER'
+
+"""
+start_server(port, bridges)
+
+Starts a broker in the asyncio mode that bridges to the brokers on the
+given ports, and waits until it accepts connections.
+"""
+def start_server(port, bridges = ()):
+    command = [sys.executable, SERVER, '--mode', 'asyncio', '--port', str(port), '--log-level', 'off',
+               '--queue-size', '1000000']
+    for bridge in bridges:
+        command += ['--bridge', f'localhost:{bridge}']
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+def stop_servers(processes):
+    for process in processes:
+        process.kill()
+        process.wait()
+
+class Subscriber:
+    """
+    A client subscribed to the test topic of a broker, which counts the
+    copies of every message it receives.
+    """
+    def __init__(self, port):
+        self.counts = collections.Counter()
+        self.received = threading.Condition()
+        self.connection = Connection(port=port, on_message=self.on_message)
+        self.connection.subscribe(TOPIC).result(10)
+
+    def on_message(self, topic, message):
+        with self.received:
+            self.counts[message] += 1
+            self.received.notify_all()
+
+    """
+    wait_for(count, timeout)
+
+    Waits until count different messages have arrived, returns False if
+    they did not within timeout seconds.
+    """
+    def wait_for(self, count, timeout):
+        with self.received:
+            return self.received.wait_for(lambda: len(self.counts) >= count, timeout)
+
+"""
+wait_for_bridges(ports, timeout)
+
+Waits until a probe published on each broker reaches the subscribers of
+all of them, so the bridges are open before a scenario starts. Returns
+the subscribers, one per broker.
+"""
+def wait_for_bridges(ports, timeout = 15):
+    subscribers = [Subscriber(port) for port in ports]
+    deadline = time.monotonic() + timeout
+    for number, subscriber in enumerate(subscribers):
+        probe = f'probe {number}'
+        while not all(probe in other.counts for other in subscribers):
+            if time.monotonic() > deadline:
+                raise RuntimeError('the bridges did not open')
+            subscriber.connection.publish(TOPIC, probe).result(10)
+            time.sleep(0.1)
+    for subscriber in subscribers:
+        with subscriber.received:
+            subscriber.counts.clear()
+    return subscribers
+
+"""
+publish_all(subscribers, messages)
+
+Publishes messages from the connection of every subscriber, waits until
+every subscriber got all of them, and returns the seconds it took and
+the list of problems found: messages that did not arrive, and messages
+that arrived more than once.
+"""
+def publish_all(subscribers, messages):
+    start = time.perf_counter()
+    futures = []
+    for number, subscriber in enumerate(subscribers):
+        futures += [subscriber.connection.publish(TOPIC, f'{number}:{n}') for n in range(messages)]
+    for future in futures:
+        future.result(60)
+    expected = messages * len(subscribers)
+    problems = []
+    for number, subscriber in enumerate(subscribers):
+        if not subscriber.wait_for(expected, 60):
+            problems.append(f'broker {number} got {len(subscriber.counts)} of {expected} messages')
+    elapsed = time.perf_counter() - start
+    time.sleep(1) # Copies that took a longer path arrive after the first ones
+    for number, subscriber in enumerate(subscribers):
+        with subscriber.received:
+            copies = sum(count - 1 for count in subscriber.counts.values())
+        if copies:
+            problems.append(f'broker {number} got {copies} duplicate messages')
+    return elapsed, problems
+
+"""
+stat(connection, name)
+
+Returns a number from the /STATS report of a broker.
+"""
+def stat(connection, name):
+    for line in connection.stats().result(10).splitlines():
+        if line.startswith(name + ': '):
+            return int(line.split(': ', 1)[1])
+    return 0
+
+def close_all(subscribers):
+    for subscriber in subscribers:
+        subscriber.connection.close()
+
+def run_pair(args):
+    ports = [args.port, args.port + 1]
+    processes = [start_server(ports[0]), start_server(ports[1], [ports[0]])]
+    try:
+        subscribers = wait_for_bridges(ports)
+        elapsed, problems = publish_all(subscribers, args.messages)
+        print(f'pair       {args.messages * len(ports) / elapsed:12,.0f} messages/s across the bridge')
+        close_all(subscribers)
+        return problems
+    finally:
+        stop_servers(processes)
+
+def run_ring(args):
+    ports = [args.port, args.port + 1, args.port + 2]
+    # Every broker opens the bridge to the next one, the bridges reconnect until the next one is up
+    processes = [start_server(port, [ports[(index + 1) % len(ports)]]) for index, port in enumerate(ports)]
+    try:
+        subscribers = wait_for_bridges(ports)
+        elapsed, problems = publish_all(subscribers, args.messages)
+        duplicates = sum(stat(subscriber.connection, 'bridged_duplicates') for subscriber in subscribers)
+        print(f'ring       {args.messages * len(ports) / elapsed:12,.0f} messages/s, '
+              f'{duplicates} duplicates dropped')
+        if not duplicates:
+            problems.append('the ring dropped no duplicates, so messages did not take both paths')
+        close_all(subscribers)
+        return problems
+    finally:
+        stop_servers(processes)
+
+def run_reconnect(args):
+    ports = [args.port, args.port + 1]
+    processes = [start_server(ports[0]), start_server(ports[1], [ports[0]])]
+    try:
+        close_all(wait_for_bridges(ports))
+        stop_servers(processes[:1])
+        stopped = time.monotonic()
+        processes[0] = start_server(ports[0])
+        subscribers = wait_for_bridges(ports, timeout=60)
+        reopened = time.monotonic() - stopped
+        elapsed, problems = publish_all(subscribers, args.messages)
+        print(f'reconnect  bridge open again after {reopened:.1f}s, '
+              f'{args.messages * len(ports) / elapsed:,.0f} messages/s after it')
+        close_all(subscribers)
+        return problems
+    finally:
+        stop_servers(processes)
+
+SCENARIOS = {'pair': run_pair, 'ring': run_ring, 'reconnect': run_reconnect}
+
+def main():
+    parser = argparse.ArgumentParser(description='Broker bridge check and benchmark')
+    parser.add_argument('--port', type=int, default=8095, help='port of the first broker, the others follow it')
+    parser.add_argument('--messages', type=int, default=5000, help='messages published on every broker')
+    parser.add_argument('--scenario', choices=['all'] + list(SCENARIOS), default='all')
+    args = parser.parse_args()
+    problems = []
+    for name, scenario in SCENARIOS.items():
+        if args.scenario in ('all', name):
+            problems += [f'{name}: {problem}' for problem in scenario(args)]
+    for problem in problems:
+        print(problem)
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+coalescing.py
+
+Purpose: Measures how many socket writes the server makes per delivered
+message. Runs the server in this process so that the write counters of
+its sessions can be read, connects subscribers to a set of topics and
+has a publisher send bursts of wildcard and plain publishes. Each run
+is repeated with one write per message (the old behaviour), batched
+writes, and batched writes with a flush delay.
+
+e.g., python benchmarks/coalescing.py --mode threaded --subscribers 50
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import server
+import subscriptions
+from framing import COMMAND, MESSAGE, FrameParser, encode_frame
+
+OUTPUT = sys.stdout # The server's own output is silenced while it runs
+
+class Connection:
+    """
+    A blocking test connection that reads frames with its own parser.
+    """
+    def __init__(self, port):
+        self.sock = socket.create_connection(('localhost', port))
+        self.parser = FrameParser()
+        self.read()
+        self.send('CONN_ACK accepted by client')
+
+    def send(self, message):
+        self.sock.sendall(encode_frame(COMMAND, message.encode('utf-8')))
+
+    def read(self):
+        frame = self.parser.next_frame()
+        while frame is None:
+            if not self.parser.recv_into(self.sock):
+                raise ConnectionError('Connection closed by server')
+            frame = self.parser.next_frame()
+        return frame
+
+    def read_messages(self, count):
+        received = 0
+        while received < count:
+            kind, payload = self.read()
+            if kind == MESSAGE:
+                received += 1
+
+"""
+start_server(mode, port)
+
+Runs the server on a daemon thread of this process.
+"""
+def start_server(mode, port):
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            if mode == 'asyncio':
+                asyncio.run(server.serve_asyncio('localhost', port))
+            else:
+                server.serve_threaded('localhost', port)
+    threading.Thread(target=run, daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+"""
+run(port, args)
+
+Runs one burst and returns (messages delivered, socket writes, seconds).
+"""
+def run(port, args):
+    topics = [f'BURST/{index}' for index in range(args.topics)]
+    publisher = Connection(port)
+    subscribers = [Connection(port) for _ in range(args.subscribers)]
+    for connection in subscribers + [publisher]:
+        for topic in topics:
+            connection.send(f'/SUB {topic}')
+            connection.read()
+    sessions = list(server.SUBSCRIPTIONS.sessions)
+    writes_before = sum(session.writes for session in sessions)
+    sent_before = sum(session.frames_sent for session in sessions)
+
+    expected = args.bursts * len(topics) * 2
+    readers = [threading.Thread(target=connection.read_messages, args=(expected,))
+               for connection in subscribers + [publisher]]
+    start = time.perf_counter()
+    for reader in readers:
+        reader.start()
+    for index in range(args.bursts):
+        publisher.send(f'/PUB BURST/+ wildcard {index}')
+        for topic in topics:
+            publisher.send(f'/PUB {topic} plain {index}')
+    for reader in readers:
+        reader.join()
+    elapsed = time.perf_counter() - start
+
+    writes = sum(session.writes for session in sessions) - writes_before
+    sent = sum(session.frames_sent for session in sessions) - sent_before
+    for connection in subscribers + [publisher]:
+        connection.sock.close()
+    time.sleep(0.2)
+    return sent, writes, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket writes per delivered message')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--port', type=int, default=8094)
+    parser.add_argument('--subscribers', type=int, default=50)
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--bursts', type=int, default=50)
+    parser.add_argument('--flush-delay', type=float, default=1.0, metavar='MS')
+    args = parser.parse_args()
+
+    server.queue_size = args.bursts * args.topics * 2 # Nothing may be dropped
+    start_server(args.mode, args.port)
+    batch_frames = subscriptions.BATCH_FRAMES
+    runs = [('one write per message', 1, 0),
+            ('batched', batch_frames, 0),
+            (f'batched, {args.flush_delay}ms delay', batch_frames, args.flush_delay / 1000)]
+    for name, frames, delay in runs:
+        subscriptions.BATCH_FRAMES = frames
+        server.flush_delay = delay
+        sent, writes, elapsed = run(args.port, args)
+        print(f'{name:<28} {sent:8d} messages {writes:8d} writes '
+              f'{writes / sent:6.3f} writes/message {sent / elapsed:10,.0f} messages/s', file=OUTPUT)
+
+if __name__ == '__main__':
+    main()
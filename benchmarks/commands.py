@@ -0,0 +1,111 @@
+"""
+commands.py
+
+Purpose: Measures the command parser alone, without a server or a
+socket. Reports the commands per second that parse_command() splits from
+text commands and decode_command() from OPCODE frames, next to the chain
+of string comparisons and splits that the server used to run on every
+command, for the same mix of commands.
+
+e.g., python benchmarks/commands.py --commands 500000
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from commands import LIST, PUB, PUBR, STATS, SUB, UNSUB, decode_command, encode_command, parse_command
+from framing import HEADER_SIZE
+
+"""
+chain_parse(message)
+
+The parsing the server did before the dispatch table: an if/elif chain
+of string comparisons, then a split of the whole message in the branch.
+"""
+def chain_parse(message):
+    if '/DISC' in message:
+        return 'DISC', ()
+    elif message[:4] == '/SUB':
+        return 'SUB', message.split(" ")[1:]
+    elif message[:4] == '/PUB' and message[:5] != '/PUBR':
+        return 'PUB', re.split(r'\s+', message, 2)[1:]
+    elif message[:5] == '/PUBR':
+        return 'PUBR', re.split(r'\s+', message, 2)[1:]
+    elif message[:6] == '/UNSUB':
+        return 'UNSUB', message.split(" ")[1:]
+    elif message[:5] == '/LIST':
+        return 'LIST', ()
+    elif message[:6] == '/STATS':
+        return 'STATS', ()
+    return 'INVALID', ()
+
+"""
+command_mix(rng, count, size)
+
+Returns count (opcode, arguments) tuples, mostly publishes, as a server
+sees them under load.
+"""
+def command_mix(rng, count, size):
+    commands = []
+    for _ in range(count):
+        topic = f'WEATHER/{rng.randrange(100)}'
+        roll = rng.random()
+        if roll < 0.8:
+            commands.append((PUB, (topic, 'x' * size)))
+        elif roll < 0.85:
+            commands.append((PUBR, (topic, 'x' * size)))
+        elif roll < 0.92:
+            commands.append((SUB, (topic,)))
+        elif roll < 0.98:
+            commands.append((UNSUB, (topic,)))
+        else:
+            commands.append((rng.choice([LIST, STATS]), ()))
+    return commands
+
+"""
+text(opcode, arguments)
+
+Returns the text command a person would type for a command.
+"""
+def text(opcode, arguments):
+    name = {SUB: '/SUB', UNSUB: '/UNSUB', PUB: '/PUB', PUBR: '/PUBR', LIST: '/LIST', STATS: '/STATS'}[opcode]
+    return ' '.join((name,) + arguments)
+
+"""
+rate(name, parse, inputs)
+
+Runs parse over every input and prints the commands parsed per second.
+"""
+def rate(name, parse, inputs):
+    start = time.perf_counter()
+    for message in inputs:
+        parse(message)
+    elapsed = time.perf_counter() - start
+    print(f'{name:22} {len(inputs) / elapsed:14,.0f} commands/s')
+
+def main():
+    parser = argparse.ArgumentParser(description='Command parser benchmark')
+    parser.add_argument('--commands', type=int, default=500000)
+    parser.add_argument('--size', type=int, default=64, help='bytes in a published message')
+    parser.add_argument('--seed', type=int, default=4211)
+    args = parser.parse_args()
+
+    commands = command_mix(random.Random(args.seed), args.commands, args.size)
+    texts = [text(opcode, arguments) for opcode, arguments in commands]
+    payloads = [encode_command(opcode, *arguments)[HEADER_SIZE:] for opcode, arguments in commands]
+    for message, (opcode, arguments) in zip(texts[:1000], commands):
+        assert parse_command(message) == (opcode, arguments), message
+    for payload, command in zip(payloads[:1000], commands):
+        assert decode_command(payload) == command
+
+    rate('if/elif chain (text)', chain_parse, texts)
+    rate('parse_command (text)', parse_command, texts)
+    rate('decode_command (OPCODE)', decode_command, payloads)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+connections.py
+
+Purpose: Load test for the server modes. Starts the server as a
+subprocess, opens many concurrent local connections to it, subscribes
+each of them to a topic and publishes a single message that has to reach
+every one of them. Reports how long each phase took and the memory used
+by the server.
+
+e.g., python benchmarks/connections.py --mode asyncio --connections 10000
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from framing import COMMAND, FrameParser, encode_frame
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+TOPIC = 'LOAD/TEST'
+
+"""
+start_server(mode, port)
+
+Starts the server in a subprocess pinned to a single core and waits
+until it accepts connections.
+"""
+def start_server(mode, port):
+    process = subprocess.Popen([sys.executable, SERVER, '--mode', mode, '--port', str(port)],
+                               stdout=subprocess.DEVNULL)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(process.pid, {min(os.sched_getaffinity(0))})
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+"""
+server_rss(pid)
+
+Returns the resident memory of a process in kB, or None if unknown.
+"""
+def server_rss(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+class Connection:
+    """
+    A connection of the load test, reading frames with its own parser.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.parser = FrameParser(4096)
+
+    def send(self, message):
+        self.writer.write(encode_frame(COMMAND, message.encode('utf-8')))
+
+    async def read(self):
+        frame = self.parser.next_frame()
+        while frame is None or not frame[1]:
+            # Empty replies only acknowledge a publish
+            if frame is None:
+                data = await self.reader.read(4096)
+                if not data:
+                    raise ConnectionError('Connection closed by server')
+                self.parser.feed(data)
+            frame = self.parser.next_frame()
+        return frame[1].decode('utf-8')
+
+"""
+connect(port, limit)
+
+Opens a single connection and performs the CONN_ACK handshake.
+"""
+async def connect(port, limit):
+    async with limit:
+        connection = Connection(*await asyncio.open_connection('localhost', port))
+        assert await connection.read() == 'CONN_ACK'
+        connection.send('CONN_ACK accepted by client')
+        return connection
+
+"""
+subscribe(connection)
+
+Subscribes a connection to the load test topic.
+"""
+async def subscribe(connection):
+    connection.send(f'/SUB {TOPIC}')
+    await connection.read()
+
+async def run(args):
+    process = start_server(args.mode, args.port)
+    try:
+        limit = asyncio.Semaphore(args.concurrency)
+        start = time.perf_counter()
+        connections = await asyncio.gather(*(connect(args.port, limit) for _ in range(args.connections)))
+        connected = time.perf_counter()
+
+        # Give the server time to register the last acknowledgements
+        await asyncio.sleep(0.5)
+        await asyncio.gather(*(subscribe(connection) for connection in connections))
+        subscribed = time.perf_counter()
+
+        publish_start = time.perf_counter()
+        connections[0].send(f'/PUB {TOPIC} hello')
+        await asyncio.gather(*(connection.read() for connection in connections))
+        delivered = time.perf_counter()
+
+        print(f'mode:                 {args.mode}')
+        print(f'connections:          {len(connections)}')
+        print(f'connect + handshake:  {connected - start:.2f}s')
+        print(f'subscribe all:        {subscribed - connected - 0.5:.2f}s')
+        print(f'fan-out to all:       {(delivered - publish_start) * 1000:.1f}ms')
+        rss = server_rss(process.pid)
+        if rss is not None:
+            print(f'server memory:        {rss / 1024:.1f}MB ({rss * 1024 // len(connections)} bytes per connection)')
+
+        for connection in connections:
+            connection.writer.close()
+    finally:
+        process.kill()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent connection load test')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio')
+    parser.add_argument('--port', type=int, default=8093)
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=500, help='connections opened at the same time')
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
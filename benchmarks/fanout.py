@@ -0,0 +1,86 @@
+"""
+fanout.py
+
+Purpose: Microbenchmark of the broadcast fan-out. Publishes a message to
+a topic with many subscribers and reports the time taken and the memory
+allocated, both for the way broadcast() used to work (encoding the message
+again for every subscriber) and for broadcast() itself, which encodes the
+frame once and shares it between the subscribers.
+
+e.g., python benchmarks/fanout.py --subscribers 1000 --size 1048576
+"""
+
+import argparse
+import collections
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import server
+from framing import MESSAGE, encode_frame
+
+TOPIC = 'FANOUT'
+
+class QueueOnlySession:
+    """
+    A session without a socket or writer, it only keeps what is queued.
+    """
+    def __init__(self):
+        self.subscriptions = {}
+        self.queue = collections.deque()
+
+    def send(self, data, kind):
+        self.enqueue(encode_frame(kind, data), kind)
+
+    def enqueue(self, frame, kind = MESSAGE):
+        self.queue.append(frame)
+        return True
+
+"""
+broadcast_per_subscriber(topic, message)
+
+broadcast() as it was before frames were shared, kept for comparison.
+"""
+def broadcast_per_subscriber(topic, message):
+    for client in server.SUBSCRIPTIONS.subscribers(topic):
+        client.send(f'[{topic}]: {message}'.encode('utf-8'), MESSAGE)
+
+"""
+measure(name, broadcast, sessions, message)
+
+Runs a single broadcast and reports the time taken, the number of memory
+blocks allocated and the peak memory allocated while it ran.
+"""
+def measure(name, broadcast, sessions, message):
+    for session in sessions:
+        session.queue.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    broadcast(TOPIC, message)
+    elapsed = time.perf_counter() - start
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    print(f'{name:<16} {elapsed * 1000:9.1f}ms {blocks:9d} blocks {peak / 1e6:10.1f}MB peak')
+
+def main():
+    parser = argparse.ArgumentParser(description='Broadcast fan-out microbenchmark')
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=1024 * 1024, help='message size in bytes')
+    args = parser.parse_args()
+
+    server.TOPICS.add(TOPIC)
+    sessions = [QueueOnlySession() for _ in range(args.subscribers)]
+    for session in sessions:
+        server.SUBSCRIPTIONS.subscribe(session, TOPIC)
+    message = 'x' * args.size
+
+    print(f'{args.subscribers} subscribers, {args.size} byte message')
+    measure('per subscriber', broadcast_per_subscriber, sessions, message)
+    measure('encode once', server.broadcast, sessions, message)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+framing.py
+
+Purpose: Checks and measures the frame parser. The fuzz check cuts a
+stream of random frames at random points, feeds the pieces to a parser
+and makes sure the same frames come out, and that random garbage only
+ever raises FrameError. The throughput check reports how many frames per
+second the parser reassembles from a socket.
+
+e.g., python benchmarks/framing.py --frames 200000
+"""
+
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from framing import COMMAND, MESSAGE, FrameError, FrameParser, encode_frame
+
+"""
+random_frames(rng, count, max_size)
+
+Returns a list of (kind, payload) tuples with random payloads.
+"""
+def random_frames(rng, count, max_size):
+    frames = []
+    for _ in range(count):
+        size = rng.choice([0, 1, rng.randint(0, 64), rng.randint(0, max_size)])
+        frames.append((rng.choice([COMMAND, MESSAGE]), rng.randbytes(size)))
+    return frames
+
+"""
+fuzz(rounds, seed)
+
+Feeds randomly split streams of frames and random garbage to parsers.
+"""
+def fuzz(rounds, seed):
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        frames = random_frames(rng, rng.randint(1, 50), 20000)
+        stream = b''.join(encode_frame(kind, payload) for kind, payload in frames)
+        parser = FrameParser(rng.choice([16, 256, 4096]))
+        received = []
+        position = 0
+        while position < len(stream):
+            size = rng.randint(1, 3000)
+            parser.feed(stream[position:position + size])
+            position += size
+            received.extend(parser)
+        assert received == frames, 'frames were not reassembled correctly'
+        assert parser.pending() == 0
+
+        parser = FrameParser(64, max_frame_size=rng.randint(0, 100000))
+        try:
+            parser.feed(rng.randbytes(rng.randint(0, 5000)))
+            for kind, payload in parser:
+                assert len(payload) <= parser.max_frame_size
+        except FrameError:
+            pass
+    print(f'fuzz:       {rounds} rounds passed')
+
+"""
+throughput(count, size)
+
+Sends count frames over a socket pair and parses them with recv_into.
+"""
+def throughput(count, size):
+    frame = encode_frame(COMMAND, b'/PUB WEATHER ' + b'x' * size)
+    batch = frame * 1000
+    sender, receiver = socket.socketpair()
+
+    def send():
+        for _ in range(count // 1000):
+            sender.sendall(batch)
+        sender.close()
+
+    thread = threading.Thread(target=send)
+    parser = FrameParser()
+    frames = 0
+    receives = 0
+    start = time.perf_counter()
+    thread.start()
+    while parser.recv_into(receiver):
+        receives += 1
+        for kind, payload in parser:
+            frames += 1
+    elapsed = time.perf_counter() - start
+    thread.join()
+    receiver.close()
+    print(f'throughput: {frames / elapsed:,.0f} frames/s, {frames * len(frame) / elapsed / 1e6:,.1f} MB/s '
+          f'({frames / receives:.1f} frames per recv_into, {size} byte payloads)')
+
+def main():
+    parser = argparse.ArgumentParser(description='Frame parser fuzz and throughput check')
+    parser.add_argument('--rounds', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=4211)
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--size', type=int, default=100, help='payload size of the throughput frames')
+    args = parser.parse_args()
+    fuzz(args.rounds, args.seed)
+    throughput(args.frames, args.size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,529 @@
+"""
+load.py
+
+Purpose: Reproducible load generator for the server. Starts the server
+as a subprocess (or in this process, or uses one that is already
+running), opens many synthetic clients on a single event loop and
+replays a workload:
+
+    fanout    one publisher, every other client subscribed to its topic
+    fanin     every client but one publishes to its own topic, the last
+              client is subscribed to all of them with a wildcard
+    wildcard  every message is published with a wildcard to many topics
+    retained  every message is published with /PUBR to a random topic,
+              then new clients subscribe and get the retained messages
+    churn     half of the clients keep connecting, subscribing and
+              disconnecting while the other half receives messages
+
+Every message carries the time it was sent, so each delivery gives an
+end-to-end latency sample. The results (throughput, latency percentiles
+and the configuration) are written as JSON, and --compare checks them
+against an earlier result so that a change that makes the server slower
+shows up as a failing run.
+
+e.g., python benchmarks/load.py --workload all --clients 2000 --output baseline.json
+      python benchmarks/load.py --workload all --clients 2000 --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from framing import ACK, COMMAND, MESSAGE, PACKET_ID, QOS_MESSAGE, FrameError, FrameParser, encode_frame
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+WORKLOADS = ('fanout', 'fanin', 'wildcard', 'retained', 'churn')
+HOST = 'localhost'
+qos = 0 # Quality of service of the synthetic clients, see --qos
+
+class Run:
+    """
+    Counts the deliveries of a single workload and the latency of each.
+    """
+    def __init__(self):
+        self.latencies = []
+        self.delivered = 0
+        self.published = 0
+        self.start = None
+        self.last_delivery = None
+        self.done = False
+
+    """
+    deliver(payload)
+
+    Records a message received by a client, the message starts with the
+    time it was sent. The topic may be followed by the offset of the
+    message, as in [TOPIC]@OFFSET: MESSAGE when the server keeps a history.
+    """
+    def deliver(self, payload):
+        now = time.perf_counter()
+        body = payload[payload.index(b': ', payload.index(b']')) + 2:]
+        self.latencies.append(now - float(body.split(b' ', 1)[0]))
+        self.delivered += 1
+        self.last_delivery = now
+
+class Connection:
+    """
+    A synthetic client. Its reader task handles every frame from the
+    server: replies are queued for request(), and messages are recorded
+    by the connection's run, or ignored while it has none. QoS 1 messages
+    are acknowledged with one ACK for everything a read returned.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.parser = FrameParser()
+        self.replies = asyncio.Queue()
+        self.run = None
+        self.packet_id = 0 # Highest packet id of the QoS 1 messages received
+        self.task = asyncio.get_running_loop().create_task(self.read())
+
+    def send(self, message):
+        self.writer.write(encode_frame(COMMAND, message.encode('utf-8')))
+
+    """
+    request(message)
+
+    Coroutine that sends a command and returns the server's reply, or None
+    if the connection was closed.
+    """
+    async def request(self, message):
+        self.send(message)
+        return await self.replies.get()
+
+    async def read(self):
+        try:
+            while True:
+                data = await self.reader.read(64 * 1024)
+                if not data:
+                    break
+                self.parser.feed(data)
+                acknowledge = False
+                for kind, payload in self.parser:
+                    if kind == QOS_MESSAGE:
+                        (packet_id,) = PACKET_ID.unpack_from(payload)
+                        acknowledge = True
+                        if packet_id <= self.packet_id:
+                            continue # Resent, it was delivered before
+                        self.packet_id = packet_id
+                        kind, payload = MESSAGE, payload[PACKET_ID.size:]
+                    if kind == MESSAGE:
+                        if self.run is not None:
+                            self.run.deliver(payload)
+                    elif payload:
+                        # Empty replies acknowledge publishes, nothing waits for them
+                        self.replies.put_nowait(payload.decode('utf-8'))
+                if acknowledge:
+                    self.writer.write(encode_frame(ACK, PACKET_ID.pack(self.packet_id)))
+        except (OSError, FrameError):
+            pass
+        finally:
+            self.replies.put_nowait(None)
+
+    """
+    disconnect()
+
+    Coroutine that disconnects the way the client does, with /DISC.
+    """
+    async def disconnect(self):
+        await self.request('/DISC')
+        self.send('DISC_ACK accepted by client')
+        await self.writer.drain()
+        self.close()
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+"""
+connect(port, limit)
+
+Opens a connection and performs the CONN_ACK handshake, then sets the
+quality of service to qos.
+"""
+async def connect(port, limit):
+    async with limit:
+        connection = Connection(*await asyncio.open_connection(HOST, port))
+        if await connection.replies.get() != 'CONN_ACK':
+            raise ConnectionError('No CONN_ACK from server')
+        connection.send('CONN_ACK accepted by client')
+        if qos:
+            await connection.request(f'/QOS {qos}')
+        return connection
+
+async def connect_many(port, count, limit):
+    return await asyncio.gather(*(connect(port, limit) for _ in range(count)))
+
+"""
+stamp(size)
+
+Returns the body of a message: the time it is sent, padded to size bytes.
+"""
+def stamp(size):
+    sent = f'{time.perf_counter():.9f}'
+    return sent + ' ' + 'x' * (size - len(sent) - 1) if size > len(sent) + 1 else sent
+
+"""
+drive(run, publishers, command, messages, rate)
+
+Coroutine that sends messages commands, command(number) returns the
+text of each one, taking turns between the publishers. With a rate the
+commands are spread evenly over time (an open loop, so a slow server
+shows up as latency), without one they are sent as fast as the
+publishers' connections take them.
+"""
+async def drive(run, publishers, command, messages, rate):
+    run.start = time.perf_counter()
+    while run.published < messages:
+        if rate:
+            due = min(messages, int((time.perf_counter() - run.start) * rate) + 1)
+        else:
+            due = min(messages, run.published + 100)
+        while run.published < due:
+            publishers[run.published % len(publishers)].send(command(run.published))
+            run.published += 1
+        if rate:
+            await asyncio.sleep(0.005)
+        else:
+            await asyncio.gather(*(publisher.writer.drain() for publisher in publishers))
+
+"""
+settle(run, expected, idle)
+
+Coroutine that waits until expected messages were delivered, or no
+message arrived for idle seconds, i.e., the rest were dropped.
+"""
+async def settle(run, expected, idle = 2.0):
+    waiting_since = time.perf_counter()
+    while run.delivered < expected:
+        await asyncio.sleep(0.02)
+        if time.perf_counter() - max(run.last_delivery or 0, waiting_since) > idle:
+            break
+    run.done = True
+
+"""
+percentiles(samples)
+
+Returns the percentiles of latency samples in milliseconds.
+"""
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'p999': at(0.999),
+            'max': round(samples[-1] * 1000, 3), 'mean': round(sum(samples) / len(samples) * 1000, 3)}
+
+"""
+report(name, run, clients, expected, **extra)
+
+Returns the result of a workload as a dict.
+"""
+def report(name, run, clients, expected, **extra):
+    elapsed = (run.last_delivery or time.perf_counter()) - run.start
+    return dict({
+        'workload': name,
+        'clients': clients,
+        'published': run.published,
+        'expected_deliveries': expected,
+        'delivered': run.delivered,
+        'lost': expected - run.delivered,
+        'duration_s': round(elapsed, 3),
+        'throughput_msgs_per_s': round(run.delivered / elapsed, 1) if elapsed > 0 else 0,
+        'latency_ms': percentiles(run.latencies),
+    }, **extra)
+
+# WORKLOADS
+
+async def fanout(port, args, rng, limit):
+    run = Run()
+    publisher = await connect(port, limit)
+    await publisher.request('/SUB LOAD/FANOUT')
+    subscribers = await connect_many(port, args.clients - 1, limit)
+    await asyncio.gather(*(subscriber.request('/SUB LOAD/FANOUT') for subscriber in subscribers))
+    for subscriber in subscribers:
+        subscriber.run = run
+    await drive(run, [publisher], lambda number: f'/PUB LOAD/FANOUT {stamp(args.size)}', args.messages, args.rate)
+    expected = args.messages * len(subscribers)
+    await settle(run, expected)
+    for connection in [publisher] + subscribers:
+        connection.close()
+    return report('fanout', run, args.clients, expected)
+
+async def fanin(port, args, rng, limit):
+    run = Run()
+    publishers = await connect_many(port, args.clients - 1, limit)
+    await asyncio.gather(*(publisher.request(f'/SUB LOAD/FANIN/{index}') for index, publisher in enumerate(publishers)))
+    subscriber = await connect(port, limit)
+    await subscriber.request('/SUB LOAD/FANIN/+')
+    subscriber.run = run
+    await drive(run, publishers,
+                lambda number: f'/PUB LOAD/FANIN/{number % len(publishers)} {stamp(args.size)}',
+                args.messages, args.rate)
+    await settle(run, args.messages)
+    for connection in publishers + [subscriber]:
+        connection.close()
+    return report('fanin', run, args.clients, args.messages)
+
+async def wildcard(port, args, rng, limit):
+    run = Run()
+    publisher = await connect(port, limit)
+    for index in range(args.topics):
+        await publisher.request(f'/SUB LOAD/WILD/{index}')
+    subscribers = await connect_many(port, args.clients - 1, limit)
+    await asyncio.gather(*(subscriber.request('/SUB LOAD/WILD/+') for subscriber in subscribers))
+    for subscriber in subscribers:
+        subscriber.run = run
+    await drive(run, [publisher], lambda number: f'/PUB LOAD/WILD/+ {stamp(args.size)}', args.messages, args.rate)
+    expected = args.messages * args.topics * len(subscribers)
+    await settle(run, expected)
+    for connection in [publisher] + subscribers:
+        connection.close()
+    return report('wildcard', run, args.clients, expected, topics=args.topics)
+
+async def retained(port, args, rng, limit):
+    run = Run()
+    publisher = await connect(port, limit)
+    for index in range(args.topics):
+        await publisher.request(f'/SUB LOAD/RETAIN/{index}')
+    subscribers = await connect_many(port, args.clients - 1, limit)
+    topic_subscribers = [0] * args.topics
+    subscriptions = []
+    for subscriber in subscribers:
+        index = rng.randrange(args.topics)
+        topic_subscribers[index] += 1
+        subscriptions.append(subscriber.request(f'/SUB LOAD/RETAIN/{index}'))
+    await asyncio.gather(*subscriptions)
+    for subscriber in subscribers:
+        subscriber.run = run
+    topics = [rng.randrange(args.topics) for _ in range(args.messages)]
+    await drive(run, [publisher], lambda number: f'/PUBR LOAD/RETAIN/{topics[number]} {stamp(args.size)}',
+                args.messages, args.rate)
+    expected = sum(topic_subscribers[index] for index in topics)
+    await settle(run, expected)
+
+    # New subscribers get the retained message with their subscription
+    joiners = await connect_many(port, min(args.clients, 500), limit)
+    async def join(joiner):
+        start = time.perf_counter()
+        await joiner.request(f'/SUB LOAD/RETAIN/{rng.randrange(args.topics)}')
+        return time.perf_counter() - start
+    joins = await asyncio.gather(*(join(joiner) for joiner in joiners))
+    for connection in [publisher] + subscribers + joiners:
+        connection.close()
+    return report('retained', run, args.clients, expected, topics=args.topics,
+                  subscribe_latency_ms=percentiles(joins))
+
+async def churn(port, args, rng, limit):
+    run = Run()
+    publisher = await connect(port, limit)
+    await publisher.request('/SUB LOAD/CHURN')
+    subscribers = await connect_many(port, args.clients // 2, limit)
+    await asyncio.gather(*(subscriber.request('/SUB LOAD/CHURN') for subscriber in subscribers))
+    for subscriber in subscribers:
+        subscriber.run = run
+    sessions = []
+
+    async def churner():
+        while not run.done:
+            start = time.perf_counter()
+            connection = await connect(port, limit)
+            await connection.request('/SUB LOAD/CHURN')
+            sessions.append(time.perf_counter() - start)
+            await connection.disconnect()
+
+    churners = [asyncio.get_running_loop().create_task(churner())
+                for _ in range(args.clients - len(subscribers) - 1)]
+    await drive(run, [publisher], lambda number: f'/PUB LOAD/CHURN {stamp(args.size)}', args.messages, args.rate)
+    expected = args.messages * len(subscribers)
+    await settle(run, expected)
+    await asyncio.gather(*churners)
+    elapsed = time.perf_counter() - run.start
+    for connection in [publisher] + subscribers:
+        connection.close()
+    return report('churn', run, args.clients, expected, sessions=len(sessions),
+                  sessions_per_s=round(len(sessions) / elapsed, 1), session_latency_ms=percentiles(sessions))
+
+# SERVERS
+
+"""
+wait_for_server(port)
+
+Waits until a server accepts connections on port.
+"""
+def wait_for_server(port):
+    for _ in range(200):
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+"""
+start_subprocess(args)
+
+Starts the server as a subprocess with its log switched off.
+"""
+def start_subprocess(args):
+    process = subprocess.Popen([sys.executable, SERVER, '--mode', args.mode, '--port', str(args.port),
+                                '--queue-size', str(args.queue_size), '--log-level', 'off']
+                               + shlex.split(args.server_args), stdout=subprocess.DEVNULL)
+    try:
+        wait_for_server(args.port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+"""
+start_in_process(args)
+
+Runs the server on a thread of this process. The clients and the server
+then share the interpreter, which makes the numbers lower but lets a
+profiler see both sides.
+"""
+def start_in_process(args):
+    import server
+    server.queue_size = args.queue_size
+    if args.mode == 'asyncio':
+        target = lambda: asyncio.run(server.serve_asyncio(HOST, args.port))
+    else:
+        target = lambda: server.serve_threaded(HOST, args.port)
+    threading.Thread(target=target, daemon=True).start()
+    wait_for_server(args.port)
+
+"""
+raise_file_limit()
+
+Raises the limit of open files as far as allowed, every client and, for
+an in-process server, its side of the connection is a file.
+"""
+def raise_file_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+"""
+environment()
+
+Returns what a result depends on besides the configuration.
+"""
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(SERVER),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'commit': commit}
+
+"""
+compare(results, baseline, tolerance)
+
+Returns the regressions of results against a baseline: a lower
+throughput or a higher p99 latency by more than tolerance.
+"""
+def compare(results, baseline, tolerance):
+    regressions = []
+    previous = {result['workload']: result for result in baseline['results']}
+    for result in results:
+        before = previous.get(result['workload'])
+        if before is None:
+            continue
+        if result['throughput_msgs_per_s'] < before['throughput_msgs_per_s'] * (1 - tolerance):
+            regressions.append(f'{result["workload"]}: throughput {result["throughput_msgs_per_s"]:,} msgs/s, '
+                               f'was {before["throughput_msgs_per_s"]:,}')
+        if result['latency_ms'] and before['latency_ms'] and \
+                result['latency_ms']['p99'] > before['latency_ms']['p99'] * (1 + tolerance):
+            regressions.append(f'{result["workload"]}: p99 latency {result["latency_ms"]["p99"]}ms, '
+                               f'was {before["latency_ms"]["p99"]}ms')
+    return regressions
+
+async def run_workload(name, port, args):
+    limit = asyncio.Semaphore(args.concurrency)
+    return await WORKLOAD_FUNCTIONS[name](port, args, random.Random(args.seed), limit)
+
+WORKLOAD_FUNCTIONS = {'fanout': fanout, 'fanin': fanin, 'wildcard': wildcard, 'retained': retained, 'churn': churn}
+
+def main():
+    global qos
+    parser = argparse.ArgumentParser(description='Load generator and latency benchmark')
+    parser.add_argument('--workload', choices=WORKLOADS + ('all',), default='all')
+    parser.add_argument('--server', choices=['subprocess', 'in-process', 'external'], default='subprocess',
+                        help='external uses a server that is already running on --port')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio')
+    parser.add_argument('--port', type=int, default=8095)
+    parser.add_argument('--server-args', default='', help='extra arguments for a subprocess server')
+    parser.add_argument('--queue-size', type=int, default=100000, help='queue size of the server')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=2000, help='commands published per workload')
+    parser.add_argument('--rate', type=float, default=1000, help='commands published per second, 0 for no limit')
+    parser.add_argument('--size', type=int, default=64, help='bytes in a message')
+    parser.add_argument('--topics', type=int, default=10, help='topics of the wildcard and retained workloads')
+    parser.add_argument('--concurrency', type=int, default=500, help='connections opened at the same time')
+    parser.add_argument('--qos', type=int, choices=[0, 1], default=0,
+                        help='quality of service of the clients, 1 acknowledges every message')
+    parser.add_argument('--seed', type=int, default=4211)
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--compare', metavar='JSON', help='fail if slower than the results in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown allowed by --compare')
+    args = parser.parse_args()
+    qos = args.qos
+    if args.clients < 2:
+        parser.error('--clients must be at least 2')
+
+    raise_file_limit()
+    if args.server == 'in-process':
+        start_in_process(args)
+
+    results = []
+    for name in WORKLOADS if args.workload == 'all' else (args.workload,):
+        process = start_subprocess(args) if args.server == 'subprocess' else None
+        try:
+            result = asyncio.run(run_workload(name, args.port, args))
+        finally:
+            if process is not None:
+                process.kill()
+                process.wait()
+        results.append(result)
+        latency = result['latency_ms'] or {}
+        print(f'{name:9} {result["throughput_msgs_per_s"]:12,.0f} msgs/s  p50 {latency.get("p50")}ms  '
+              f'p99 {latency.get("p99")}ms  lost {result["lost"]}', file=sys.stderr)
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'tolerance')}
+    document = {'environment': environment(), 'config': config, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(document, output, indent=2)
+    else:
+        print(json.dumps(document, indent=2))
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            baseline = json.load(baseline)
+        changed = [key for key, value in config.items() if baseline['config'].get(key) != value]
+        if changed:
+            print(f'Note: the baseline was run with different {", ".join(changed)}', file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
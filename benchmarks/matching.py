@@ -0,0 +1,70 @@
+"""
+matching.py
+
+Purpose: Measures the wildcard lookups of the topic trie with and without
+its match cache. Builds a trie of --topics topics, then looks up a set
+of wildcards over and over, the way publishers reuse the same wildcards,
+while a new topic is created every --create-every lookups. Reports the
+lookups per second and the cache hit rate.
+
+e.g., python benchmarks/matching.py --topics 100000 --lookups 200000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from topics import TopicTrie
+
+"""
+build(rng, count, cache_size)
+
+Returns a trie of count topics of the form SENSORS/<site>/<room>/<n>.
+"""
+def build(rng, count, cache_size):
+    trie = TopicTrie(cache_size=cache_size)
+    for number in range(count):
+        trie.add(f'SENSORS/SITE{rng.randrange(100)}/ROOM{rng.randrange(10)}/{number}')
+    return trie
+
+"""
+run(trie, rng, wildcards, lookups, create_every)
+
+Looks up random wildcards and returns the lookups per second.
+"""
+def run(trie, rng, wildcards, lookups, create_every):
+    created = 0
+    start = time.perf_counter()
+    for number in range(lookups):
+        if create_every and number % create_every == 0:
+            trie.add(f'SENSORS/SITE{rng.randrange(100)}/ROOM{rng.randrange(10)}/NEW{created}')
+            created += 1
+        trie.match(rng.choice(wildcards))
+    return lookups / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Topic match cache benchmark')
+    parser.add_argument('--topics', type=int, default=100000)
+    parser.add_argument('--wildcards', type=int, default=200, help='distinct wildcards looked up')
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--create-every', type=int, default=1000, help='lookups between topic creations, 0 for none')
+    parser.add_argument('--seed', type=int, default=4211)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    wildcards = [rng.choice([f'SENSORS/SITE{rng.randrange(100)}/+/{rng.randrange(args.topics)}',
+                             f'SENSORS/SITE{rng.randrange(100)}/ROOM{rng.randrange(10)}/#',
+                             f'SENSORS/+/ROOM{rng.randrange(10)}/{rng.randrange(args.topics)}'])
+                 for _ in range(args.wildcards)]
+    for cache_size in (0, 1024):
+        trie = build(random.Random(args.seed), args.topics, cache_size)
+        rate = run(trie, random.Random(args.seed), wildcards, args.lookups, args.create_every)
+        total = trie.hits + trie.misses
+        label = 'no cache' if cache_size == 0 else f'cache of {cache_size}'
+        print(f'{label:15} {rate:12,.0f} lookups/s  hit rate {trie.hits / total:6.1%}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+memory.py
+
+Purpose: Measures the memory the server uses per connection, per topic
+and per subscription. Starts the server as a subprocess and reads its
+resident memory after each phase: connecting --connections clients,
+creating --topics topics, and subscribing every client to
+--subscriptions of those topics.
+
+e.g., python benchmarks/memory.py --mode asyncio --connections 5000 --subscriptions 20
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from framing import COMMAND, FrameParser, encode_frame
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+
+"""
+start_server(mode, port)
+
+Starts the server in a subprocess and waits until it accepts connections.
+"""
+def start_server(mode, port):
+    process = subprocess.Popen([sys.executable, SERVER, '--mode', mode, '--port', str(port),
+                                '--log-level', 'off'], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+"""
+server_rss(pid)
+
+Returns the resident memory of a process in bytes.
+"""
+def server_rss(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+class Connection:
+    """
+    A connection of the benchmark, reading frames with its own parser.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.parser = FrameParser(4096)
+
+    def send(self, message):
+        self.writer.write(encode_frame(COMMAND, message.encode('utf-8')))
+
+    async def read(self):
+        frame = self.parser.next_frame()
+        while frame is None:
+            data = await self.reader.read(4096)
+            if not data:
+                raise ConnectionError('Connection closed by server')
+            self.parser.feed(data)
+            frame = self.parser.next_frame()
+        return frame[1].decode('utf-8')
+
+    """
+    commands(messages)
+
+    Coroutine that sends several commands at once and reads their replies.
+    """
+    async def commands(self, messages):
+        for message in messages:
+            self.send(message)
+        for message in messages:
+            await self.read()
+
+async def connect(port, limit):
+    async with limit:
+        connection = Connection(*await asyncio.open_connection('localhost', port))
+        await connection.read()
+        connection.send('CONN_ACK accepted by client')
+        return connection
+
+async def run(args, pid):
+    topics = [f'MEMORY/BENCHMARK/SENSOR/{number:06d}' for number in range(args.topics)]
+    limit = asyncio.Semaphore(50) # The threaded server runs the handshakes one at a time
+    await asyncio.sleep(0.5)
+    start = server_rss(pid)
+
+    connections = await asyncio.gather(*(connect(args.port, limit) for _ in range(args.connections)))
+    await asyncio.sleep(0.5)
+    connected = server_rss(pid)
+
+    # Create every topic, the creator's own subscriptions go away with it
+    creator = await connect(args.port, limit)
+    await creator.commands([f'/SUB {topic}' for topic in topics])
+    creator.writer.close()
+    await asyncio.sleep(0.5)
+    created = server_rss(pid)
+
+    rng = random.Random(args.seed)
+    await asyncio.gather(*(connection.commands([f'/SUB {topic}' for topic in rng.sample(topics, args.subscriptions)])
+                           for connection in connections))
+    await asyncio.sleep(0.5)
+    subscribed = server_rss(pid)
+
+    subscriptions = args.connections * args.subscriptions
+    print(f'mode:                   {args.mode}')
+    print(f'server at start:        {start / 1e6:.1f}MB')
+    print(f'per connection:         {(connected - start) / args.connections:,.0f} bytes ({args.connections} connections)')
+    print(f'per topic:              {(created - connected) / args.topics:,.0f} bytes ({args.topics} topics)')
+    print(f'per subscription:       {(subscribed - created) / subscriptions:,.0f} bytes ({subscriptions} subscriptions)')
+    for connection in connections:
+        connection.writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Server memory per connection and subscription')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio')
+    parser.add_argument('--port', type=int, default=8097)
+    parser.add_argument('--connections', type=int, default=5000)
+    parser.add_argument('--topics', type=int, default=10000)
+    parser.add_argument('--subscriptions', type=int, default=20, help='topics every connection subscribes to')
+    parser.add_argument('--seed', type=int, default=4211)
+    args = parser.parse_args()
+    process = start_server(args.mode, args.port)
+    try:
+        asyncio.run(run(args, process.pid))
+    finally:
+        process.kill()
+        process.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+payloads.py
+
+Purpose: Compares publishing large payloads as text with /PUB against
+publishing them as binary messages (see framing.PUBLISH). For each way a
+fresh server is started as a subprocess, a publisher sends --messages
+payloads of --size bytes to a topic with --subscribers subscribers, and
+the benchmark reports the time until every subscriber received all of
+them along with how much the peak memory of the server grew.
+
+e.g., python benchmarks/payloads.py --mode threaded --size 8000000 --subscribers 10
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from framing import COMMAND, DATA, MAX_BINARY_SIZE, MESSAGE, PUBLISH, FrameParser, binary_header, encode_frame
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+TOPIC = 'BENCH/PAYLOADS'
+
+"""
+start_server(mode, port)
+
+Starts the server in a subprocess and waits until it accepts connections.
+"""
+def start_server(mode, port):
+    process = subprocess.Popen([sys.executable, SERVER, '--mode', mode, '--port', str(port),
+                                '--log-level', 'off'], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+"""
+peak_memory(pid)
+
+Returns the peak resident memory of a process in bytes.
+"""
+def peak_memory(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+class Connection:
+    """
+    A connection of the benchmark, reading frames with its own parser.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.parser = FrameParser(256 * 1024, MAX_BINARY_SIZE)
+
+    def send(self, message):
+        self.writer.write(encode_frame(COMMAND, message.encode('utf-8')))
+
+    async def read(self):
+        frame = self.parser.next_frame()
+        while frame is None:
+            data = await self.reader.read(256 * 1024)
+            if not data:
+                raise ConnectionError('Connection closed by server')
+            self.parser.feed(data)
+            frame = self.parser.next_frame()
+        return frame
+
+    """
+    count_messages(count)
+
+    Coroutine that reads until count MESSAGE or DATA frames have arrived.
+    """
+    async def count_messages(self, count):
+        while count > 0:
+            kind, payload = await self.read()
+            if kind == MESSAGE or kind == DATA:
+                count -= 1
+
+"""
+connect(port)
+
+Opens a connection, performs the CONN_ACK handshake and subscribes it to
+the benchmark topic.
+"""
+async def connect(port):
+    connection = Connection(*await asyncio.open_connection('localhost', port))
+    await connection.read()
+    connection.send('CONN_ACK accepted by client')
+    connection.send(f'/SUB {TOPIC}')
+    await connection.read()
+    return connection
+
+async def run(args, binary, pid):
+    connections = [await connect(args.port) for _ in range(args.subscribers)]
+    publisher = connections[0]
+    if binary:
+        payload = os.urandom(args.size)
+        frames = [binary_header(PUBLISH, TOPIC, len(payload)), payload]
+    else:
+        payload = 'x' * args.size
+        frames = [encode_frame(COMMAND, f'/PUB {TOPIC} {payload}'.encode('utf-8'))]
+    await asyncio.sleep(0.5)
+    before = peak_memory(pid)
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        publisher.writer.writelines(frames)
+    await asyncio.gather(*(connection.count_messages(args.messages) for connection in connections))
+    elapsed = time.perf_counter() - start
+    for connection in connections:
+        connection.writer.close()
+    return elapsed, peak_memory(pid) - before
+
+def main():
+    parser = argparse.ArgumentParser(description='Large payloads as text and as binary messages')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--port', type=int, default=8098)
+    parser.add_argument('--size', type=int, default=8 * 1000 * 1000, help='bytes of every payload')
+    parser.add_argument('--messages', type=int, default=5)
+    parser.add_argument('--subscribers', type=int, default=10)
+    args = parser.parse_args()
+    print(f'{args.mode} mode, {args.messages} payloads of {args.size / 1e6:.1f}MB to {args.subscribers} subscribers')
+    for name, binary in (('text /PUB', False), ('binary', True)):
+        process = start_server(args.mode, args.port)
+        try:
+            elapsed, growth = asyncio.run(run(args, binary, process.pid))
+        finally:
+            process.kill()
+            process.wait()
+        delivered = args.size * args.messages * args.subscribers
+        print(f'{name:10}  {elapsed:7.2f}s  {delivered / elapsed / 1e6:8.1f}MB/s delivered  '
+              f'server peak memory +{growth / 1e6:.0f}MB')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+pipelining.py
+
+Purpose: Measures how many publishes per second a single process gets
+through with the client library (connection.py). Starts the server as a
+subprocess and publishes with both the threaded Connection and the
+AsyncConnection, once waiting for every reply before the next publish
+and once pipelined, with up to --window publishes waiting for a reply.
+
+e.g., python benchmarks/pipelining.py --messages 50000 --window 1000
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from connection import AsyncConnection, Connection
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+TOPIC = 'LOAD/PIPELINING'
+
+"""
+start_server(mode, port)
+
+Starts the server in a subprocess and waits until it accepts connections.
+"""
+def start_server(mode, port):
+    process = subprocess.Popen([sys.executable, SERVER, '--mode', mode, '--port', str(port),
+                                '--log-level', 'off'], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+"""
+publish_threaded(port, messages, window)
+
+Publishes with the threaded connection and returns the publishes per
+second. A window of 1 waits for every reply before the next publish.
+"""
+def publish_threaded(port, messages, window):
+    with Connection(port=port) as connection:
+        connection.subscribe(TOPIC).result()
+        waiting = collections.deque()
+        start = time.perf_counter()
+        for number in range(messages):
+            if len(waiting) >= window:
+                waiting.popleft().result()
+            waiting.append(connection.publish(TOPIC, f'message {number}'))
+        for future in waiting:
+            future.result()
+        return messages / (time.perf_counter() - start)
+
+"""
+publish_async(port, messages, window)
+
+Publishes with the asyncio connection and returns the publishes per
+second.
+"""
+async def publish_async(port, messages, window):
+    async with await AsyncConnection.connect(port=port) as connection:
+        await connection.subscribe(TOPIC)
+        waiting = collections.deque()
+        start = time.perf_counter()
+        for number in range(messages):
+            if len(waiting) >= window:
+                await waiting.popleft()
+            waiting.append(connection.publish(TOPIC, f'message {number}'))
+        await asyncio.gather(*waiting)
+        return messages / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Client library publish throughput')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio', help='server mode')
+    parser.add_argument('--port', type=int, default=8096)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--window', type=int, default=1000, help='publishes waiting for a reply when pipelined')
+    args = parser.parse_args()
+    process = start_server(args.mode, args.port)
+    try:
+        for window in (1, args.window):
+            label = 'one at a time' if window == 1 else f'pipelined ({window})'
+            rate = publish_threaded(args.port, args.messages, window)
+            print(f'Connection       {label:18} {rate:10,.0f} publishes/s')
+            rate = asyncio.run(publish_async(args.port, args.messages, window))
+            print(f'AsyncConnection  {label:18} {rate:10,.0f} publishes/s')
+    finally:
+        process.kill()
+        process.wait()
+
+if __name__ == '__main__':
+    main()
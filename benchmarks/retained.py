@@ -0,0 +1,66 @@
+"""
+retained.py
+
+Purpose: Benchmark of the retained message log. Retains messages on many
+topics, compares group commit with an fsync for every message, and
+measures how long a restart takes to load the log back. The end of the
+log is then cut off in the middle of a record to check that a crash
+during a write still loads.
+
+e.g., python benchmarks/retained.py --topics 10000 --messages 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from retained import LogRetainedStore
+
+def main():
+    parser = argparse.ArgumentParser(description='Retained message log benchmark')
+    parser.add_argument('--topics', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=100, help='message size in bytes')
+    parser.add_argument('--fsync-each', type=int, default=200, help='messages written with an fsync each')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'retained.log')
+        message = 'x' * args.size
+
+        store = LogRetainedStore(path)
+        store.load()
+        start = time.perf_counter()
+        for index in range(args.fsync_each):
+            store.put(f'BENCH/{index % args.topics}', message)
+            store.sync()
+        elapsed = time.perf_counter() - start
+        print(f'fsync each:    {args.fsync_each / elapsed:12,.0f} messages/s')
+
+        start = time.perf_counter()
+        for index in range(args.messages):
+            store.put(f'BENCH/{index % args.topics}', message)
+        store.sync()
+        elapsed = time.perf_counter() - start
+        print(f'group commit:  {args.messages / elapsed:12,.0f} messages/s (durable)')
+        store.close()
+        print(f'log size:      {os.path.getsize(path) / 1e6:12.1f}MB ({store.records} records)')
+
+        start = time.perf_counter()
+        store = LogRetainedStore(path)
+        loaded = store.load()
+        print(f'load:          {time.perf_counter() - start:12.3f}s for {len(loaded)} topics')
+        store.close()
+
+        with open(path, 'r+b') as log:
+            log.truncate(os.path.getsize(path) - args.size // 2)
+        store = LogRetainedStore(path)
+        recovered = store.load()
+        store.close()
+        print(f'torn write:    {len(recovered):12d} topics recovered')
+
+if __name__ == '__main__':
+    main()
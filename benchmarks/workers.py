@@ -0,0 +1,163 @@
+"""
+workers.py
+
+Purpose: Measures how the server scales with its number of worker
+processes. For every worker count the server is started with --workers,
+several load processes connect subscribers and a publisher to it, and
+every publisher sends messages to a topic that all of the subscribers of
+every load process are subscribed to. Reports the messages delivered per
+second for each worker count. The load processes need cores too, so the
+numbers only mean something on a machine with more cores than workers.
+
+e.g., python benchmarks/workers.py --max-workers 4 --load 4
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from framing import COMMAND, MESSAGE, FrameParser, encode_frame
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+TOPIC = 'LOAD/WORKERS'
+
+"""
+start_server(workers, port)
+
+Starts the server with a number of workers and waits until it accepts
+connections.
+"""
+def start_server(workers, port):
+    process = subprocess.Popen([sys.executable, SERVER, '--mode', 'asyncio', '--workers', str(workers),
+                                '--port', str(port), '--queue-size', '1000000'],
+                               stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+class Connection:
+    """
+    A connection of the load test, reading frames with its own parser.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.parser = FrameParser(64 * 1024)
+
+    def send(self, message):
+        self.writer.write(encode_frame(COMMAND, message.encode('utf-8')))
+
+    async def read(self):
+        frame = self.parser.next_frame()
+        while frame is None:
+            data = await self.reader.read(64 * 1024)
+            if not data:
+                raise ConnectionError('Connection closed by server')
+            self.parser.feed(data)
+            frame = self.parser.next_frame()
+        return frame
+
+    """
+    count_messages(count)
+
+    Coroutine that reads until count MESSAGE frames have arrived.
+    """
+    async def count_messages(self, count):
+        while count > 0:
+            kind, payload = await self.read()
+            if kind == MESSAGE:
+                count -= 1
+
+"""
+connect(port)
+
+Opens a connection, performs the CONN_ACK handshake and subscribes it to
+the load test topic.
+"""
+async def connect(port):
+    connection = Connection(*await asyncio.open_connection('localhost', port))
+    await connection.read()
+    connection.send('CONN_ACK accepted by client')
+    connection.send(f'/SUB {TOPIC}')
+    await connection.read()
+    return connection
+
+"""
+run_load(port, subscribers, messages, total, barrier, results)
+
+Runs in a load process. Connects the subscribers, the first of which is
+also the publisher, waits for every other load process, then publishes
+and waits until every subscriber received the messages of all load
+processes.
+"""
+async def run_load(port, subscribers, messages, total, barrier, results):
+    connections = [await connect(port) for _ in range(subscribers)]
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, barrier.wait)
+    start = time.perf_counter()
+    publisher = connections[0]
+    for number in range(messages):
+        publisher.send(f'/PUB {TOPIC} message {number}')
+    await asyncio.wait_for(asyncio.gather(*(connection.count_messages(total) for connection in connections)), 120)
+    results.put(time.perf_counter() - start)
+    for connection in connections:
+        connection.writer.close()
+
+def load_process(port, subscribers, messages, total, barrier, results):
+    asyncio.run(run_load(port, subscribers, messages, total, barrier, results))
+
+"""
+measure(workers, args)
+
+Runs the load against a server with a number of workers and returns the
+delivered messages per second.
+"""
+def measure(workers, args):
+    process = start_server(workers, args.port)
+    try:
+        # Let every worker subscribe to the other workers first
+        time.sleep(0.5)
+        barrier = multiprocessing.Barrier(args.load)
+        results = multiprocessing.Queue()
+        total = args.load * args.messages
+        loads = [multiprocessing.Process(target=load_process,
+                                         args=(args.port, args.subscribers, args.messages, total, barrier, results))
+                 for _ in range(args.load)]
+        for load in loads:
+            load.start()
+        elapsed = max(results.get(timeout=180) for _ in loads)
+        for load in loads:
+            load.join()
+        return total * args.subscribers * args.load / elapsed
+    finally:
+        process.kill()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker process scaling benchmark')
+    parser.add_argument('--port', type=int, default=8094)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--load', type=int, default=4, help='number of load processes')
+    parser.add_argument('--subscribers', type=int, default=50, help='subscribers per load process')
+    parser.add_argument('--messages', type=int, default=2000, help='messages published per load process')
+    args = parser.parse_args()
+    print(f'{args.load} load processes, {args.subscribers} subscribers and {args.messages} messages each')
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        rate = measure(workers, args)
+        baseline = baseline or rate
+        print(f'workers: {workers:3}  {rate:12,.0f} messages/s delivered  ({rate / baseline:.2f}x)')
+
+if __name__ == '__main__':
+    main()
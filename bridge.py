@@ -0,0 +1,346 @@
+"""
+bridge.py
+
+Purpose: Connects separate brokers, e.g., brokers on other machines
+that each serve a share of the topics. A bridge is a connection between
+two brokers over which the messages published and retained on topics
+matching its topic filters flow both ways. One broker opens it (see
+Bridges.connect()) like a client would, and turns it into a bridge with
+the /BRIDGE command, so the other broker needs no configuration.
+
+Messages are sent in batches: everything forwarded to a bridge during
+one pass of the event loop is written as a single BRIDGE_MESSAGES frame.
+While more than MAX_BACKLOG bytes wait to be sent to the other broker,
+the batches are held back and grow instead, and a bridge whose held
+back messages reach MAX_PENDING bytes is closed, as the other broker
+stopped reading. A bridge this broker opened is then opened again.
+Every message carries the id of the broker it was published on and a
+sequence number, so a broker that gets the same message over two paths,
+e.g., when the brokers are bridged in a ring, drops the second copy and
+never forwards a message back to the broker it came from.
+"""
+
+import asyncio
+import collections
+import itertools
+import os
+import struct
+
+from framing import COMMAND, REPLY, FrameError, FrameParser, encode_frame
+from topics import topic_matches
+
+BRIDGE_MESSAGES = 20 # Frame kind of a batch of messages between brokers, clients never see these
+
+# Message header: origin broker, sequence number, flags, topic length, message length
+RECORD = struct.Struct('!QQBHI')
+RETAIN = 1 # Flag of a message that is retained, not published
+
+BATCH_SIZE = 1024 * 1024 # Bytes of messages after which a batch is written without waiting for the pass to end
+MAX_BACKLOG = 4 * BATCH_SIZE   # Bytes waiting to be sent to the other broker above which batches are held back
+MAX_PENDING = 64 * BATCH_SIZE  # Bytes of held back messages at which the bridge is closed
+DRAIN_DELAY = 0.01       # Seconds between checks whether a held back batch can be written
+SEEN_SIZE = 65536        # Messages remembered to drop the copies that arrive again
+RECONNECT_DELAY = 1.0    # Seconds before a lost bridge is opened again, doubling up to MAX_RECONNECT_DELAY
+MAX_RECONNECT_DELAY = 30.0
+
+class BridgeBatch:
+    """
+    A BRIDGE_MESSAGES frame received from a broker on a client
+    connection, returned by the receive() of a session instead of a
+    command.
+    """
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+"""
+encode_record(origin, sequence, flags, topic, message)
+
+Returns a message as it is laid out in a BRIDGE_MESSAGES frame.
+"""
+def encode_record(origin, sequence, flags, topic, message):
+    topic_bytes = topic.encode('utf-8')
+    message_bytes = message.encode('utf-8')
+    return RECORD.pack(origin, sequence, flags, len(topic_bytes), len(message_bytes)) + topic_bytes + message_bytes
+
+"""
+decode_records(payload)
+
+Returns a list of (origin, sequence, flags, topic, message) tuples, one
+for every message in the payload of a BRIDGE_MESSAGES frame.
+"""
+def decode_records(payload):
+    records = []
+    position = 0
+    while position < len(payload):
+        if position + RECORD.size > len(payload):
+            raise FrameError('Bridge message is shorter than its header')
+        origin, sequence, flags, topic_length, message_length = RECORD.unpack_from(payload, position)
+        topic_end = position + RECORD.size + topic_length
+        end = topic_end + message_length
+        if end > len(payload):
+            raise FrameError('Bridge message is shorter than its header')
+        records.append((origin, sequence, flags, bytes(payload[position + RECORD.size:topic_end]).decode('utf-8'),
+                        bytes(payload[topic_end:end]).decode('utf-8')))
+        position = end
+    return records
+
+class BridgeLink:
+    """
+    Constructor for a bridge to the broker with the id peer. Messages on
+    topics matching filters are written to it with write(frame), the
+    messages forwarded during one pass of the event loop as one frame.
+    backlog() returns the bytes written that are not sent yet, and
+    close() closes the connection of a bridge that stopped reading.
+    """
+    def __init__(self, peer, filters, write, backlog, close):
+        self.peer = peer
+        self.filters = filters
+        self.write = write
+        self.backlog = backlog
+        self.close = close
+        self.pending = []
+        self.pending_bytes = 0
+        self.held = False # A batch is held back until the backlog drains, see flush()
+
+    """
+    wants(origin, topic)
+
+    Returns True if a message published on broker origin to topic is to
+    be sent over the bridge.
+    """
+    def wants(self, origin, topic):
+        if origin == self.peer:
+            return False
+        for topic_filter in self.filters:
+            if topic_matches(topic_filter, topic):
+                return True
+        return False
+
+    """
+    send(record)
+
+    Queues an encoded message for the other broker.
+    """
+    def send(self, record):
+        self.pending.append(record)
+        self.pending_bytes += len(record)
+        if self.pending_bytes >= MAX_PENDING:
+            self.pending, self.pending_bytes = [], 0
+            self.close()
+        elif self.pending_bytes >= BATCH_SIZE:
+            self.flush()
+        elif len(self.pending) == 1:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    """
+    flush()
+
+    Writes every queued message as a single frame, unless more than
+    MAX_BACKLOG bytes still wait to be sent. The messages are then held
+    back, and written once the backlog has drained.
+    """
+    def flush(self):
+        if not self.pending or self.held:
+            return # Already written because the batch was full, or held back
+        if self.backlog() > MAX_BACKLOG:
+            self.held = True
+            asyncio.get_running_loop().call_later(DRAIN_DELAY, self.resume)
+            return
+        records, self.pending, self.pending_bytes = self.pending, [], 0
+        self.write(encode_frame(BRIDGE_MESSAGES, b''.join(records)))
+
+    """
+    resume()
+
+    Checks again whether the held back messages can be written.
+    """
+    def resume(self):
+        self.held = False
+        self.flush()
+
+class Bridges:
+    """
+    Constructor for the bridges of a broker. The callbacks apply the
+    messages of other brokers: on_message(topic, message, retain, pending)
+    publishes a message to the local subscribers, or only retains it, and
+    on_batch(pending) is called after every batch, see server.deliver()
+    for pending. Every broker gets a random id when it starts.
+    """
+    def __init__(self, on_message, on_batch):
+        self.on_message = on_message
+        self.on_batch = on_batch
+        self.node = int.from_bytes(os.urandom(8), 'big')
+        self.sequence = itertools.count(1)
+        self.links = []
+        self.sessions = {} # session -> BridgeLink, for the bridges other brokers opened
+        self.seen = set()  # (origin, sequence) of the last SEEN_SIZE messages received
+        self.seen_order = collections.deque()
+        self.tasks = []    # The coroutines of the bridges this broker opened, see connect()
+        self.received = 0
+        self.forwarded = 0
+        self.duplicates = 0
+
+    """
+    publish(topic, message)
+
+    Forwards a message published by a local client.
+    """
+    def publish(self, topic, message):
+        if self.links:
+            self.forward(self.node, next(self.sequence), 0, topic, message, None)
+
+    """
+    retain(topic, message)
+
+    Forwards a message retained by a local client.
+    """
+    def retain(self, topic, message):
+        if self.links:
+            self.forward(self.node, next(self.sequence), RETAIN, topic, message, None)
+
+    """
+    forward(origin, sequence, flags, topic, message, source)
+
+    Sends a message to every bridge that wants it, except to source, the
+    bridge it arrived over. The message is encoded once for all of them.
+    """
+    def forward(self, origin, sequence, flags, topic, message, source):
+        record = None
+        for link in self.links:
+            if link is not source and link.wants(origin, topic):
+                if record is None:
+                    record = encode_record(origin, sequence, flags, topic, message)
+                link.send(record)
+                self.forwarded += 1
+
+    """
+    receive(link, payload)
+
+    Applies the messages of a BRIDGE_MESSAGES frame that arrived over a
+    bridge, and forwards them to the other bridges. Messages that already
+    arrived over another path are dropped.
+    """
+    def receive(self, link, payload):
+        pending = set()
+        for origin, sequence, flags, topic, message in decode_records(payload):
+            if origin == self.node or self.is_duplicate(origin, sequence):
+                self.duplicates += 1
+                continue
+            self.received += 1
+            self.on_message(topic, message, bool(flags & RETAIN), pending)
+            self.forward(origin, sequence, flags, topic, message, link)
+        self.on_batch(pending)
+
+    """
+    is_duplicate(origin, sequence)
+
+    Returns True if the message was received before, and remembers it
+    otherwise.
+    """
+    def is_duplicate(self, origin, sequence):
+        key = (origin, sequence)
+        if key in self.seen:
+            return True
+        self.seen.add(key)
+        self.seen_order.append(key)
+        if len(self.seen_order) > SEEN_SIZE:
+            self.seen.discard(self.seen_order.popleft())
+        return False
+
+    """
+    accept(session, arguments)
+
+    Turns the connection of session into a bridge, for the /BRIDGE
+    command of another broker. arguments are the id of that broker and
+    the topic filters of the bridge. Returns the reply to the command.
+    A connection that already is a bridge stays the bridge it was.
+    """
+    def accept(self, session, arguments):
+        if session in self.sessions:
+            return 'This connection is already a bridge.'
+        peer, *filters = arguments.split()
+        link = BridgeLink(int(peer), filters or ['#'], lambda frame: session.enqueue(frame, BRIDGE_MESSAGES),
+                          lambda: session.queued_bytes, session.abort)
+        self.sessions[session] = link
+        self.links.append(link)
+        return f'BRIDGE_ACK {self.node}'
+
+    """
+    detach(session)
+
+    Removes the bridge of a session whose connection was closed, if it
+    has one.
+    """
+    def detach(self, session):
+        link = self.sessions.pop(session, None)
+        if link is not None:
+            self.links.remove(link)
+
+    """
+    start(host, port, filters)
+
+    Starts a bridge that this broker opens to the broker on host:port.
+    """
+    def start(self, host, port, filters):
+        self.tasks.append(asyncio.get_running_loop().create_task(self.connect(host, port, filters)))
+
+    """
+    connect(host, port, filters)
+
+    Coroutine that keeps a bridge to the broker on host:port open. The
+    bridge connects like a client, and is opened again whenever it is
+    lost, waiting longer after every failed attempt.
+    """
+    async def connect(self, host, port, filters):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            try:
+                await self.run_link(reader, writer, filters)
+            except (OSError, FrameError, ValueError):
+                pass
+            finally:
+                writer.close()
+            await asyncio.sleep(delay)
+
+    """
+    run_link(reader, writer, filters)
+
+    Coroutine that performs the handshake of a bridge this broker opened,
+    and then applies what the other broker sends until it goes away.
+    """
+    async def run_link(self, reader, writer, filters):
+        parser = FrameParser(64 * 1024)
+        link = None
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                parser.feed(data)
+                for kind, payload in parser:
+                    if kind == BRIDGE_MESSAGES and link is not None:
+                        self.receive(link, payload)
+                    elif kind != REPLY:
+                        continue
+                    elif payload == b'CONN_ACK':
+                        writer.write(encode_frame(COMMAND, b'CONN_ACK accepted by bridge'))
+                        command = ' '.join(['/BRIDGE', str(self.node)] + filters)
+                        writer.write(encode_frame(COMMAND, command.encode('utf-8')))
+                    elif payload.startswith(b'BRIDGE_ACK ') and link is None:
+                        link = BridgeLink(int(payload[len(b'BRIDGE_ACK '):]), filters, writer.write,
+                                          writer.transport.get_write_buffer_size, writer.close)
+                        self.links.append(link)
+                    elif link is None:
+                        raise ValueError(f'Bridge was refused: {payload.decode("utf-8")}')
+        finally:
+            if link is not None:
+                self.links.remove(link)
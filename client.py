@@ -7,38 +7,53 @@ client can both receive messages from the server and send messages
 to it.
 """
 
+import argparse
 import threading
 import socket
 import sys
 
+from framing import ACK, COMMAND, DATA, MAX_BINARY_SIZE, PACKET_ID, QOS_MESSAGE, FrameParser, decode_binary, \
+    encode_frame
+
 class Client:
     """
-    Constructor for client. The user can give a command-line argument for
-    determining the localhost port to connect to. If none is specified, the
-    default port will be 8080.
+    Constructor for client. The user can give command-line arguments for
+    the host and port to connect to, see main(). If none are specified, the
+    client connects to port 8092 of localhost.
+
+    An interactive client reads commands from the terminal with its write
+    thread. A client that is not interactive has no write thread, it is
+    driven by calling send() instead, e.g., from a script, and is only
+    returned once the server has accepted the connection. Every message
+    from the server is passed to on_message, which prints it by default.
+    Raises OSError if the server cannot be reached.
     """
-    def __init__(self, port = 8092):
+    def __init__(self, port = 8092, host = 'localhost', interactive = True, on_message = print):
         """
         Initialize the client socket using TCP
         """
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.parser = FrameParser(max_frame_size=MAX_BINARY_SIZE)
+        self.send_lock = threading.Lock() # Both threads send to the server
+        self.on_message = on_message
+        self.connected = threading.Event() # Set once CONN_ACK was acknowledged
+        self.packet_id = 0 # Highest packet id of the QoS 1 messages received, see /QOS
 
         """
-        Attempt to connect to the server, if the connection fails, then handle
-        the exception.
+        Attempt to connect to the server, the caller handles a failure.
         """
         try:
-            self.sock.connect( ('localhost', port) )
-        except socket.error:
-            print("Unable to connect to server. Server may be down or on a different port")
-            sys.exit(1)
+            self.sock.connect( (host, port) )
+        except OSError:
+            self.sock.close()
+            raise
 
         """
         Begin the receive thread, allowing to receive messages from server
         Begin the write thread, allowing to send messages to the server
         """
-        self.receive_thread = threading.Thread(target=self.receive)
-        self.write_thread = threading.Thread(target=self.write)
+        self.receive_thread = threading.Thread(target=self.receive, daemon=not interactive)
+        self.write_thread = threading.Thread(target=self.write) if interactive else None
 
         """
         Ready to disconnect flag will indicate when the client is ready to disconnect.
@@ -50,14 +65,19 @@ class Client:
         Start both receive and write threads
         """
         self.receive_thread.start()
-        self.write_thread.start()
+        if self.write_thread is not None:
+            self.write_thread.start()
+        elif not self.connected.wait(10):
+            self.sock.close()
+            raise ConnectionError('The server did not accept the connection')
     
     """
     receive()
 
     This function serves the purpose of handling received messages from the server.
     Depending on the message, the client will perform some action, like sending
-    acknoledgement to the server, or printing the message.
+    acknoledgement to the server, or printing the message. A single receive may
+    hold several messages, each of them is handled in order.
 
     Error handling is added in case the receive function does not work, in which
     the socket will close and the terminate safely.
@@ -65,19 +85,41 @@ class Client:
     def receive(self):
         while not self.ready_to_disconnect:
             try:
-                message = self.sock.recv(1024).decode('utf-8')
-                # print("debug: message=" + message)
-
-                if message == 'CONN_ACK':
-                    # Connection accepted, let's acknoledge it
-                    print("CONN_ACK received from server")
-                    self.sock.send("CONN_ACK accepted by client".encode('utf-8'))
-                elif message == 'DISC_ACK':
-                    print("DISC_ACK received from server, press enter to close socket")
-                    self.sock.send("DISC_ACK accepted by client".encode('utf-8'))
-                    self.ready_to_disconnect = True
-                else:
-                    print(message)
+                if self.parser.recv_into(self.sock) == 0:
+                    raise ConnectionError('Connection closed by server')
+                acknowledge = False
+                for kind, payload in self.parser:
+                    if kind == QOS_MESSAGE:
+                        # Acknowledged below, a message that was resent is not shown again
+                        (packet_id,) = PACKET_ID.unpack_from(payload)
+                        acknowledge = True
+                        if packet_id <= self.packet_id:
+                            continue
+                        self.packet_id = packet_id
+                        payload = payload[PACKET_ID.size:]
+                    if kind == DATA:
+                        # A binary message is not printed, only its size
+                        topic, data = decode_binary(payload)
+                        self.on_message(f'[{topic}]: <{len(data)} bytes>')
+                        continue
+                    message = payload.decode('utf-8')
+                    # print("debug: message=" + message)
+
+                    if message == 'CONN_ACK':
+                        # Connection accepted, let's acknoledge it
+                        print("CONN_ACK received from server")
+                        self.send("CONN_ACK accepted by client")
+                        self.connected.set()
+                    elif message == 'DISC_ACK':
+                        print("DISC_ACK received from server, press enter to close socket")
+                        self.send("DISC_ACK accepted by client")
+                        self.ready_to_disconnect = True
+                        break
+                    elif message:
+                        # An empty reply only means that a publish succeeded
+                        self.on_message(message)
+                if acknowledge:
+                    self.send_frame(encode_frame(ACK, PACKET_ID.pack(self.packet_id)))
             except:
                 print("An error occurred.")
                 self.sock.close()
@@ -96,8 +138,25 @@ class Client:
             if self.ready_to_disconnect:
                 self.stop()
             else:
-                self.sock.send(message.encode('utf-8'))
+                self.send(message)
         print("Closed write thread")
+
+    """
+    send(message)
+
+    This function sends a single command to the server as one frame.
+    """
+    def send(self, message):
+        self.send_frame(encode_frame(COMMAND, message.encode('utf-8')))
+
+    """
+    send_frame(frame)
+
+    This function sends an encoded frame to the server.
+    """
+    def send_frame(self, frame):
+        with self.send_lock:
+            self.sock.sendall(frame)
     
     """
     stop()
@@ -109,4 +168,21 @@ class Client:
         print("socket closed")
         sys.exit(0)
 
-client = Client()
\ No newline at end of file
+"""
+main()
+
+Parses the command line and starts an interactive client.
+"""
+def main():
+    parser = argparse.ArgumentParser(description='MQTT client')
+    parser.add_argument('--host', default='localhost', help='host of the server')
+    parser.add_argument('--port', type=int, default=8092, help='port of the server')
+    args = parser.parse_args()
+    try:
+        Client(args.port, args.host)
+    except OSError:
+        print("Unable to connect to server. Server may be down or on a different port")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
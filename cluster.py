@@ -0,0 +1,222 @@
+"""
+cluster.py
+
+Purpose: Lets several server processes (workers) act as a single MQTT
+server. Every worker listens on the same port with SO_REUSEPORT, so the
+kernel spreads new clients over the workers, and every pair of workers
+is connected by a Unix socket pair. A worker tells the other workers
+about every message published, message retained and topic created by
+its own clients, so that each worker holds the full topic table and a
+publisher on one worker still reaches the subscribers on another.
+"""
+
+import asyncio
+import socket
+
+from framing import MAX_BINARY_SIZE, TOPIC_LENGTH, FrameError, FrameParser, binary_header, \
+    decode_binary, encode_frame
+
+# Frame kinds used between workers, clients never see these
+PEER_PUBLISH = 16 # A message published to a topic
+PEER_RETAIN = 17  # A message retained for a topic
+PEER_TOPIC = 18   # A topic was created
+PEER_BINARY = 19  # A binary message published to a topic, laid out like a DATA frame
+
+"""
+listening_socket(host, port)
+
+Returns a listening socket that other workers can bind to the same port.
+"""
+def listening_socket(host, port, backlog = 4096):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind( (host, port) )
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+"""
+socket_pairs(count)
+
+Connects every pair of count workers. Returns a list with a dict for
+every worker, mapping the index of each other worker to the socket the
+worker talks to it through.
+"""
+def socket_pairs(count):
+    peers = [{} for _ in range(count)]
+    for first in range(count):
+        for second in range(first + 1, count):
+            peers[first][second], peers[second][first] = socket.socketpair()
+    return peers
+
+"""
+encode_peer_message(topic, message)
+
+Returns the payload of a frame between workers holding a topic and an
+optional message.
+"""
+def encode_peer_message(topic, message = ''):
+    topic_bytes = topic.encode('utf-8')
+    return TOPIC_LENGTH.pack(len(topic_bytes)) + topic_bytes + message.encode('utf-8')
+
+"""
+decode_peer_message(payload)
+
+Returns the (topic, message) tuple held by a frame between workers.
+"""
+def decode_peer_message(payload):
+    (length,) = TOPIC_LENGTH.unpack_from(payload)
+    end = TOPIC_LENGTH.size + length
+    return payload[TOPIC_LENGTH.size:end].decode('utf-8'), payload[end:].decode('utf-8')
+
+class PeerLink:
+    """
+    Constructor for the link to another worker. Frames sent during one
+    pass of the event loop are written together once the pass is over.
+    """
+    def __init__(self, cluster, sock):
+        self.cluster = cluster
+        self.sock = sock
+        self.pending = []
+        self.reader = None
+        self.writer = None
+        self.task = None
+
+    """
+    start()
+
+    Coroutine that opens the streams of the link and starts reading it.
+    """
+    async def start(self):
+        self.reader, self.writer = await asyncio.open_connection(sock=self.sock)
+        self.task = asyncio.get_running_loop().create_task(self.read())
+
+    """
+    send(frame)
+
+    Queues a frame for the other worker.
+    """
+    def send(self, frame):
+        self.pending.append(frame)
+        if len(self.pending) == 1:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    """
+    flush()
+
+    Writes every queued frame at once.
+    """
+    def flush(self):
+        frames, self.pending = self.pending, []
+        self.writer.writelines(frames)
+
+    """
+    read()
+
+    Reads the frames sent by the other worker and hands them to the
+    cluster, until the other worker goes away.
+    """
+    async def read(self):
+        parser = FrameParser(64 * 1024, MAX_BINARY_SIZE)
+        try:
+            while True:
+                data = await self.reader.read(64 * 1024)
+                if not data:
+                    break
+                parser.feed(data)
+                for kind, payload in parser:
+                    self.cluster.receive(kind, payload)
+        except (OSError, FrameError):
+            pass
+        self.cluster.links.remove(self)
+
+class Cluster:
+    """
+    Constructor for the cluster of a worker. The callbacks apply what the
+    other workers sent: on_publish(topic, message) delivers a message to
+    the local subscribers, on_retain(topic, message) retains a message,
+    on_topic(topic) creates a topic and on_binary(topic, message) delivers
+    a binary message.
+    """
+    def __init__(self, on_publish, on_retain, on_topic, on_binary):
+        self.on_publish = on_publish
+        self.on_retain = on_retain
+        self.on_topic = on_topic
+        self.on_binary = on_binary
+        self.links = []
+
+    """
+    connect(sockets)
+
+    Coroutine that starts the links to the other workers.
+    """
+    async def connect(self, sockets):
+        for sock in sockets:
+            link = PeerLink(self, sock)
+            await link.start()
+            self.links.append(link)
+
+    """
+    publish(topic, message)
+
+    Sends a message published by a local client to the other workers.
+    """
+    def publish(self, topic, message):
+        self.send(encode_frame(PEER_PUBLISH, encode_peer_message(topic, message)))
+
+    """
+    retain(topic, message)
+
+    Sends a message retained by a local client to the other workers.
+    """
+    def retain(self, topic, message):
+        self.send(encode_frame(PEER_RETAIN, encode_peer_message(topic, message)))
+
+    """
+    topic(topic)
+
+    Sends a topic created by a local client to the other workers.
+    """
+    def topic(self, topic):
+        self.send(encode_frame(PEER_TOPIC, encode_peer_message(topic)))
+
+    """
+    publish_binary(topic, chunks)
+
+    Sends a binary message published by a local client, given as a list
+    of pieces, to the other workers. The pieces are written as they are,
+    after the header of the frame.
+    """
+    def publish_binary(self, topic, chunks):
+        header = binary_header(PEER_BINARY, topic, sum(len(chunk) for chunk in chunks))
+        for link in self.links:
+            link.send(header)
+            for chunk in chunks:
+                link.send(chunk)
+
+    """
+    send(frame)
+
+    Sends the same frame to every other worker.
+    """
+    def send(self, frame):
+        for link in self.links:
+            link.send(frame)
+
+    """
+    receive(kind, payload)
+
+    Applies a frame sent by another worker.
+    """
+    def receive(self, kind, payload):
+        if kind == PEER_BINARY:
+            self.on_binary(*decode_binary(payload))
+            return
+        topic, message = decode_peer_message(payload)
+        if kind == PEER_PUBLISH:
+            self.on_publish(topic, message)
+        elif kind == PEER_RETAIN:
+            self.on_retain(topic, message)
+        elif kind == PEER_TOPIC:
+            self.on_topic(topic)
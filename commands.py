@@ -0,0 +1,122 @@
+"""
+commands.py
+
+Purpose: Parses the commands that clients send to the server. A command
+is identified by its opcode, which also fixes its arguments, and the
+server looks the opcode up in a table of handlers instead of comparing
+the command against every command it knows.
+
+People type commands as text, e.g., /PUB WEATHER sunny, which
+parse_command() splits into the opcode and its arguments in one pass.
+Programs can send OPCODE frames instead (see encode_command()), which
+hold the opcode as a byte and need no text parsing at all:
+
+    +--------+-----------------------------------------------------+
+    | opcode | arguments                                           |
+    | 1 byte | none, one UTF-8 argument, or for a topic and message: |
+    |        | topic length (2 bytes, big), topic, message         |
+    +--------+-----------------------------------------------------+
+"""
+
+import re
+
+from framing import OPCODE, TOPIC_LENGTH, FrameError, encode_frame
+
+# Opcodes
+SUB = 1
+UNSUB = 2
+PUB = 3
+PUBR = 4
+LIST = 5
+STATS = 6
+QOS = 7
+SESSION = 8
+DISC = 9
+BRIDGE = 10
+SUBFROM = 11
+
+# Text command -> opcode
+OPCODES = {'/SUB': SUB, '/UNSUB': UNSUB, '/PUB': PUB, '/PUBR': PUBR, '/LIST': LIST, '/STATS': STATS,
+           '/QOS': QOS, '/SESSION': SESSION, '/DISC': DISC, '/BRIDGE': BRIDGE,
+           '/SUBFROM': SUBFROM}
+NAMES = {opcode: text[1:] for text, opcode in OPCODES.items()} # Opcode -> name, e.g., for the metrics
+
+# Opcode -> arguments: 0 for none, 1 for a single argument, 2 for a topic and a message
+ARGUMENTS = {SUB: 1, UNSUB: 1, PUB: 2, PUBR: 2, LIST: 0, STATS: 0, QOS: 1, SESSION: 1, DISC: 0, BRIDGE: 1,
+             SUBFROM: 2}
+
+# Kinds of topic arguments, see topic_kind()
+TOPIC = 0
+SINGLE_LEVEL = 1 # One + wildcard, e.g., WEATHER/+/NINE
+MULTI_LEVEL = 2  # Ends with the /# wildcard, e.g., WEATHER/#
+TOPIC_KIND = re.compile(r'(?P<multi>.*/#)|(?P<single>[^+]*\+[^+]*)', re.DOTALL)
+WILDCARDS = re.compile(r'[+#]')
+WHITESPACE = re.compile(r'\s+') # Separates the name and the arguments of a text command
+
+"""
+parse_command(message)
+
+Splits a text command into its opcode and the tuple of its arguments,
+at runs of whitespace. The message of /PUB and /PUBR is None when there
+is none. The opcode is None for an unknown command.
+"""
+def parse_command(message):
+    name, *rest = WHITESPACE.split(message, 1)
+    opcode = OPCODES.get(name)
+    arguments = ARGUMENTS.get(opcode)
+    if arguments == 1:
+        return opcode, (rest[0] if rest else '',)
+    elif arguments == 2:
+        name, topic, *body = WHITESPACE.split(message, 2) if rest else (name, '')
+        return opcode, (topic, body[0] if body else None)
+    return opcode, ()
+
+"""
+encode_command(opcode, *arguments)
+
+Returns the OPCODE frame of a command.
+"""
+def encode_command(opcode, *arguments):
+    if ARGUMENTS[opcode] == 2:
+        topic = arguments[0].encode('utf-8')
+        payload = bytes((opcode,)) + TOPIC_LENGTH.pack(len(topic)) + topic + arguments[1].encode('utf-8')
+    elif arguments:
+        payload = bytes((opcode,)) + arguments[0].encode('utf-8')
+    else:
+        payload = bytes((opcode,))
+    return encode_frame(OPCODE, payload)
+
+"""
+decode_command(payload)
+
+Returns the (opcode, arguments) tuple of the payload of an OPCODE frame,
+like parse_command() does for a text command.
+"""
+def decode_command(payload):
+    if not payload:
+        raise FrameError('OPCODE frame without an opcode')
+    opcode = payload[0]
+    arguments = ARGUMENTS.get(opcode)
+    if arguments == 1:
+        return opcode, (payload[1:].decode('utf-8'),)
+    elif arguments == 2:
+        if len(payload) < 3:
+            raise FrameError('OPCODE frame is shorter than its topic')
+        end = 3 + (payload[1] << 8 | payload[2]) # The topic length, TOPIC_LENGTH
+        if end > len(payload):
+            raise FrameError('OPCODE frame is shorter than its topic')
+        return opcode, (payload[3:end].decode('utf-8'), payload[end:].decode('utf-8'))
+    return (opcode if arguments is not None else None), ()
+
+"""
+topic_kind(topic)
+
+Returns whether a topic argument is a MULTI_LEVEL or SINGLE_LEVEL
+wildcard, or a TOPIC. A TOPIC may still hold wildcard characters that
+make it invalid, see WILDCARDS.
+"""
+def topic_kind(topic):
+    match = TOPIC_KIND.fullmatch(topic)
+    if match is None:
+        return TOPIC
+    return MULTI_LEVEL if match.lastgroup == 'multi' else SINGLE_LEVEL
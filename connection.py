@@ -0,0 +1,662 @@
+"""
+connection.py
+
+Purpose: The client library, for programs that publish and subscribe
+without a terminal. Connection runs on threads and AsyncConnection on
+an asyncio event loop, both offer the same commands.
+
+Every command returns a future right away instead of waiting for the
+server. Commands are sent as OPCODE frames (see commands.py), which the
+server does not have to parse, and written back to back, many of them
+with a single write, while the server is still working on earlier ones
+(pipelining).
+The server replies to every command exactly once and in order, so each
+reply resolves the oldest future that is still waiting. Messages from
+subscribed topics go to the callback given for the topic, to on_message,
+and to messages() for a program that iterates over them. The message of
+a binary publish, see publish_binary(), arrives as a memoryview.
+
+After set_qos(1) messages are delivered at least once. The connection
+acknowledges them with a single ACK for everything that one read from
+the socket held, once their callbacks have returned, and passes on a
+message that the server resent only if it did not get it before.
+
+resume(client_id) keeps the subscriptions of the connection on the
+server after it is closed, and queues the messages published to them
+until a new connection resumes the session. They arrive like any other
+message, so a callback given to subscribe() before resume() gets them.
+
+subscribe_from(topic, offset) also gets the messages the server still
+keeps of a topic from an offset on, see --history in server.py. Those
+messages, and every message published to a topic the server keeps a
+history of, carry their offset, and offsets[topic] is the offset after
+the last message of the topic received, to subscribe from again later.
+
+e.g.,
+    with Connection(port=8092) as connection:
+        connection.subscribe('WEATHER', lambda topic, message: print(message))
+        futures = [connection.publish('WEATHER', f'reading {n}') for n in range(10000)]
+        for future in futures:
+            future.result()
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import queue
+import re
+import socket
+import threading
+
+from framing import ACK, COMMAND, DATA, MAX_BINARY_SIZE, MESSAGE, PACKET_ID, PUBLISH, QOS_MESSAGE, FrameError, \
+    FrameParser, binary_header, decode_binary, encode_frame, send_frames
+from commands import DISC, LIST, PUB, PUBR, QOS, SESSION, STATS, SUB, SUBFROM, UNSUB, encode_command
+from topics import topic_matches
+
+LOG = logging.getLogger('mqtt.connection')
+
+class CommandError(Exception):
+    """
+    Raised by the future of a command that the server refused, e.g., a
+    publish to a topic the client is not subscribed to. The message is
+    the server's reply.
+    """
+
+# [TOPIC]: or, on a topic with a history, [TOPIC]@OFFSET: in front of a message
+MESSAGE_PREFIX = re.compile(r'\[(.*?)\](?:@([0-9]+))?: ', re.DOTALL)
+
+"""
+parse_message(payload)
+
+Returns the (topic, message, offset) tuple of a MESSAGE frame, which the
+server sends as [TOPIC]: MESSAGE, or as [TOPIC]@OFFSET: MESSAGE for a
+topic it keeps a history of. The offset is None if there is none.
+"""
+def parse_message(payload):
+    text = str(payload, 'utf-8')
+    match = MESSAGE_PREFIX.match(text)
+    if match is None:
+        raise ValueError('Message has no topic')
+    topic, offset = match.groups()
+    return topic, text[match.end():], None if offset is None else int(offset)
+
+# Reply checks, each returns the result of a command or raises CommandError
+
+def published(reply):
+    if reply:
+        raise CommandError(reply)
+
+def subscribed(reply):
+    if not reply.startswith(('Subscribed to', 'You are already subscribed')):
+        raise CommandError(reply)
+    return reply
+
+def subscribed_from(reply):
+    head, found, offsets = reply.rpartition(' from offset ')
+    if not head.startswith('Subscribed to') or not found:
+        raise CommandError(reply)
+    first, _, next_offset = offsets.partition(', next offset ')
+    return int(first), int(next_offset)
+
+def unsubscribed(reply):
+    if not reply.startswith(('Successfully unsubscribed', 'Unsubscribed')):
+        raise CommandError(reply)
+    return reply
+
+def listed(reply):
+    count, _, topics = reply[len('Subscribed to '):].partition(' topics. ')
+    return topics.split(', ') if int(count) else []
+
+def qos_set(reply):
+    if not reply.startswith('QoS set to'):
+        raise CommandError(reply)
+
+def session_resumed(reply):
+    if reply.startswith('Session ') and reply.endswith(' started.'):
+        return None
+    head, resumed, tail = reply.rpartition(' resumed with ')
+    if not head.startswith('Session ') or not resumed:
+        raise CommandError(reply)
+    return int(tail.split(' ', 1)[0])
+
+def disconnected(reply):
+    if reply != 'DISC_ACK':
+        raise CommandError(reply)
+
+def any_reply(reply):
+    return reply
+
+class Commands:
+    """
+    The commands shared by both connections. A connection implements
+    command_frames(frames, check), which sends a command given as a list
+    of frames (or pieces of one) and returns a future that check(reply)
+    resolves.
+    """
+
+    """
+    command(text, check)
+
+    Sends a command and returns a future that is resolved with
+    check(reply) once the server replies.
+    """
+    def command(self, text, check = any_reply):
+        return self.command_frames([encode_frame(COMMAND, text.encode('utf-8'))], check)
+
+    """
+    opcode_command(check, opcode, *arguments)
+
+    Sends a command as an OPCODE frame, which the server does not have to
+    parse, see commands.py. Returns a future like command().
+    """
+    def opcode_command(self, check, opcode, *arguments):
+        return self.command_frames([encode_command(opcode, *arguments)], check)
+
+    """
+    publish(topic, message, retain)
+
+    Publishes a message to a topic, and retains it if retain is True. The
+    future resolves to None once the server has published the message.
+    """
+    def publish(self, topic, message, retain = False):
+        return self.opcode_command(published, PUBR if retain else PUB, topic, str(message))
+
+    """
+    publish_binary(topic, payload)
+
+    Publishes a bytes-like payload to a topic as a binary message, which
+    the server passes on without decoding it. The payload is sent as it
+    is, after the header of the frame, so it should not be changed until
+    the future resolves.
+    """
+    def publish_binary(self, topic, payload):
+        return self.command_frames([binary_header(PUBLISH, topic, len(payload)), payload], published)
+
+    """
+    subscribe(topic, callback)
+
+    Subscribes to a topic, or to the topics matching a wildcard. Messages
+    from those topics are passed to callback(topic, message), if given.
+    The future resolves to the server's reply, which holds the retained
+    messages of the topics.
+    """
+    def subscribe(self, topic, callback = None):
+        if callback is not None:
+            self.callbacks[topic] = callback
+        return self.opcode_command(subscribed, SUB, topic)
+
+    """
+    subscribe_from(topic, offset, callback)
+
+    Subscribes to a topic like subscribe(), and also gets the messages
+    published to it from offset on that the server still keeps (see
+    --history). The future resolves to (first, next_offset): the offset
+    of the first message that is sent again, and of the first message
+    published after the subscription. Wildcards are not supported. Every
+    message of the topic carries its offset, and offsets[topic] is where
+    a later subscribe_from() picks up after the last of them received.
+    """
+    def subscribe_from(self, topic, offset, callback = None):
+        if callback is not None:
+            self.callbacks[topic] = callback
+        return self.opcode_command(subscribed_from, SUBFROM, topic, str(offset))
+
+    """
+    unsubscribe(topic)
+
+    Unsubscribes from a topic, or from the topics matching a wildcard, and
+    forgets the callback of the topic.
+    """
+    def unsubscribe(self, topic):
+        self.callbacks.pop(topic, None)
+        return self.opcode_command(unsubscribed, UNSUB, topic)
+
+    """
+    list_topics()
+
+    The future resolves to the list of topics the client is subscribed to.
+    """
+    def list_topics(self):
+        return self.opcode_command(listed, LIST)
+
+    """
+    set_qos(qos)
+
+    Sets the quality of service of the messages from the server, 0 (at
+    most once, the default) or 1 (at least once).
+    """
+    def set_qos(self, qos):
+        return self.opcode_command(qos_set, QOS, str(qos))
+
+    """
+    resume(client_id)
+
+    Makes the session persistent under client_id, or resumes the session
+    the client had on an earlier connection, with its subscriptions, QoS
+    and the messages published while it was away. The future gets the
+    number of those messages, or None for a new session.
+    """
+    def resume(self, client_id):
+        return self.opcode_command(session_resumed, SESSION, client_id)
+
+    """
+    stats()
+
+    The future resolves to the server's metrics report, see /STATS.
+    """
+    def stats(self):
+        return self.opcode_command(any_reply, STATS)
+
+    """
+    dispatch(kind, payload)
+
+    Passes a MESSAGE or DATA frame from the server on to its callbacks.
+    A message that cannot be decoded is logged and dropped, and so is the
+    exception of a callback, so neither stops the connection.
+    """
+    def dispatch(self, kind, payload):
+        try:
+            topic, message, offset = (*decode_binary(payload), None) if kind == DATA else parse_message(payload)
+        except ValueError:
+            LOG.warning('Dropped a message that could not be decoded')
+            return
+        if offset is not None:
+            self.offsets[topic] = offset + 1
+        for topic_filter, callback in list(self.callbacks.items()):
+            if topic_matches(topic_filter, topic):
+                run_callback(callback, topic, message)
+        if self.on_message is not None:
+            run_callback(self.on_message, topic, message)
+        if self.messages_queue is not None:
+            self.messages_queue.put_nowait((topic, message))
+
+    """
+    handle_frames()
+
+    Handles every frame the parser holds: replies resolve the futures of
+    the commands and messages go to their callbacks. Returns the ACK frame
+    for the QoS 1 messages among them, or None.
+    """
+    def handle_frames(self):
+        acknowledge = False
+        for kind, payload in self.parser:
+            if kind == MESSAGE or kind == DATA:
+                self.dispatch(kind, payload)
+            elif kind == QOS_MESSAGE:
+                (packet_id,) = PACKET_ID.unpack_from(payload)
+                if packet_id > self.packet_id: # Otherwise it was resent
+                    self.packet_id = packet_id
+                    self.dispatch(MESSAGE, memoryview(payload)[PACKET_ID.size:])
+                acknowledge = True
+            else:
+                waiting = self.next_waiting()
+                if waiting is not None:
+                    resolve(*waiting, payload.decode('utf-8', 'replace'))
+        return encode_frame(ACK, PACKET_ID.pack(self.packet_id)) if acknowledge else None
+
+"""
+run_callback(callback, topic, message)
+
+Calls a message callback, logging the exception it raises instead of
+letting it end the reader.
+"""
+def run_callback(callback, topic, message):
+    try:
+        callback(topic, message)
+    except Exception:
+        LOG.exception('Message callback for %s failed', topic)
+
+"""
+resolve(future, check, reply)
+
+Resolves the future of a command with the server's reply, unless the
+future was cancelled.
+"""
+def resolve(future, check, reply):
+    if future.done():
+        return
+    try:
+        result = check(reply)
+    except (CommandError, ValueError) as error:
+        future.set_exception(error if isinstance(error, CommandError) else CommandError(reply))
+    else:
+        future.set_result(result)
+
+class Connection(Commands):
+    """
+    Constructor for a connection that uses threads. The constructor
+    connects and completes the handshake. A reader thread resolves the
+    futures and runs the message callbacks, so callbacks should return
+    quickly. A writer thread sends every command queued since its last
+    write with a single write.
+    """
+    def __init__(self, host = 'localhost', port = 8092, on_message = None, timeout = 10):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.parser = FrameParser(max_frame_size=MAX_BINARY_SIZE)
+        self.lock = threading.Lock()
+        self.writable = threading.Condition(self.lock)
+        self.outgoing = []                  # Frames of the commands waiting for the writer
+        self.waiting = collections.deque()  # (future, check) of every command without a reply
+        self.callbacks = {}                 # topic or wildcard -> callback(topic, message)
+        self.offsets = {}                   # topic -> offset after the last message received, see subscribe_from()
+        self.on_message = on_message
+        self.messages_queue = None
+        self.packet_id = 0 # Highest packet id of the QoS 1 messages received
+        self.closed = False
+
+        kind, payload = self.read_frame()
+        if payload != b'CONN_ACK':
+            self.sock.close()
+            raise ConnectionError('The server did not accept the connection')
+        self.sock.sendall(encode_frame(COMMAND, b'CONN_ACK accepted by client'))
+        self.sock.settimeout(None)
+
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.reader.start()
+        self.writer.start()
+
+    """
+    command_frames(frames, check)
+
+    Queues the frames of a command and returns a concurrent.futures.Future
+    that is resolved with check(reply) once the server replies.
+    """
+    def command_frames(self, frames, check = any_reply):
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                future.set_exception(ConnectionError('Connection is closed'))
+                return future
+            self.waiting.append((future, check))
+            self.outgoing.extend(frames)
+            if len(self.outgoing) == len(frames):
+                self.writable.notify()
+        return future
+
+    """
+    messages()
+
+    Returns an iterator over the (topic, message) tuples received from now
+    on, which ends once the connection is closed.
+    """
+    def messages(self):
+        if self.messages_queue is None:
+            self.messages_queue = queue.Queue()
+        return iter(self.messages_queue.get, None)
+
+    """
+    close()
+
+    Disconnects with /DISC, after the replies to every earlier command.
+    """
+    def close(self, timeout = 10):
+        future = self.opcode_command(disconnected, DISC)
+        try:
+            future.result(timeout)
+            with self.lock:
+                self.outgoing.append(encode_frame(COMMAND, b'DISC_ACK accepted by client'))
+                self.closed = True
+                self.writable.notify()
+            self.writer.join(timeout)
+            self.reader.join(timeout)
+        except (ConnectionError, CommandError, concurrent.futures.TimeoutError):
+            pass
+        finally:
+            self.fail(ConnectionError('Connection is closed'))
+            self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    """
+    read_frame()
+
+    Returns the next frame from the server, reading as needed.
+    """
+    def read_frame(self):
+        frame = self.parser.next_frame()
+        while frame is None:
+            if self.parser.recv_into(self.sock) == 0:
+                raise ConnectionError('Connection closed by server')
+            frame = self.parser.next_frame()
+        return frame
+
+    """
+    read()
+
+    The reader thread, resolves the futures of the commands in the order
+    they were sent and passes messages on to their callbacks.
+    """
+    def read(self):
+        try:
+            while self.parser.recv_into(self.sock):
+                ack = self.handle_frames()
+                if ack is not None:
+                    with self.lock:
+                        self.outgoing.append(ack)
+                        if len(self.outgoing) == 1:
+                            self.writable.notify()
+        except (OSError, FrameError):
+            pass
+        finally:
+            # Whatever ended the reader, no reply will come for the commands still waiting
+            self.fail(ConnectionError('Connection closed by server'))
+
+    """
+    next_waiting()
+
+    Removes and returns the (future, check) of the oldest command without
+    a reply, or None.
+    """
+    def next_waiting(self):
+        with self.lock:
+            return self.waiting.popleft() if self.waiting else None
+
+    """
+    write()
+
+    The writer thread, sends the queued commands in batches.
+    """
+    def write(self):
+        while True:
+            with self.writable:
+                while not self.outgoing and not self.closed:
+                    self.writable.wait()
+                if not self.outgoing:
+                    break
+                frames, self.outgoing = self.outgoing, []
+            try:
+                send_frames(self.sock, frames)
+            except OSError:
+                self.fail(ConnectionError('Connection closed by server'))
+                break
+
+    """
+    fail(error)
+
+    Closes the connection and fails every command still waiting.
+    """
+    def fail(self, error):
+        with self.lock:
+            self.closed = True
+            waiting, self.waiting = self.waiting, collections.deque()
+            self.outgoing.clear()
+            self.writable.notify()
+        for future, check in waiting:
+            if not future.done():
+                future.set_exception(error)
+        if self.messages_queue is not None:
+            self.messages_queue.put(None)
+
+class AsyncConnection(Commands):
+    """
+    A connection that runs on an asyncio event loop, opened with
+    await AsyncConnection.connect(host, port). The commands return
+    asyncio futures, and the commands queued during one pass of the event
+    loop are written together.
+    """
+    def __init__(self, reader, writer, on_message = None):
+        self.reader = reader
+        self.writer = writer
+        self.parser = FrameParser(max_frame_size=MAX_BINARY_SIZE)
+        self.outgoing = []
+        self.waiting = collections.deque()
+        self.callbacks = {}
+        self.offsets = {}
+        self.on_message = on_message
+        self.messages_queue = None
+        self.packet_id = 0 # Highest packet id of the QoS 1 messages received
+        self.closed = False
+        self.loop = asyncio.get_running_loop()
+        self.task = None
+
+    """
+    connect(host, port, on_message)
+
+    Coroutine that opens a connection and completes the handshake.
+    """
+    @classmethod
+    async def connect(cls, host = 'localhost', port = 8092, on_message = None):
+        reader, writer = await asyncio.open_connection(host, port)
+        connection = cls(reader, writer, on_message)
+        kind, payload = await connection.read_frame()
+        if payload != b'CONN_ACK':
+            writer.close()
+            raise ConnectionError('The server did not accept the connection')
+        writer.write(encode_frame(COMMAND, b'CONN_ACK accepted by client'))
+        connection.task = connection.loop.create_task(connection.read())
+        return connection
+
+    """
+    command_frames(frames, check)
+
+    Queues the frames of a command and returns an asyncio future that is
+    resolved with check(reply) once the server replies.
+    """
+    def command_frames(self, frames, check = any_reply):
+        future = self.loop.create_future()
+        if self.closed:
+            future.set_exception(ConnectionError('Connection is closed'))
+            return future
+        self.waiting.append((future, check))
+        self.outgoing.extend(frames)
+        if len(self.outgoing) == len(frames):
+            self.loop.call_soon(self.flush)
+        return future
+
+    """
+    flush()
+
+    Writes every queued command at once.
+    """
+    def flush(self):
+        frames, self.outgoing = self.outgoing, []
+        if frames and not self.writer.is_closing():
+            self.writer.writelines(frames)
+
+    """
+    drain()
+
+    Coroutine that waits until the connection has room for more commands,
+    for a publisher that should not queue without bounds.
+    """
+    async def drain(self):
+        self.flush()
+        await self.writer.drain()
+
+    """
+    messages()
+
+    Returns an async iterator over the (topic, message) tuples received
+    from now on, which ends once the connection is closed.
+    """
+    def messages(self):
+        if self.messages_queue is None:
+            self.messages_queue = asyncio.Queue()
+        return self.iterate_messages(self.messages_queue)
+
+    async def iterate_messages(self, messages):
+        while True:
+            message = await messages.get()
+            if message is None:
+                break
+            yield message
+
+    """
+    close()
+
+    Coroutine that disconnects with /DISC, after the replies to every
+    earlier command.
+    """
+    async def close(self, timeout = 10):
+        try:
+            await asyncio.wait_for(self.opcode_command(disconnected, DISC), timeout)
+            self.writer.write(encode_frame(COMMAND, b'DISC_ACK accepted by client'))
+            await self.writer.drain()
+            await asyncio.wait_for(asyncio.shield(self.task), timeout)
+        except (ConnectionError, CommandError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.fail(ConnectionError('Connection is closed'))
+            self.writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception):
+        await self.close()
+
+    async def read_frame(self):
+        frame = self.parser.next_frame()
+        while frame is None:
+            data = await self.reader.read(64 * 1024)
+            if not data:
+                raise ConnectionError('Connection closed by server')
+            self.parser.feed(data)
+            frame = self.parser.next_frame()
+        return frame
+
+    """
+    read()
+
+    The reader task, resolves the futures of the commands in the order
+    they were sent and passes messages on to their callbacks.
+    """
+    async def read(self):
+        try:
+            while True:
+                data = await self.reader.read(64 * 1024)
+                if not data:
+                    break
+                self.parser.feed(data)
+                ack = self.handle_frames()
+                if ack is not None and not self.writer.is_closing():
+                    self.writer.write(ack)
+        except (OSError, FrameError):
+            pass
+        finally:
+            # Whatever ended the reader, no reply will come for the commands still waiting
+            self.fail(ConnectionError('Connection closed by server'))
+
+    def next_waiting(self):
+        return self.waiting.popleft() if self.waiting else None
+
+    """
+    fail(error)
+
+    Closes the connection and fails every command still waiting.
+    """
+    def fail(self, error):
+        self.closed = True
+        waiting, self.waiting = self.waiting, collections.deque()
+        self.outgoing.clear()
+        for future, check in waiting:
+            if not future.done():
+                future.set_exception(error)
+        if self.messages_queue is not None:
+            self.messages_queue.put_nowait(None)
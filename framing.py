@@ -0,0 +1,329 @@
+"""
+framing.py
+
+Purpose: The framing layer shared by the MQTT server and client. TCP is
+a stream, so a single recv() may hold several commands or only part of
+one. Every command and message is therefore sent as a frame with a fixed
+header holding the kind of the frame and the length of its payload:
+
+    +--------+-----------------+------------------+
+    | kind   | payload length  | payload          |
+    | 1 byte | 4 bytes (big)   | length bytes     |
+    +--------+-----------------+------------------+
+
+FrameParser reassembles frames from the stream into a single reusable
+buffer, so one recv_into() can yield many frames.
+
+Binary messages (PUBLISH and DATA frames) are never decoded. Their
+payload starts with the topic, prefixed by its length, and the rest of
+the payload is the message as it was published:
+
+    +-----------------+--------------+-------------------------+
+    | topic length    | topic        | message                 |
+    | 2 bytes (big)   | UTF-8        | the rest of the payload |
+    +-----------------+--------------+-------------------------+
+
+A client at QoS 1 gets its messages as QOS_MESSAGE frames, a MESSAGE
+payload prefixed with a packet id (4 bytes, big). The ids of a session
+go up by one for every message, so an ACK frame holding a single packet
+id acknowledges every message up to and including it.
+"""
+
+import struct
+
+# Frame kinds
+COMMAND = 1 # Client -> server, a command such as /SUB WEATHER
+REPLY = 2   # Server -> client, the response to a command
+MESSAGE = 3 # Server -> client, a message published to a subscribed topic
+PUBLISH = 4 # Client -> server, a binary message to publish to a topic
+DATA = 5    # Server -> client, a binary message published to a subscribed topic
+QOS_MESSAGE = 6 # Server -> client, a MESSAGE with a packet id, for a client at QoS 1
+ACK = 7         # Client -> server, acknowledges the QOS_MESSAGE frames up to a packet id
+OPCODE = 8      # Client -> server, a command encoded for programs, see commands.py
+
+HEADER = struct.Struct('!BI')
+HEADER_SIZE = HEADER.size
+TOPIC_LENGTH = struct.Struct('!H')
+PACKET_ID = struct.Struct('!I')
+QOS_HEADER = struct.Struct('!BII') # The header of a QOS_MESSAGE frame followed by its packet id
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024   # Largest payload accepted by a parser
+MAX_BINARY_SIZE = 256 * 1024 * 1024 # Largest binary message, which a server streams instead of buffering
+MAX_BUFFERS = 1024                  # Most buffers sent with one sendmsg() (the usual IOV_MAX)
+
+class FrameError(ValueError):
+    """
+    Raised when the stream does not hold valid frames, e.g., a frame
+    larger than the parser is willing to buffer.
+    """
+
+"""
+encode_frame(kind, payload)
+
+Returns the bytes of a frame holding payload.
+"""
+def encode_frame(kind, payload):
+    return HEADER.pack(kind, len(payload)) + payload
+
+class PacketFrame:
+    """
+    A QOS_MESSAGE frame made from a MESSAGE frame without copying it, see
+    with_packet_id(). header holds the header of the QOS_MESSAGE frame and
+    the packet id, and message is the MESSAGE frame, whose payload is
+    sent right after the header. The MESSAGE frame of a publish is shared
+    by all of its subscribers, so every subscriber at QoS 1 only adds a
+    header of its own.
+    """
+    __slots__ = ('header', 'message')
+
+    def __init__(self, header, message):
+        self.header = header
+        self.message = message
+
+    """
+    buffers()
+
+    Returns the buffers to send for the frame, one after the other.
+    """
+    def buffers(self):
+        return self.header, memoryview(self.message)[HEADER_SIZE:]
+
+    def __len__(self):
+        return len(self.header) + len(self.message) - HEADER_SIZE
+
+"""
+with_packet_id(frame, packet_id)
+
+Returns the QOS_MESSAGE frame for an encoded MESSAGE frame, as a
+PacketFrame.
+"""
+def with_packet_id(frame, packet_id):
+    return PacketFrame(QOS_HEADER.pack(QOS_MESSAGE, len(frame) - HEADER_SIZE + PACKET_ID.size, packet_id), frame)
+
+"""
+without_packet_id(frame)
+
+Returns the MESSAGE frame of a PacketFrame, see with_packet_id().
+"""
+def without_packet_id(frame):
+    return frame.message
+
+"""
+split_frames(buffer)
+
+Returns a memoryview of each frame in a buffer holding whole encoded
+frames one after the other, without copying any of them.
+"""
+def split_frames(buffer):
+    view = memoryview(buffer)
+    frames = []
+    position = 0
+    while position < len(view):
+        kind, length = HEADER.unpack_from(view, position)
+        end = position + HEADER_SIZE + length
+        frames.append(view[position:end])
+        position = end
+    return frames
+
+"""
+binary_header(kind, topic, length)
+
+Returns the start of a binary frame, its header and topic, for a message
+of length bytes. The message itself is sent right after it, so it never
+has to be copied into the frame.
+"""
+def binary_header(kind, topic, length):
+    topic_bytes = topic.encode('utf-8')
+    return HEADER.pack(kind, TOPIC_LENGTH.size + len(topic_bytes) + length) + \
+        TOPIC_LENGTH.pack(len(topic_bytes)) + topic_bytes
+
+"""
+decode_binary(payload)
+
+Returns the (topic, message) tuple of the payload of a binary frame. The
+message is a memoryview of the payload, not a copy.
+"""
+def decode_binary(payload):
+    if len(payload) < TOPIC_LENGTH.size:
+        raise FrameError('Binary frame is shorter than its topic length')
+    (length,) = TOPIC_LENGTH.unpack_from(payload)
+    end = TOPIC_LENGTH.size + length
+    if end > len(payload):
+        raise FrameError('Binary frame is shorter than its topic')
+    return bytes(payload[TOPIC_LENGTH.size:end]).decode('utf-8'), memoryview(payload)[end:]
+
+"""
+send_frames(sock, frames)
+
+Sends a list of frames, or of pieces of frames, with as few system calls
+as possible. On platforms without sendmsg() the frames are joined and
+sent at once.
+"""
+def send_frames(sock, frames):
+    if len(frames) == 1:
+        sock.sendall(frames[0])
+    elif not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(frames))
+    else:
+        buffers = [memoryview(frame) for frame in frames]
+        while buffers:
+            sent = sock.sendmsg(buffers[:MAX_BUFFERS])
+            # Skip what was sent, a partial write leaves part of a frame
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if buffers and sent:
+                buffers[0] = buffers[0][sent:]
+
+class FrameParser:
+    """
+    Constructor for the incremental frame parser. The parser owns one
+    bytearray that data is received into. Complete frames are read from
+    the front of the buffer, and the unread remainder is moved back to the
+    front only when more room is needed. The buffer grows for frames
+    larger than itself, up to max_frame_size, and goes back to its
+    initial size once it has been emptied.
+    """
+    def __init__(self, size = 4096, max_frame_size = MAX_FRAME_SIZE):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # Start of the unread data
+        self.end = 0   # End of the received data
+        self.max_frame_size = max_frame_size
+
+    """
+    recv_into(sock)
+
+    Receives as much data as fits in the buffer from a socket. Returns the
+    number of bytes received, 0 means the connection was closed.
+    """
+    def recv_into(self, sock):
+        self._reserve(1)
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    """
+    feed(data)
+
+    Appends data that was received some other way, e.g., from an asyncio
+    StreamReader.
+    """
+    def feed(self, data):
+        self._reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    """
+    next_frame()
+
+    Returns the next complete frame as a (kind, payload) tuple, or None if
+    the buffer does not hold a complete frame yet.
+    """
+    def next_frame(self):
+        available = self.end - self.start
+        if available < HEADER_SIZE:
+            return None
+        kind, length = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_frame_size:
+            raise FrameError(f'Frame of {length} bytes is larger than {self.max_frame_size} bytes')
+        if available < HEADER_SIZE + length:
+            # Make sure the rest of the frame will fit in the buffer
+            self._reserve(HEADER_SIZE + length - available)
+            return None
+        payload_start = self.start + HEADER_SIZE
+        payload = bytes(self.view[payload_start:payload_start + length])
+        self.start = payload_start + length
+        self._consumed()
+        return kind, payload
+
+    """
+    next_header()
+
+    Returns the (kind, length) of the next frame once its header has been
+    received, without removing anything, or None. This lets the caller
+    read a large frame in pieces with peek() and take() instead.
+    """
+    def next_header(self):
+        if self.end - self.start < HEADER_SIZE:
+            return None
+        return HEADER.unpack_from(self.buffer, self.start)
+
+    """
+    peek(size)
+
+    Returns a copy of the first size bytes of the received data without
+    removing them, or None if fewer have been received so far, in which
+    case room is made for the rest.
+    """
+    def peek(self, size):
+        available = self.end - self.start
+        if available < size:
+            self._reserve(size - available)
+            return None
+        return bytes(self.view[self.start:self.start + size])
+
+    """
+    take(size)
+
+    Removes up to size bytes from the front of the received data and
+    returns them.
+    """
+    def take(self, size):
+        size = min(size, self.end - self.start)
+        data = bytes(self.view[self.start:self.start + size])
+        self.start += size
+        self._consumed()
+        return data
+
+    """
+    pending()
+
+    Returns the number of received bytes that are not part of a returned
+    frame yet.
+    """
+    def pending(self):
+        return self.end - self.start
+
+    """
+    _consumed()
+
+    Starts over at the front of the buffer once everything received has
+    been read, and goes back to the initial size.
+    """
+    def _consumed(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size:
+                self.view.release()
+                self.buffer = bytearray(self.size)
+                self.view = memoryview(self.buffer)
+
+    """
+    _reserve(size)
+
+    Makes sure there are at least size free bytes at the end of the buffer,
+    first by moving the unread data to the front and then by growing the
+    buffer.
+    """
+    def _reserve(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+        unread = self.end - self.start
+        if self.start > 0:
+            self.view[:unread] = self.view[self.start:self.end]
+            self.start, self.end = 0, unread
+        if len(self.buffer) - self.end < size:
+            new_size = len(self.buffer)
+            while new_size - self.end < size:
+                new_size *= 2
+            self.view.release()
+            self.buffer.extend(bytes(new_size - len(self.buffer)))
+            self.view = memoryview(self.buffer)
+
+    def __iter__(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
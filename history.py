@@ -0,0 +1,156 @@
+"""
+history.py
+
+Purpose: Keeps the last messages published to every topic, so a client
+that fell behind or restarted can catch up with /SUBFROM instead of
+only getting what is published after it subscribes. Every topic has a
+ring of a fixed number of slots holding its newest messages as encoded
+frames, optionally also capped in bytes, and every message gets an
+offset, one more than the message before it on the same topic. A client
+asks for the messages from an offset on, and the ones still in the ring
+are sent to it together.
+
+The offset is part of every message of a topic with a history, which
+the server sends as [TOPIC]@OFFSET: MESSAGE, so a client knows where
+to start again from the last message it got, whether that message was
+sent again or published after the client subscribed.
+"""
+
+import threading
+
+from framing import MESSAGE, encode_frame
+
+class TopicHistory:
+    """
+    Constructor for the history of a single topic, a ring of size slots
+    that, unless max_bytes is None, holds up to max_bytes bytes of frames.
+    The lock is held while a message is added and while a client starts
+    reading the history, see MessageHistory.
+    """
+    __slots__ = ('frames', 'max_bytes', 'bytes', 'first_offset', 'next_offset', 'lock')
+
+    def __init__(self, size, max_bytes = None):
+        self.frames = [None] * size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.first_offset = 0 # Offset of the oldest message kept
+        self.next_offset = 0  # Offset of the next message, also the number of messages so far
+        self.lock = threading.Lock()
+
+    """
+    append(frame)
+
+    Adds the frame of the newest message, in place of the oldest one once
+    the ring is full, and drops the oldest ones that no longer fit in
+    max_bytes. A message larger than max_bytes is not kept at all.
+    """
+    def append(self, frame):
+        if self.next_offset - self.first_offset == len(self.frames):
+            self.drop_oldest()
+        self.frames[self.next_offset % len(self.frames)] = frame
+        self.bytes += len(frame)
+        self.next_offset += 1
+        while self.max_bytes is not None and self.bytes > self.max_bytes:
+            self.drop_oldest()
+
+    """
+    drop_oldest()
+
+    Empties the slot of the oldest message kept.
+    """
+    def drop_oldest(self):
+        slot = self.first_offset % len(self.frames)
+        self.bytes -= len(self.frames[slot])
+        self.frames[slot] = None
+        self.first_offset += 1
+
+    """
+    since(offset)
+
+    Returns the offset of the first message from offset on that is still
+    kept, and the list of the frames from it up to the newest message.
+    """
+    def since(self, offset):
+        first = min(max(offset, self.first_offset), self.next_offset)
+        size = len(self.frames)
+        start, end = first % size, first % size + self.next_offset - first
+        if end <= size:
+            return first, self.frames[start:end]
+        return first, self.frames[start:] + self.frames[:end - size]
+
+    def __len__(self):
+        return self.next_offset - self.first_offset
+
+class MessageHistory:
+    """
+    Constructor for the histories of all topics, each keeping the last
+    size messages, or none for a size of 0, and no more than max_bytes
+    bytes of them unless it is None. A topic gets its history with its
+    first message.
+
+    A message is added to the history and its subscribers are looked up
+    under the lock of the topic, and a client subscribes and is sent the
+    history under the same lock, so a message published at that moment
+    reaches it exactly once: either with the history or as a subscriber.
+    """
+    def __init__(self, size = 0, max_bytes = None):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.topics = {} # topic -> TopicHistory
+
+    """
+    history(topic)
+
+    Returns the TopicHistory of a topic, which is created if it has none.
+    """
+    def history(self, topic):
+        history = self.topics.get(topic)
+        if history is None:
+            # Two threads may get here at once, only one of the new histories is kept
+            history = self.topics.setdefault(topic, TopicHistory(self.size, self.max_bytes))
+        return history
+
+    """
+    record(topic, message, subscribers)
+
+    Adds a message published to topic, and returns its MESSAGE frame,
+    which holds its offset, along with subscribers(topic), the sessions
+    the message is then delivered to.
+    """
+    def record(self, topic, message, subscribers):
+        history = self.history(topic)
+        with history.lock:
+            frame = encode_frame(MESSAGE, f'[{topic}]@{history.next_offset}: {message}'.encode('utf-8'))
+            history.append(frame)
+            return frame, subscribers(topic)
+
+    """
+    replay(topic, offset, start)
+
+    Calls start(first, frames, next_offset) with the messages of a topic
+    from offset on, where first is the offset of the first one of them
+    that is still kept and next_offset the offset of the next message,
+    and returns what it returns. start() subscribes the client and sends
+    it the frames, a message published meanwhile waits until it returns.
+    """
+    def replay(self, topic, offset, start):
+        history = self.history(topic)
+        with history.lock:
+            first, frames = history.since(offset)
+            return start(first, frames, history.next_offset)
+
+    """
+    messages()
+
+    Returns the number of messages kept for all topics.
+    """
+    def messages(self):
+        return sum(len(history) for history in list(self.topics.values()))
+
+    """
+    bytes()
+
+    Returns the bytes of the frames kept for all topics.
+    """
+    def bytes(self):
+        return sum(history.bytes for history in list(self.topics.values()))
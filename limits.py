@@ -0,0 +1,170 @@
+"""
+limits.py
+
+Purpose: Keeps a single client from taking the server for itself.
+Admission caps the number of open connections, counting the clients
+that are still in the CONN_ACK handshake. RateLimits holds publishers
+to a rate of messages and of bytes per second, both per client and per
+topic, with token buckets: a bucket holds up to a second's worth of
+tokens, every publish takes tokens from it, and it fills up again at
+the rate of the limit. A publish that finds a bucket empty is refused.
+
+The buckets are refilled when they are used instead of by a timer, so
+a publish only costs a few additions and comparisons, and nothing at
+all when no limits are set.
+"""
+
+import collections
+import threading
+import time
+
+MAX_TOPIC_BUCKETS = 65536 # Buckets of topics kept, the least recently used one is dropped for a new one
+
+class TokenBucket:
+    """
+    Constructor for a token bucket that fills up with rate tokens per
+    second, up to burst tokens. It starts full.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst = None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    """
+    take(amount, now)
+
+    Takes amount tokens from the bucket and returns True, or returns
+    False and takes nothing if the bucket does not hold enough. An amount
+    larger than the bucket is taken once the bucket is full, leaving it
+    in debt, so a large message is slowed down instead of never passing.
+    """
+    def take(self, amount, now):
+        # now may be from just before the bucket was made, it never drains it
+        tokens = min(self.burst, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = max(now, self.updated)
+        if tokens < min(amount, self.burst):
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - amount
+        return True
+
+class Admission:
+    """
+    Constructor for the cap on open connections, None for no cap.
+    """
+    def __init__(self, max_connections = None):
+        self.max_connections = max_connections
+        self.open = 0
+        self.refused = 0
+        self.lock = threading.Lock() # Connections are admitted and released from every handler thread
+
+    """
+    admit()
+
+    Returns True if one more connection may be opened, and counts it.
+    Every admitted connection must be released when it is closed.
+    """
+    def admit(self):
+        with self.lock:
+            if self.max_connections is not None and self.open >= self.max_connections:
+                self.refused += 1
+                return False
+            self.open += 1
+            return True
+
+    """
+    release()
+
+    Forgets a connection that was admitted.
+    """
+    def release(self):
+        with self.lock:
+            self.open -= 1
+
+class RateLimits:
+    """
+    Constructor for the rate limits of publishers, in messages and in
+    bytes per second. A limit that is None is not enforced. The buckets
+    of a client are kept in its session, the buckets of topics here.
+
+    The buckets are not locked. In the threaded mode, two clients that
+    publish to one topic at the same moment may both get through a topic
+    bucket that only had room for one of them, which lets a little more
+    through than the limit but never blocks a publisher on another.
+    """
+    def __init__(self, client_messages = None, client_bytes = None, topic_messages = None, topic_bytes = None):
+        self.client_messages = client_messages
+        self.client_bytes = client_bytes
+        self.topic_messages = topic_messages
+        self.topic_bytes = topic_bytes
+        self.topics = collections.OrderedDict() # topic -> (messages bucket, bytes bucket), least recently used first
+        self.limited = 0 # Publishes refused
+
+    """
+    enabled()
+
+    Returns True if any limit is set.
+    """
+    def enabled(self):
+        return any(limit is not None for limit in
+                   (self.client_messages, self.client_bytes, self.topic_messages, self.topic_bytes))
+
+    """
+    admit(session, topic, size)
+
+    Returns True if a client may publish a message of size bytes to
+    topic now, and takes it from the buckets of the client and the topic.
+    A wildcard publish counts toward the buckets of the wildcard itself.
+    The topic must have been checked first, e.g., that it exists, so a
+    client cannot push the buckets of other topics out with made up ones.
+    """
+    def admit(self, session, topic, size):
+        if session.rate_limits is False:
+            return True # No limits are set, see start()
+        now = time.monotonic()
+        messages, data = session.rate_limits or self.start(session)
+        if messages is not None and not messages.take(1, now) or data is not None and not data.take(size, now):
+            self.limited += 1
+            return False
+        if self.topic_messages is None and self.topic_bytes is None:
+            return True
+        buckets = self.topics.get(topic)
+        if buckets is None:
+            buckets = self.topics[topic] = (bucket(self.topic_messages), bucket(self.topic_bytes))
+            if len(self.topics) > MAX_TOPIC_BUCKETS:
+                self.topics.popitem(last=False)
+        else:
+            try:
+                self.topics.move_to_end(topic)
+            except KeyError:
+                pass # Another thread dropped it meanwhile, its buckets are still used this once
+        messages, data = buckets
+        if messages is not None and not messages.take(1, now) or data is not None and not data.take(size, now):
+            self.limited += 1
+            return False
+        return True
+
+    """
+    start(session)
+
+    Gives a session its buckets on its first publish, and returns them.
+    A session that needs none is marked with False, so its later
+    publishes return right away.
+    """
+    def start(self, session):
+        if not self.enabled():
+            session.rate_limits = False
+            return None, None
+        session.rate_limits = (bucket(self.client_messages), bucket(self.client_bytes))
+        return session.rate_limits
+
+"""
+bucket(rate)
+
+Returns a full TokenBucket for a limit, or None for no limit.
+"""
+def bucket(rate):
+    return None if rate is None else TokenBucket(rate)
@@ -0,0 +1,79 @@
+"""
+log.py
+
+Purpose: The log of the MQTT server. Logging a line never writes to the
+terminal from the thread or event loop that logged it, the record is put
+on a bounded queue instead and written by a listener thread. When the
+queue is full the record is dropped, so a slow terminal cannot hold up
+the server. The log can be switched off with the level 'off'.
+"""
+
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOG = logging.getLogger('mqtt')
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'off': logging.CRITICAL + 10,
+}
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A queue handler that drops records when its queue is full, instead of
+    blocking or reporting an error. dropped counts the dropped records.
+    """
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+handler = None  # The DroppingQueueHandler of LOG
+listener = None # The QueueListener writing the records
+
+"""
+start_logging(level, size)
+
+Sets the level of LOG and starts the listener thread that writes its
+records to stdout. At most size records wait to be written. Called
+again in a forked worker process, which does not have the listener
+thread of its parent.
+"""
+def start_logging(level = 'info', size = 10000):
+    global handler, listener
+    records = queue.Queue(size)
+    handler = DroppingQueueHandler(records)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter('%(message)s'))
+    LOG.handlers = [handler]
+    LOG.setLevel(LEVELS[level])
+    LOG.propagate = False
+    listener = logging.handlers.QueueListener(records, stream)
+    listener.start()
+
+"""
+stop_logging()
+
+Writes the queued records and stops the listener thread.
+"""
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+"""
+dropped_records()
+
+Returns the number of records dropped because the queue was full.
+"""
+def dropped_records():
+    return handler.dropped if handler is not None else 0
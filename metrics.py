@@ -0,0 +1,441 @@
+"""
+metrics.py
+
+Purpose: Keeps the metrics of the MQTT server. METRICS is the registry
+of the server process, it counts connections, commands, published
+messages and bytes in and out, and keeps histograms of the command
+dispatch latency and of the publish fan-out. report() is what the /STATS
+command sends to a client, and prometheus() is what the metrics HTTP
+listener serves, see serve_metrics().
+"""
+
+import http.server
+import threading
+import time
+
+"""
+e.g., a histogram with a scale of 1e6 keeps latencies in seconds in
+buckets of whole microseconds: 0, 1, 2-3, 4-7, 8-15, ... microseconds.
+"""
+
+class Histogram:
+    """
+    Constructor for a histogram with power of two buckets. A value is
+    multiplied by scale and rounded down, and bucket i holds the values
+    below 2 ** i (and at least 2 ** (i - 1)), so observing a value only
+    takes an int.bit_length(). The last bucket also holds everything
+    larger.
+    """
+    def __init__(self, scale = 1, buckets = 32):
+        self.scale = scale
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0
+
+    """
+    observe(value)
+
+    Adds a value to the histogram.
+    """
+    def observe(self, value):
+        index = int(value * self.scale).bit_length()
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+
+    """
+    quantile(q)
+
+    Returns an estimate of the q quantile, e.g., 0.99 for the p99. The
+    value is interpolated within the bucket that holds the quantile.
+    """
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = 2 ** (index - 1) if index else 0
+                upper = 2 ** index - 1 if index else 0 # Values are whole numbers once scaled
+                return (lower + (upper - lower) * (rank - seen) / count) / self.scale
+            seen += count
+        return 0
+
+    """
+    bounds()
+
+    Returns (upper bound, cumulative count) tuples for the buckets up to
+    the last one in use.
+    """
+    def bounds(self):
+        last = max((index for index, count in enumerate(self.counts) if count), default=0)
+        cumulative = 0
+        result = []
+        for index in range(last + 1):
+            cumulative += self.counts[index]
+            result.append((2 ** index / self.scale, cumulative))
+        return result
+
+    """
+    merge(other)
+
+    Adds the values of another histogram with the same buckets.
+    """
+    def merge(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+
+    """
+    copy()
+
+    Returns a copy of the histogram that is safe to read while the
+    original is still being updated.
+    """
+    def copy(self):
+        histogram = Histogram(self.scale, len(self.counts))
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.total = self.total
+        return histogram
+
+class Meter:
+    """
+    Constructor for a meter, which counts events along with their rate.
+    The rate is measured over windows of at least a second, so mark()
+    only adds to the window until it is over.
+    """
+    def __init__(self, now):
+        self.count = 0
+        self.window_start = now
+        self.window_count = 0
+        self.last_rate = 0.0
+
+    """
+    mark(now, amount)
+
+    Counts amount events that happened at now.
+    """
+    def mark(self, now, amount = 1):
+        self.count += amount
+        self.window_count += amount
+        elapsed = now - self.window_start
+        if elapsed >= 1:
+            self.last_rate = self.window_count / elapsed
+            self.window_start = now
+            self.window_count = 0
+
+    """
+    rate(now)
+
+    Returns the events per second of the last window. A window that has
+    been open for more than a second counts as over.
+    """
+    def rate(self, now):
+        elapsed = now - self.window_start
+        if elapsed >= 1:
+            return self.window_count / elapsed
+        return self.last_rate
+
+# Counters of the registry: name -> help text
+COUNTERS = {
+    'connections_total': 'Clients that completed the connection handshake',
+    'messages_published_total': 'Messages published to a topic of this server',
+    'messages_delivered_total': 'Messages queued for a subscriber',
+    'bytes_in_total': 'Bytes of the frames received from clients',
+    'bytes_out_total': 'Bytes of the frames written to clients',
+    'messages_retransmitted_total': 'QoS 1 messages sent again because they were not acknowledged in time',
+}
+
+class MetricsShard:
+    """
+    Constructor for the metrics updated by a single thread, see
+    MetricsRegistry. Only that thread writes to it, so it needs no lock.
+    """
+    __slots__ = ('counters', 'commands', 'latency', 'topics', 'fanout')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.commands = {} # command -> Meter
+        self.latency = {}  # command -> Histogram of dispatch seconds
+        self.topics = {}   # topic -> Meter of messages published
+        self.fanout = Histogram()
+
+    """
+    absorb(shard)
+
+    Adds the counts of the shard of a thread that has finished, which is
+    no longer updated. Its rates are over, so only the counts are kept.
+    """
+    def absorb(self, shard):
+        for name, value in shard.counters.items():
+            self.counters[name] += value
+        for mine, theirs in ((self.commands, shard.commands), (self.topics, shard.topics)):
+            for key, meter in theirs.items():
+                mine.setdefault(key, Meter(0)).count += meter.count
+        for command, histogram in shard.latency.items():
+            self.latency.setdefault(command, Histogram(1e6)).merge(histogram)
+        self.fanout.merge(shard.fanout)
+
+class MetricsRegistry:
+    """
+    Constructor for the metrics registry. Every thread that updates the
+    registry, e.g., every client of the threaded mode, gets its own
+    MetricsShard, so counting a publish or a frame never waits for
+    another thread. The shards are added up when the metrics are read.
+    The shards of threads that have finished are folded into retired
+    whenever a shard is added or the metrics are read.
+    Gauges are not updated at all, they are functions that are called
+    when the metrics are reported, e.g., the number of connected clients.
+    """
+    def __init__(self):
+        self.lock = threading.Lock() # Held to add a shard and to read them
+        self.started = time.monotonic()
+        self.local = threading.local()
+        self.shards = []   # (thread, MetricsShard) of the threads that updated the registry
+        self.retired = MetricsShard()
+        self.gauges = {}   # name -> (help text, function returning the value)
+
+    """
+    shard()
+
+    Returns the MetricsShard of the current thread. Adding a shard also
+    retires the shards of the threads that have finished, so the list
+    only holds live threads even if the metrics are never read.
+    """
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = MetricsShard()
+            with self.lock:
+                self.retire()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    """
+    retire()
+
+    Folds the shards of the threads that have finished into retired and
+    forgets them, called with the lock held. Their shards are no longer
+    updated.
+    """
+    def retire(self):
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self.retired.absorb(shard)
+        self.shards = live
+
+    """
+    count(name, amount)
+
+    Adds amount to a counter.
+    """
+    def count(self, name, amount = 1):
+        self.shard().counters[name] += amount
+
+    """
+    gauge(name, help, function)
+
+    Registers a gauge, function() returns its current value.
+    """
+    def gauge(self, name, help, function):
+        self.gauges[name] = (help, function)
+
+    """
+    command(command, seconds)
+
+    Counts a command that took seconds to dispatch.
+    """
+    def command(self, command, seconds):
+        now = time.monotonic()
+        shard = self.shard()
+        meter = shard.commands.get(command)
+        if meter is None:
+            meter = shard.commands[command] = Meter(now)
+            shard.latency[command] = Histogram(1e6)
+        meter.mark(now)
+        shard.latency[command].observe(seconds)
+
+    """
+    publish(topic, subscribers)
+
+    Counts a message published to a topic with a number of subscribers.
+    """
+    def publish(self, topic, subscribers):
+        now = time.monotonic()
+        shard = self.shard()
+        meter = shard.topics.get(topic)
+        if meter is None:
+            meter = shard.topics[topic] = Meter(now)
+        meter.mark(now)
+        shard.fanout.observe(subscribers)
+        counters = shard.counters
+        counters['messages_published_total'] += 1
+        counters['messages_delivered_total'] += subscribers
+
+    """
+    snapshot()
+
+    Returns a copy of the metrics as a dict, adding up the shards of all
+    threads. A shard may be updated while it is read, so a count may be
+    off by the updates of that moment.
+    """
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            self.retire()
+            shards = [self.retired] + [shard for thread, shard in self.shards]
+            counters = dict.fromkeys(COUNTERS, 0)
+            commands, latency, topics = {}, {}, {}
+            fanout = Histogram()
+            for shard in shards:
+                for name, value in dict(shard.counters).items():
+                    counters[name] += value
+                for mine, theirs in ((commands, shard.commands), (topics, shard.topics)):
+                    for key, meter in dict(theirs).items():
+                        count, rate = mine.get(key, (0, 0.0))
+                        mine[key] = (count + meter.count, rate + meter.rate(now))
+                for command, histogram in dict(shard.latency).items():
+                    latency.setdefault(command, Histogram(1e6)).merge(histogram.copy())
+                fanout.merge(shard.fanout.copy())
+        snapshot = {
+            'uptime': now - self.started,
+            'counters': counters,
+            'commands': commands,
+            'latency': latency,
+            'topics': topics,
+            'fanout': fanout,
+        }
+        snapshot['gauges'] = {name: function() for name, (help, function) in self.gauges.items()}
+        return snapshot
+
+    """
+    report()
+
+    Returns the metrics as text for a client, used by /STATS.
+    """
+    def report(self):
+        snapshot = self.snapshot()
+        counters = snapshot['counters']
+        lines = [f'Uptime {snapshot["uptime"]:.0f}s, {counters["connections_total"]} connections so far']
+        for name, value in snapshot['gauges'].items():
+            lines.append(f'{name}: {value}')
+        lines.append(f'bytes in: {counters["bytes_in_total"]}, bytes out: {counters["bytes_out_total"]}')
+        lines.append('Commands:')
+        all_commands = Histogram(1e6)
+        for command, (count, rate) in sorted(snapshot['commands'].items()):
+            latency = snapshot['latency'][command]
+            all_commands.merge(latency)
+            lines.append(f'  {command}: {count} ({rate:.1f}/s) p50 {format_seconds(latency.quantile(0.5))} '
+                         f'p99 {format_seconds(latency.quantile(0.99))}')
+        lines.append(f'Dispatch latency: p50 {format_seconds(all_commands.quantile(0.5))} '
+                     f'p99 {format_seconds(all_commands.quantile(0.99))}')
+        fanout = snapshot['fanout']
+        lines.append(f'Published {counters["messages_published_total"]} messages, delivered '
+                     f'{counters["messages_delivered_total"]}, fan-out p50 {fanout.quantile(0.5):.0f} '
+                     f'p99 {fanout.quantile(0.99):.0f}')
+        lines.append('Topics:')
+        for topic, (count, rate) in sorted(snapshot['topics'].items()):
+            lines.append(f'  {topic}: {count} messages ({rate:.1f}/s)')
+        return '\n'.join(lines)
+
+    """
+    prometheus()
+
+    Returns the metrics in the Prometheus text format, every name is
+    prefixed with mqtt_.
+    """
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, help in COUNTERS.items():
+            lines += [f'# HELP mqtt_{name} {help}', f'# TYPE mqtt_{name} counter',
+                      f'mqtt_{name} {snapshot["counters"][name]}']
+        for name, (help, function) in self.gauges.items():
+            if name in snapshot['gauges']:
+                lines += [f'# HELP mqtt_{name} {help}', f'# TYPE mqtt_{name} gauge',
+                          f'mqtt_{name} {snapshot["gauges"][name]}']
+        lines += ['# HELP mqtt_commands_total Commands received from clients',
+                  '# TYPE mqtt_commands_total counter']
+        for command, (count, rate) in sorted(snapshot['commands'].items()):
+            lines.append(f'mqtt_commands_total{{command="{label(command)}"}} {count}')
+        lines += ['# HELP mqtt_dispatch_seconds Time taken to dispatch a command',
+                  '# TYPE mqtt_dispatch_seconds histogram']
+        for command, histogram in sorted(snapshot['latency'].items()):
+            lines += histogram_lines('mqtt_dispatch_seconds', histogram, f'command="{label(command)}"')
+        lines += ['# HELP mqtt_publish_fanout Subscribers a published message was queued for',
+                  '# TYPE mqtt_publish_fanout histogram']
+        lines += histogram_lines('mqtt_publish_fanout', snapshot['fanout'], '')
+        lines += ['# HELP mqtt_topic_messages_total Messages published to a topic',
+                  '# TYPE mqtt_topic_messages_total counter']
+        for topic, (count, rate) in sorted(snapshot['topics'].items()):
+            lines.append(f'mqtt_topic_messages_total{{topic="{label(topic)}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+"""
+histogram_lines(name, histogram, labels)
+
+Returns the Prometheus lines of a histogram, labels (e.g., 'command="SUB"')
+are added to every line.
+"""
+def histogram_lines(name, histogram, labels):
+    bucket_labels = labels + ',' if labels else ''
+    labels = '{' + labels + '}' if labels else ''
+    lines = [f'{name}_bucket{{{bucket_labels}le="{bound:g}"}} {count}' for bound, count in histogram.bounds()]
+    lines.append(f'{name}_bucket{{{bucket_labels}le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{labels} {histogram.total:g}')
+    lines.append(f'{name}_count{labels} {histogram.count}')
+    return lines
+
+"""
+label(value)
+
+Escapes a Prometheus label value.
+"""
+def label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+"""
+format_seconds(seconds)
+
+Returns a short text for a duration, e.g., 12us or 3.4ms.
+"""
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.0f}us'
+    if seconds < 1:
+        return f'{seconds * 1e3:.1f}ms'
+    return f'{seconds:.2f}s'
+
+METRICS = MetricsRegistry()
+
+"""
+serve_metrics(registry, host, port)
+
+Serves the metrics of a registry in the Prometheus text format over HTTP
+on its own thread, at /metrics. Returns the HTTP server.
+"""
+def serve_metrics(registry, host, port):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Scrapes are not logged
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,79 @@
+"""
+offline.py
+
+Purpose: Keeps the messages published to a persistent session while its
+client is not connected, see SubscriptionRegistry.resume(). The newest
+messages would otherwise pile up in memory for as long as the client
+stays away, so only the first ones are kept in memory and the rest are
+appended to a file on disk. Both hold the messages as encoded frames,
+so when the client comes back they are written to it as they are: the
+file is memory-mapped and sent front to back.
+"""
+
+import mmap
+import tempfile
+
+class OfflineQueue:
+    """
+    Constructor for the queue of a persistent session. The first
+    memory_size frames are kept in a list, every frame after them is
+    appended to a temporary file in spill_dir (the default temporary
+    directory for None), so that the frames keep their order. The file
+    has no name, it goes away as soon as it is closed.
+    """
+    __slots__ = ('frames', 'memory_size', 'spill_dir', 'spill', 'spilled', 'spilled_bytes')
+
+    def __init__(self, memory_size = 1000, spill_dir = None):
+        self.frames = []
+        self.memory_size = memory_size
+        self.spill_dir = spill_dir
+        self.spill = None # The temporary file, once a frame was spilled
+        self.spilled = 0  # Frames in the file
+        self.spilled_bytes = 0
+
+    def __len__(self):
+        return len(self.frames) + self.spilled
+
+    """
+    append(frame)
+
+    Adds an encoded frame to the end of the queue.
+    """
+    def append(self, frame):
+        if self.spill is None:
+            if len(self.frames) < self.memory_size:
+                self.frames.append(frame)
+                return
+            self.spill = tempfile.TemporaryFile(prefix='mqtt-offline-', dir=self.spill_dir)
+        self.spill.write(frame)
+        self.spilled += 1
+        self.spilled_bytes += len(frame)
+
+    """
+    take()
+
+    Empties the queue. Returns the list of the frames that were kept in
+    memory and a buffer holding the spilled frames one after the other,
+    a read-only memory map of the file, or None if nothing was spilled.
+    """
+    def take(self):
+        frames, self.frames = self.frames, []
+        spilled = None
+        if self.spill is not None:
+            self.spill.flush()
+            if self.spilled_bytes:
+                # The map keeps the pages of the file after the file is closed
+                spilled = memoryview(mmap.mmap(self.spill.fileno(), 0, access=mmap.ACCESS_READ))
+            self.close()
+        return frames, spilled
+
+    """
+    close()
+
+    Drops the spilled frames.
+    """
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            self.spilled = self.spilled_bytes = 0
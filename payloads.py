@@ -0,0 +1,221 @@
+"""
+payloads.py
+
+Purpose: Carries binary messages through the server without decoding or
+copying them. A binary message (see framing.PUBLISH) that fits in the
+parser of the publisher's session is received whole, and its message is
+a memoryview of the received frame. A larger one is streamed: it is
+queued for its subscribers as a PayloadStream as soon as its topic is
+known, and every piece of it is passed on to their writers as it comes
+off the socket, so it is never held in a single buffer.
+"""
+
+import asyncio
+import collections
+import threading
+
+class BinaryPublish:
+    """
+    A binary message received from a client, returned by the receive()
+    of a session instead of a command.
+
+    For a message that was received whole, payload holds it. Otherwise
+    payload is None and the message has not been received yet. The
+    server then sets stream to the PayloadStream to receive it into, and
+    the session does so before it returns the next command. A message
+    with no stream set is received and thrown away. on_complete(stream)
+    is called once the whole message has been received, if it is set.
+    """
+    __slots__ = ('topic', 'length', 'payload', 'stream', 'on_complete')
+
+    def __init__(self, topic, length, payload = None):
+        self.topic = topic
+        self.length = length # Bytes of the message
+        self.payload = payload
+        self.stream = None
+        self.on_complete = None
+
+class PayloadStream:
+    """
+    Constructor for a binary message that is delivered while it is still
+    being received. header is the start of the DATA frame, see
+    framing.binary_header(), and length bytes of message follow it.
+
+    The same stream is queued for every subscriber. The publisher's
+    session appends the pieces of the message as they arrive, and the
+    writer of each subscriber sends them on from its own position, so a
+    slow subscriber never holds up the publisher or the others. Every
+    reader is added with add_reader() before the stream is queued for
+    it, and moves on with consumed() as it sends the pieces, so a piece
+    is released as soon as every reader has sent it, and the stream
+    never holds more than the pieces between its slowest and its fastest
+    reader. Positions count pieces from the start of the message.
+    """
+    def __init__(self, header, length):
+        self.header = header
+        self.length = length
+        self.chunks = []   # Pieces of the message that a reader still needs
+        self.first = 0     # Position of chunks[0], the pieces before it were released
+        self.count = 0     # Pieces of the message received so far
+        self.received = 0  # Bytes of the message received so far
+        self.positions = collections.Counter() # Position -> readers at it
+        self.done = False
+        self.failed = False # The publisher went away before the end of the message
+        self.changed = threading.Condition()
+
+    """
+    append(chunk)
+
+    Adds the next piece of the message.
+    """
+    def append(self, chunk):
+        with self.changed:
+            self.add(chunk)
+            self.changed.notify_all()
+
+    """
+    add(chunk)
+
+    append() without the lock. A piece that no reader is left to send is
+    released right away.
+    """
+    def add(self, chunk):
+        self.count += 1
+        self.received += len(chunk)
+        if self.positions:
+            self.chunks.append(chunk)
+        else:
+            self.first = self.count
+
+    """
+    finish(failed)
+
+    Marks the message as complete, or as failed when its publisher went
+    away before sending all of it.
+    """
+    def finish(self, failed = False):
+        with self.changed:
+            self.done = True
+            self.failed = failed
+            self.changed.notify_all()
+
+    """
+    add_reader()
+
+    Adds a reader at the start of the message, before the stream is
+    queued for it. Every reader must leave() once it is done, also when
+    the stream is dropped before it was read.
+    """
+    def add_reader(self):
+        with self.changed:
+            self.positions[0] += 1
+
+    """
+    consumed(position, new_position)
+
+    Moves a reader from position to new_position once it has sent the
+    pieces between them, which are released if no reader needs them.
+    """
+    def consumed(self, position, new_position):
+        with self.changed:
+            self.move(position, new_position)
+
+    """
+    leave(position)
+
+    Removes a reader at position, e.g., once it has sent the whole
+    message, or when its session went away.
+    """
+    def leave(self, position):
+        with self.changed:
+            self.move(position, None)
+
+    """
+    move(position, new_position)
+
+    Moves a reader, or removes it for a new_position of None, and
+    releases the pieces before the position of the slowest reader left.
+    Called with the lock held, if there is one.
+    """
+    def move(self, position, new_position):
+        positions = self.positions
+        positions[position] -= 1
+        if not positions[position]:
+            del positions[position]
+        if new_position is not None:
+            positions[new_position] += 1
+        if position > self.first and positions:
+            return # The slowest reader did not move
+        first = min(positions, default=self.count)
+        if first > self.first:
+            del self.chunks[:first - self.first]
+            self.first = first
+
+    """
+    wait(position)
+
+    Waits until there are pieces after the first position ones, and
+    returns a (pieces, done) tuple. Raises ConnectionError if the message
+    will never be complete, as the frame can then not be finished.
+    """
+    def wait(self, position):
+        with self.changed:
+            while self.count <= position and not self.done:
+                self.changed.wait()
+            return self.pieces(position)
+
+    """
+    pieces(position)
+
+    Returns the (pieces, done) tuple of wait(), called once there is no
+    need to wait.
+    """
+    def pieces(self, position):
+        if self.failed:
+            raise ConnectionError('The publisher of a streamed message went away')
+        return self.chunks[position - self.first:], self.done
+
+    def __len__(self):
+        return len(self.header) + self.length
+
+class AsyncPayloadStream(PayloadStream):
+    """
+    A PayloadStream whose writers are coroutines, for the asyncio mode.
+    Every change sets the current event and replaces it with a new one,
+    so each writer wakes up once for every change it waited for.
+    """
+    def __init__(self, header, length):
+        super().__init__(header, length)
+        self.event = asyncio.Event()
+
+    def append(self, chunk):
+        self.add(chunk)
+        self.notify()
+
+    def finish(self, failed = False):
+        self.done = True
+        self.failed = failed
+        self.notify()
+
+    def add_reader(self):
+        self.positions[0] += 1
+
+    def consumed(self, position, new_position):
+        self.move(position, new_position)
+
+    def leave(self, position):
+        self.move(position, None)
+
+    def notify(self):
+        self.event.set()
+        self.event = asyncio.Event()
+
+    """
+    wait(position)
+
+    Coroutine version of PayloadStream.wait().
+    """
+    async def wait(self, position):
+        while self.count <= position and not self.done:
+            await self.event.wait()
+        return self.pieces(position)
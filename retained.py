@@ -0,0 +1,249 @@
+"""
+retained.py
+
+Purpose: Stores the retained message of every topic. The server keeps
+retained messages in its topic trie, and a retained store is what makes
+them outlive the server. MemoryRetainedStore keeps nothing across
+restarts, LogRetainedStore writes every retained message to an
+append-only log on disk that is read back when the server starts.
+"""
+
+import abc
+import os
+import struct
+import threading
+import zlib
+
+class RetainedStore(abc.ABC):
+    """
+    The interface of a retained store. load() is called once when the
+    server starts, put() every time a message is retained and close() when
+    the server stops. A store must implement load() and put().
+    """
+
+    """
+    load()
+
+    Returns a dict of topic -> retained message of every stored topic.
+    """
+    @abc.abstractmethod
+    def load(self):
+        pass
+
+    """
+    put(topic, message)
+
+    Stores the retained message of a topic.
+    """
+    @abc.abstractmethod
+    def put(self, topic, message):
+        pass
+
+    """
+    sync()
+
+    Waits until everything that was put is durable.
+    """
+    def sync(self):
+        pass
+
+    """
+    close()
+
+    Makes everything durable and releases the store.
+    """
+    def close(self):
+        pass
+
+class MemoryRetainedStore(RetainedStore):
+    """
+    A store that does not persist anything, retained messages only live
+    in the topic trie of the running server.
+    """
+    def load(self):
+        return {}
+
+    def put(self, topic, message):
+        pass
+
+# Record header: crc32 of the body, topic length, message length
+RECORD = struct.Struct('!III')
+
+class LogRetainedStore(RetainedStore):
+    """
+    Constructor for the append-only log store. Every retained message is
+    appended to the log as a record holding a checksum, the topic and the
+    message, so a restart reads the log front to back and the last record
+    of each topic wins.
+
+    put() only queues the record. A flusher thread writes everything queued
+    since its last write with a single write() and fsync() every
+    flush_interval seconds, so many /PUBR commands share one fsync (group
+    commit). Once the log holds more than compact_ratio records per topic
+    (and at least compact_min records), it is rewritten with only the
+    latest record of each topic.
+    """
+    def __init__(self, path, flush_interval = 0.01, compact_ratio = 4, compact_min = 10000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.messages = {} # topic -> latest retained message
+        self.records = 0   # Records in the log file
+        self.pending = []  # Encoded records that are not written yet
+        self.written = 0   # Number of put() calls that are durable
+        self.queued = 0    # Number of put() calls so far
+        self.closed = False
+        self.ready = threading.Condition()
+        self.file = None
+        self.flusher = None
+
+    """
+    load()
+
+    Reads the log and starts the flusher, see read() and start().
+    """
+    def load(self):
+        messages = self.read()
+        self.start()
+        return messages
+
+    """
+    read()
+
+    Reads the log and returns its retained messages. A record that was
+    only partly written, or fails its checksum, ends the log: it and
+    anything after it are cut off, since they were never acknowledged as
+    durable. Nothing is written until start() is called, e.g., a server
+    with workers reads the log before it forks them, and only the worker
+    that writes the log starts it.
+    """
+    def read(self):
+        valid = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as log:
+                data = log.read()
+            position = 0
+            while position + RECORD.size <= len(data):
+                crc, topic_length, message_length = RECORD.unpack_from(data, position)
+                body_start = position + RECORD.size
+                body_end = body_start + topic_length + message_length
+                if body_end > len(data) or zlib.crc32(data[body_start:body_end]) != crc:
+                    break
+                topic = data[body_start:body_start + topic_length].decode('utf-8')
+                self.messages[topic] = data[body_start + topic_length:body_end].decode('utf-8')
+                self.records += 1
+                position = valid = body_end
+            if valid != len(data):
+                with open(self.path, 'r+b') as log:
+                    log.truncate(valid)
+        return dict(self.messages)
+
+    """
+    start()
+
+    Opens the log for appending and starts the flusher.
+    """
+    def start(self):
+        self.file = open(self.path, 'ab')
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    """
+    put(topic, message)
+
+    Queues the retained message of a topic to be written by the flusher.
+    """
+    def put(self, topic, message):
+        topic_bytes = topic.encode('utf-8')
+        message_bytes = message.encode('utf-8')
+        body = topic_bytes + message_bytes
+        record = RECORD.pack(zlib.crc32(body), len(topic_bytes), len(message_bytes)) + body
+        with self.ready:
+            self.messages[topic] = message
+            self.pending.append(record)
+            self.queued += 1
+
+    """
+    sync()
+
+    Waits until every record put so far has been written and fsynced.
+    """
+    def sync(self):
+        with self.ready:
+            target = self.queued
+            self.ready.notify_all()
+            while self.written < target and not self.closed:
+                self.ready.wait()
+
+    """
+    flush_loop()
+
+    The flusher thread. Writes the queued records as one batch every
+    flush_interval seconds, or right away when sync() asks for it.
+    """
+    def flush_loop(self):
+        while True:
+            with self.ready:
+                if not self.pending and not self.closed:
+                    self.ready.wait(self.flush_interval)
+                batch, self.pending = self.pending, []
+                target = self.queued
+                closed = self.closed
+            if batch:
+                self.file.write(b''.join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.records += len(batch)
+                if self.records >= self.compact_min and self.records > self.compact_ratio * len(self.messages):
+                    self.compact()
+            with self.ready:
+                self.written = target
+                self.ready.notify_all()
+            if closed:
+                break
+
+    """
+    compact()
+
+    Rewrites the log with only the latest record of every topic. The new
+    log is written next to the old one and renamed over it, so a crash
+    during compaction leaves one complete log behind.
+    """
+    def compact(self):
+        with self.ready:
+            messages = dict(self.messages)
+            # Records queued after the snapshot are written to the new log
+        temporary = self.path + '.compact'
+        with open(temporary, 'wb') as log:
+            for topic, message in messages.items():
+                topic_bytes = topic.encode('utf-8')
+                message_bytes = message.encode('utf-8')
+                body = topic_bytes + message_bytes
+                log.write(RECORD.pack(zlib.crc32(body), len(topic_bytes), len(message_bytes)) + body)
+            log.flush()
+            os.fsync(log.fileno())
+        os.replace(temporary, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.file.close()
+        self.file = open(self.path, 'ab')
+        self.records = len(messages)
+
+    """
+    close()
+
+    Writes what is still queued and closes the log.
+    """
+    def close(self):
+        if self.flusher is None:
+            return
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+        self.flusher.join()
+        self.file.close()
+        self.flusher = None
@@ -4,223 +4,729 @@ Author: Anthony Narlock
 
 Purpose: Serves as an MQTT server-side application. A multi-threaded
 server for handling clients that can publish and subscribe to messages.
+The server can also run on a single asyncio event loop instead of a
+thread per client, see main().
 """
 
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
 import threading
 import socket
-import re
+import time
+
+from history import MessageHistory
+from limits import Admission, RateLimits
+from log import LEVELS, LOG, dropped_records, start_logging, stop_logging
+from metrics import METRICS, serve_metrics
+from retained import LogRetainedStore, MemoryRetainedStore
+from topics import TopicTrie
+from bridge import BridgeBatch, Bridges
+from cluster import Cluster, listening_socket, socket_pairs
+from commands import BRIDGE, DISC, LIST, MULTI_LEVEL, NAMES, PUB, PUBR, QOS, SESSION, SINGLE_LEVEL, STATS, SUB, SUBFROM, \
+    TOPIC, UNSUB, WILDCARDS, parse_command, topic_kind
+from framing import DATA, MESSAGE, REPLY, FrameError, binary_header, encode_frame
+from payloads import BinaryPublish
+from subscriptions import OVERFLOW_POLICIES, Session, StreamSession, SubscriptionRegistry
 
 # Server setup
 host = 'localhost'
 port = 8092
+queue_size = 1000 # Published messages queued for a client before overflow applies
+overflow = 'drop-oldest' # What to do when a client's queue is full, see OVERFLOW_POLICIES
+flush_delay = 0 # Seconds a client's writer waits for more messages before a write
+log_level = 'info' # See log.LEVELS, 'off' switches the log off
+metrics_port = None # Port of the Prometheus metrics listener, None for no listener
+inflight_window = 1000 # Unacknowledged messages a client at QoS 1 may have
+retransmit_timeout = 2.0 # Seconds before an unacknowledged QoS 1 message is sent again
+handshake_timeout = 10.0 # Seconds a new client has to acknowledge CONN_ACK
+bridge_filters = ['#'] # Topic filters forwarded over the bridges this server opens, see bridge.py
+
+# Offsets and broker ids given by clients are plain decimal numbers, str.isdigit() would also accept e.g. '²', which int() refuses
+DECIMAL = re.compile(r'[0-9]+')
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP
-server.bind( (host, port) ) # Binding to port and localhost
-server.listen()
+# Topics available to use, each topic holds its own retained message
+TOPICS = TopicTrie(['WEATHER', 'NEWS', 'HEALTH', 'SECURITY', 'WEATHER/MINNESOTA', 'WEATHER/WISCONSIN/NINE','WEATHER/MINNESOTA/NINE'])
+SUBSCRIPTIONS = SubscriptionRegistry(TOPICS) # Connected clients and their subscriptions
+RETAINED = MemoryRetainedStore() # Where retained messages are persisted, see load_retained()
+ADMISSION = Admission() # The cap on open connections, see limits.py
+LIMITS = RateLimits()   # The rate limits of publishers, see limits.py
+HISTORY = MessageHistory() # The last messages of every topic, for /SUBFROM, see history.py
 
-TOPICS = ['WEATHER', 'NEWS', 'HEALTH', 'SECURITY', 'WEATHER/MINNESOTA', 'WEATHER/WISCONSIN/NINE','WEATHER/MINNESOTA/NINE'] # Topics available to use
-RETAINED_TOPIC_MESSAGE = ["","","","","","",""]
-clients = [] #List of (client, address) tuples
-client_subscriptions = [] # List of topic lists corresponding to each client index.
+# Functions called with (topic, message) for every message published or retained
+# by a client of this server, and with (topic) for every topic created by one.
+# e.g., the workers of the server use these to pass messages on to each other.
+PUBLISH_HOOKS = []
+RETAIN_HOOKS = []
+TOPIC_HOOKS = []
+BINARY_HOOKS = [] # Called with (topic, list of pieces) once a binary message has been received
+
+BRIDGES = None # The bridges to other brokers, only in the asyncio mode without workers, see bridge.py
+
+# Gauges of the metrics, read when the metrics are reported
+METRICS.gauge('connections', 'Connected clients', lambda: len(SUBSCRIPTIONS.sessions))
+METRICS.gauge('topics', 'Topics of the server', lambda: len(TOPICS))
+METRICS.gauge('queued_frames', 'Frames waiting to be written to clients',
+              lambda: sum(depth for address, depth, dropped in SUBSCRIPTIONS.queue_stats()))
+METRICS.gauge('max_queue_depth', 'Frames waiting to be written to the most behind client',
+              lambda: max((depth for address, depth, dropped in SUBSCRIPTIONS.queue_stats()), default=0))
+METRICS.gauge('dropped_messages', 'Messages dropped by the queues of connected clients',
+              lambda: sum(dropped for address, depth, dropped in SUBSCRIPTIONS.queue_stats()))
+METRICS.gauge('offline_sessions', 'Persistent sessions whose clients are not connected',
+              lambda: len(SUBSCRIPTIONS.offline))
+METRICS.gauge('offline_messages', 'Messages queued for the clients of offline sessions',
+              lambda: SUBSCRIPTIONS.offline_messages())
+METRICS.gauge('inflight_messages', 'QoS 1 messages waiting to be acknowledged', lambda: SUBSCRIPTIONS.inflight())
+METRICS.gauge('history_messages', 'Messages kept in the histories of topics', lambda: HISTORY.messages())
+METRICS.gauge('history_bytes', 'Bytes of the messages kept in the histories of topics', lambda: HISTORY.bytes())
+METRICS.gauge('match_cache_hits', 'Wildcard lookups answered by the topic match cache', lambda: TOPICS.hits)
+METRICS.gauge('match_cache_misses', 'Wildcard lookups that walked the topic trie', lambda: TOPICS.misses)
+METRICS.gauge('connections_refused', 'Connections refused because the server was full', lambda: ADMISSION.refused)
+METRICS.gauge('rate_limited_messages', 'Publishes refused by the rate limits', lambda: LIMITS.limited)
+METRICS.gauge('bridged_messages_in', 'Messages received from other brokers over bridges',
+              lambda: BRIDGES.received if BRIDGES is not None else 0)
+METRICS.gauge('bridged_messages_out', 'Messages forwarded to other brokers over bridges',
+              lambda: BRIDGES.forwarded if BRIDGES is not None else 0)
+METRICS.gauge('bridged_duplicates', 'Messages that arrived again over a bridge and were dropped',
+              lambda: BRIDGES.duplicates if BRIDGES is not None else 0)
+METRICS.gauge('dropped_log_records', 'Log records dropped because the log could not keep up', dropped_records)
 
 """
-e.g., if there is a client at index 0, and they subscribe to WEATHER,
-then client_subscriptions[0] = ['WEATHER']. If they are subscribed to both WEATHER and NEWS,
-it will be ['WEATHER', 'NEWS']. Order will not matter, the only thing that should matter
-is if the index of the client contains a topic within their own list of subscriptions,
-then we will publish a message to them...
+e.g., if a client subscribes to WEATHER, then the client's session is added to the
+set of subscribers of WEATHER, and WEATHER is added to the session's own subscriptions.
+Publishing a message to WEATHER only has to go through the subscribers of WEATHER,
+and a client disconnecting only has to go through the topics it is subscribed to.
 """
 
 """
 handle(client)
 
 This is the method that handles the client messages
-that are sent to the server.
+that are sent to the server. The client is the Session
+of the connected client, which first has to complete the
+handshake.
 """
 def handle(client):
+    if not handshake(client):
+        ADMISSION.release()
+        return
     while True:
         try:
             #Receive message command from client
-            message = client.recv(1024).decode('utf-8')
+            message = client.receive()
             # print(message) # For debugging
 
-            # Message command conditional statements
-            if '/DISC' in message:
-                """
-                /DISC is the DISCONNECT command.
-                When this command is received from the client, the client
-                wants to disconnect. The server will acknoledge disconnect
-                message and close the socket with the client.
-                """
-                client.send('DISC_ACK'.encode('utf-8'))
-                disconnect_accepted = client.recv(1024).decode('utf-8')
-                print(disconnect_accepted)
-                index = clients.index( (client) )
-                del clients[index]
-                del client_subscriptions[index]
+            if not dispatch(client, message):
+                disconnect_accepted = client.receive()
+                LOG.info(disconnect_accepted)
+                SUBSCRIPTIONS.disconnect(client)
                 client.close()
                 break # Required or an exception will be thrown.
-            elif (message[:4] == '/SUB'):
-                """
-                /SUB <TOPIC>
-                When this command is received from the client, the client
-                wants to subscribe to a topic. The server will add
-                the client to the topic they wish to connect. The client
-                must enter a valid topic. A client is also not able to
-                subscribe to a topic they are already subscribed to.
-
-                If the retained message for the topic is not the empty string,
-                then there is no retained message. Thus, no message will be
-                sent to the client. If there is a retained message, it will
-                be sent to the client.
-                """
-                subscription_split = message.split(" ")
-                if(len(subscription_split) != 2):
-                    client.send(f'Invalid syntax: /SUB <TOPIC>'.encode('utf-8'))
-                else:
-                    if '/#' == subscription_split[1][-2:]:
-                        subscribe_multilevel(subscription_split[1], client)
-                    elif '+' in subscription_split[1] and subscription_split[1].count('+') == 1:
-                        subscribe_singlelevel(subscription_split[1], client)
-                    elif subscription_split[1] in TOPICS:
-                        if subscription_split[1] in client_subscriptions[clients.index( (client) )]:
-                            client.send(f'You are already subscribed to this topic!'.encode('utf-8'))
-                        else:
-                            client_subscriptions[clients.index( (client) )].append(subscription_split[1])
-                            print(client_subscriptions[clients.index( (client) )])
-                            client.send(f'Subscribed to [{subscription_split[1]}] {RETAINED_TOPIC_MESSAGE[TOPICS.index(subscription_split[1])]}'.encode('utf-8'))
-                    else:
-                        if '+' not in subscription_split[1] and '#' not in subscription_split[1]:
-                            TOPICS.append(subscription_split[1])
-                            RETAINED_TOPIC_MESSAGE.append("")
-                            client_subscriptions[clients.index( (client) )].append(subscription_split[1])
-                            print(TOPICS)
-                            client.send(f'Subscribed to [{subscription_split[1]}] {RETAINED_TOPIC_MESSAGE[TOPICS.index(subscription_split[1])]}'.encode('utf-8'))
-                        else:
-                            client.send(f'Cannot create topic with +, # symbol.'.encode('utf-8'))
-
-            elif (message[:4] == '/PUB' and message[:5] != '/PUBR'):
-                """
-                /PUB <TOPIC> <MESSAGE BODY>
-                When this command is received from the client, the client
-                wants to publish a message to a topic. They must enter
-                a valid topic for the message to send. The client must
-                also belong to that topic in order to send messages to it.
-                Publishing a message to a valid topic will broadcast
-                the message to each client that is subscribed to the
-                respective topic.
-                """
-                subscription_split = re.split(r'\s+', message, 2)
-                if len(subscription_split) == 3:
-                    if '/#' == subscription_split[1][-2:] and subscription_split[1][:len(subscription_split[1])-2] in TOPICS:
-                        broadcast_multilevel(subscription_split[1], subscription_split[2], client)
-                    elif '+' in subscription_split[1] and subscription_split[1].count('+') == 1:
-                        broadcast_singlelevel(subscription_split[1], subscription_split[2], client)
-                    elif subscription_split[1] not in TOPICS:
-                        client.send(f'Invalid topic.'.encode('utf-8'))
-                    else:
-                        if subscription_split[1] in client_subscriptions[clients.index( (client) )]:
-                            broadcast(subscription_split[1], subscription_split[2])
-                        else:
-                            client.send(f'You are not subscribed to this topic.'.encode('utf-8'))
-                else:
-                    client.send(f'Invalid syntax: /PUB <TOPIC> <MESSAGE>'.encode('utf-8'))
-            elif (message[:5] == '/PUBR'):
-                """
-                /PUBR <TOPIC> <MESSAGE BODY>
-
-                Similar to publish, but this will put published message
-                to be retained.
-                This will send the message into the topic's retained message.
-                This means that all connected users will receive the published message
-                and this message will be retained. This means that clients that newly
-                subscribe to this topic will receive this retained message.
-                """
-                subscription_split = re.split(r'\s+', message, 2)
-                if len(subscription_split) == 3:
-                    if '/#' == subscription_split[1][-2:] and subscription_split[1][:len(subscription_split[1])-2] in TOPICS:
-                        broadcast_multilevel_retain(subscription_split[1], subscription_split[2], client)
-                    elif '+' in subscription_split[1] and subscription_split[1].count('+') == 1:
-                        broadcast_singlelevel_retain(subscription_split[1], subscription_split[2], client)
-                    elif subscription_split[1] not in TOPICS:
-                        client.send(f'Invalid topic.'.encode('utf-8'))
-                    else:
-                        if subscription_split[1] in client_subscriptions[clients.index( (client) )]:
-                            retain_message(subscription_split[1], subscription_split[2])
-                            broadcast(subscription_split[1], subscription_split[2])
-                        else:
-                            client.send(f'You are not subscribed to this topic.'.encode('utf-8'))
-                else:
-                    client.send(f'Invalid syntax: /PUBR <TOPIC> <MESSAGE>'.encode('utf-8'))
-            elif (message[:6] == '/UNSUB'):
-                """
-                /UNSUB <TOPIC>
-                When this command is received from the client, the client
-                wants to unsubscribe from a topic. They must enter a topic
-                in which they are already subscribed to. If they are not
-                subscribed to the topic, the server will display an error.
-                On success, the server will send a message to the user saying
-                they have successfully unsubscribed from topic x.
-                """
-                subscription_split = message.split(" ")
-                if(len(subscription_split) != 2):
-                    client.send(f'Invalid syntax: /UNSUB <TOPIC>'.encode('utf-8'))
-                else:
-                    if '/#' == subscription_split[1][-2:] and subscription_split[1][:len(subscription_split[1])-2] in TOPICS:
-                        unsubscribe_multilevel(subscription_split[1], client)
-                    elif '+' in subscription_split[1] and subscription_split[1].count('+') == 1:
-                        unsubscribe_singlelevel(subscription_split[1], client)
-                    elif subscription_split[1] in client_subscriptions[clients.index( (client) )]:
-                        client_subscriptions[clients.index( (client) )].remove(subscription_split[1])
-                        client.send(f'Successfully unsubscribed from {subscription_split[1]}!'.encode('utf-8'))
-                    else:
-                        client.send(f'You are not subscribed to that topic.'.encode('utf-8'))
-            elif (message[:5] == '/LIST'):
-                """
-                /LIST
-                When this command is received from the client, the client
-                wants to query the topics they are subscribed to. This will
-                also display how many topics they are subscribed to.
-                """
-                client_topic_list = client_subscriptions[clients.index( (client) )]
-                topic_string = ", ".join(str(topic) for topic in client_topic_list)
-                client.send(f'Subscribed to {str(len(client_topic_list))} topics. {topic_string}'.encode('utf-8'))
-            else:
-                """
-                If the user enters an invalid command, it is not
-                supported by this system. The server will indicate
-                that it is an invalid command.
-                """
-                client.send('Invalid command'.encode('utf-8'))
         except:
             """
             Under a sudden disconnection, we will handle closing the client
             """
-            index = clients.index( (client) )
-            del clients[index]
-            del client_subscriptions[index]
+            SUBSCRIPTIONS.disconnect(client)
             client.close()
             break
+    ADMISSION.release()
+
+"""
+handshake(client)
+
+Sends CONN_ACK to a new client and waits for its acknowledgement, for
+at most handshake_timeout seconds. This runs on the client's own
+thread, so a client that never acknowledges only holds up itself.
+Returns False if the client did not complete the handshake.
+"""
+def handshake(client):
+    try:
+        client.sock.settimeout(handshake_timeout)
+        #Send connection acknoledgement message
+        client.send('CONN_ACK'.encode('utf-8'))
+        connection_accepted = client.receive()
+        client.sock.settimeout(None)
+    except (OSError, UnicodeDecodeError, FrameError):
+        client.close() # The client left during the handshake, or took too long
+        return False
+    LOG.info(connection_accepted)
+    SUBSCRIPTIONS.connect(client)
+    METRICS.count('connections_total')
+    return True
+
+"""
+refuse(sock)
+
+Tells a client that the server is full, and closes its connection.
+"""
+def refuse(sock):
+    try:
+        sock.sendall(encode_frame(REPLY, 'Server is full.'.encode('utf-8')))
+    except OSError:
+        pass
+    sock.close()
+
+"""
+dispatch(client, message)
+
+Performs a single command with handle_command() and counts it in the
+metrics along with how long it took. message is the text of a command,
+the (opcode, arguments) of an OPCODE frame, a BinaryPublish, or a
+BridgeBatch of another broker.
+"""
+def dispatch(client, message):
+    start = time.perf_counter()
+    if isinstance(message, BinaryPublish):
+        result = publish_binary(client, message)
+        name = 'BINARY'
+    elif isinstance(message, BridgeBatch):
+        result = receive_bridged(client, message)
+        name = 'BRIDGED'
+    else:
+        opcode, arguments = parse_command(message) if isinstance(message, str) else message
+        result = handle_command(client, opcode, arguments)
+        name = NAMES.get(opcode, 'INVALID')
+    METRICS.command(name, time.perf_counter() - start)
+    return result
+
+"""
+handle_command(client, opcode, arguments)
+
+Performs a single command received from the client with the handler
+of its opcode in COMMANDS. This does not receive anything from the
+client itself, so it is shared by every server mode. Returns False once
+the client has been sent DISC_ACK, after which the caller waits for the
+client's acknowledgement and closes the connection.
+"""
+def handle_command(client, opcode, arguments):
+    # Only command_disc() returns anything, the others keep the connection open
+    return COMMANDS.get(opcode, command_invalid)(client, *arguments) is not False
+
+"""
+command_disc(client)
+
+/DISC is the DISCONNECT command.
+When this command is received from the client, the client
+wants to disconnect. The server will acknoledge disconnect
+message and close the socket with the client.
+"""
+def command_disc(client):
+    client.send('DISC_ACK'.encode('utf-8'))
+    return False
+
+"""
+command_sub(client, topic)
+
+/SUB <TOPIC>
+When this command is received from the client, the client
+wants to subscribe to a topic. The server will add
+the client to the topic they wish to connect. The client
+must enter a valid topic. A client is also not able to
+subscribe to a topic they are already subscribed to.
+
+If the retained message for the topic is not the empty string,
+then there is no retained message. Thus, no message will be
+sent to the client. If there is a retained message, it will
+be sent to the client.
+"""
+def command_sub(client, topic):
+    if not topic or ' ' in topic:
+        client.send(f'Invalid syntax: /SUB <TOPIC>'.encode('utf-8'))
+        return
+    kind = topic_kind(topic)
+    if kind == MULTI_LEVEL:
+        subscribe_multilevel(topic, client)
+    elif kind == SINGLE_LEVEL:
+        subscribe_singlelevel(topic, client)
+    elif topic in TOPICS:
+        if not SUBSCRIPTIONS.subscribe(client, topic):
+            client.send(f'You are already subscribed to this topic!'.encode('utf-8'))
+        else:
+            if LOG.isEnabledFor(logging.INFO): # Listing the topics costs more than the command itself
+                LOG.info('%s', SUBSCRIPTIONS.topics(client))
+            client.send(f'Subscribed to [{topic}] {TOPICS.retained(topic)}'.encode('utf-8'))
+    elif WILDCARDS.search(topic) is None:
+        create_topic(topic)
+        SUBSCRIPTIONS.subscribe(client, topic)
+        if LOG.isEnabledFor(logging.INFO):
+            LOG.info('%s', list(TOPICS))
+        client.send(f'Subscribed to [{topic}] {TOPICS.retained(topic)}'.encode('utf-8'))
+    else:
+        client.send(f'Cannot create topic with +, # symbol.'.encode('utf-8'))
+
+"""
+command_subfrom(client, topic, offset)
+
+/SUBFROM <TOPIC> <OFFSET>
+When this command is received from the client, the client
+wants to subscribe to a topic and also get the messages
+published to it from an offset on, e.g., to catch up after
+it fell behind or restarted. The messages still kept in the
+topic's history are sent right after the reply, which holds
+the offset of the first of them and the offset of the next
+message published to the topic. Every message carries its own
+offset, so the client can come back with the offset after the
+last message it got. Wildcards are not supported.
+"""
+def command_subfrom(client, topic, offset):
+    if offset is None or not DECIMAL.fullmatch(offset) or ' ' in topic or topic_kind(topic) != TOPIC:
+        client.send(f'Invalid syntax: /SUBFROM <TOPIC> <OFFSET>'.encode('utf-8'))
+    elif not HISTORY.size:
+        client.send(f'The server keeps no message history.'.encode('utf-8'))
+    elif topic not in TOPICS:
+        client.send(f'Invalid topic.'.encode('utf-8'))
+    else:
+        def start(first, frames, next_offset):
+            if not SUBSCRIPTIONS.subscribe(client, topic):
+                client.send(f'You are already subscribed to this topic!'.encode('utf-8'))
+                return
+            client.send(f'Subscribed to [{topic}] from offset {first}, next offset {next_offset}'.encode('utf-8'))
+            client.replay(frames, None)
+        HISTORY.replay(topic, int(offset), start)
+
+"""
+command_pub(client, topic, message)
+
+/PUB <TOPIC> <MESSAGE BODY>
+When this command is received from the client, the client
+wants to publish a message to a topic. They must enter
+a valid topic for the message to send. The client must
+also belong to that topic in order to send messages to it.
+Publishing a message to a valid topic will broadcast
+the message to each client that is subscribed to the
+respective topic.
+"""
+def command_pub(client, topic, message):
+    if message is None:
+        client.send(f'Invalid syntax: /PUB <TOPIC> <MESSAGE>'.encode('utf-8'))
+        return
+    kind = topic_kind(topic)
+    if kind == MULTI_LEVEL and topic[:-2] in TOPICS:
+        broadcast_multilevel(topic, message, client)
+    elif kind == SINGLE_LEVEL:
+        broadcast_singlelevel(topic, message, client)
+    elif topic not in TOPICS:
+        client.send(f'Invalid topic.'.encode('utf-8'))
+    elif SUBSCRIPTIONS.is_subscribed(client, topic):
+        if rate_limited(client, topic, message):
+            return
+        broadcast(topic, message)
+        acknowledge(client)
+    else:
+        client.send(f'You are not subscribed to this topic.'.encode('utf-8'))
+
+"""
+command_pubr(client, topic, message)
+
+/PUBR <TOPIC> <MESSAGE BODY>
+
+Similar to publish, but this will put published message
+to be retained.
+This will send the message into the topic's retained message.
+This means that all connected users will receive the published message
+and this message will be retained. This means that clients that newly
+subscribe to this topic will receive this retained message.
+"""
+def command_pubr(client, topic, message):
+    if message is None:
+        client.send(f'Invalid syntax: /PUBR <TOPIC> <MESSAGE>'.encode('utf-8'))
+        return
+    kind = topic_kind(topic)
+    if kind == MULTI_LEVEL and topic[:-2] in TOPICS:
+        broadcast_multilevel_retain(topic, message, client)
+    elif kind == SINGLE_LEVEL:
+        broadcast_singlelevel_retain(topic, message, client)
+    elif topic not in TOPICS:
+        client.send(f'Invalid topic.'.encode('utf-8'))
+    elif SUBSCRIPTIONS.is_subscribed(client, topic):
+        if rate_limited(client, topic, message):
+            return
+        retain_message(topic, message)
+        broadcast(topic, message)
+        acknowledge(client)
+    else:
+        client.send(f'You are not subscribed to this topic.'.encode('utf-8'))
+
+"""
+command_unsub(client, topic)
+
+/UNSUB <TOPIC>
+When this command is received from the client, the client
+wants to unsubscribe from a topic. They must enter a topic
+in which they are already subscribed to. If they are not
+subscribed to the topic, the server will display an error.
+On success, the server will send a message to the user saying
+they have successfully unsubscribed from topic x.
+"""
+def command_unsub(client, topic):
+    if not topic or ' ' in topic:
+        client.send(f'Invalid syntax: /UNSUB <TOPIC>'.encode('utf-8'))
+        return
+    kind = topic_kind(topic)
+    if kind == MULTI_LEVEL and topic[:-2] in TOPICS:
+        unsubscribe_multilevel(topic, client)
+    elif kind == SINGLE_LEVEL:
+        unsubscribe_singlelevel(topic, client)
+    elif SUBSCRIPTIONS.unsubscribe(client, topic):
+        client.send(f'Successfully unsubscribed from {topic}!'.encode('utf-8'))
+    else:
+        client.send(f'You are not subscribed to that topic.'.encode('utf-8'))
+
+"""
+command_list(client)
+
+/LIST
+When this command is received from the client, the client
+wants to query the topics they are subscribed to. This will
+also display how many topics they are subscribed to.
+"""
+def command_list(client):
+    client_topic_list = SUBSCRIPTIONS.topics(client)
+    topic_string = ", ".join(str(topic) for topic in client_topic_list)
+    client.send(f'Subscribed to {str(len(client_topic_list))} topics. {topic_string}'.encode('utf-8'))
+
+"""
+command_stats(client)
+
+/STATS
+When this command is received from the client, the client
+wants to see the metrics of the server: connections, commands,
+dispatch latency, published messages and the message rate of
+every topic.
+"""
+def command_stats(client):
+    client.send(METRICS.report().encode('utf-8'))
+
+"""
+command_qos(client, qos)
+
+/QOS <0|1>
+When this command is received from the client, the client
+wants its messages delivered with another quality of service.
+At QoS 0 (the default) a message is sent once. At QoS 1 every
+message has a packet id and is sent again until the client
+acknowledges it, so it arrives at least once.
+"""
+def command_qos(client, qos):
+    if qos not in ('0', '1'):
+        client.send(f'Invalid syntax: /QOS <0|1>'.encode('utf-8'))
+    else:
+        client.set_qos(int(qos), inflight_window)
+        client.send(f'QoS set to {qos}'.encode('utf-8'))
+
+"""
+command_session(client, client_id)
+
+/SESSION <CLIENT ID>
+When this command is received from the client, the client
+wants its session to outlive the connection. When the client
+goes away, its subscriptions are kept and the messages
+published to them are queued, and sent to it once it connects
+again and sends /SESSION with the same id.
+"""
+def command_session(client, client_id):
+    if not client_id or ' ' in client_id:
+        client.send(f'Invalid syntax: /SESSION <CLIENT ID>'.encode('utf-8'))
+    elif client.client_id is not None:
+        client.send(f'Session {client.client_id} was already started.'.encode('utf-8'))
+    else:
+        replayed = SUBSCRIPTIONS.resume(client, client_id)
+        if replayed is None:
+            client.send(f'Session {client_id} started.'.encode('utf-8'))
+        else:
+            client.send(f'Session {client_id} resumed with {replayed} offline messages.'.encode('utf-8'))
+
+"""
+command_bridge(client, arguments)
+
+/BRIDGE <BROKER ID> [TOPIC FILTER ...]
+When this command is received, the client is another broker
+that wants the connection to be a bridge, see bridge.py. The
+messages published on topics matching the topic filters (# if
+none are given) are then forwarded over it both ways.
+"""
+def command_bridge(client, arguments):
+    broker_id = arguments.split()[:1]
+    if BRIDGES is None:
+        client.send(f'Bridges need the asyncio mode without workers.'.encode('utf-8'))
+    elif not broker_id or not DECIMAL.fullmatch(broker_id[0]):
+        client.send(f'Invalid syntax: /BRIDGE <BROKER ID> [TOPIC FILTER ...]'.encode('utf-8'))
+    else:
+        client.send(BRIDGES.accept(client, arguments).encode('utf-8'))
+
+"""
+command_invalid(client, *arguments)
+
+If the user enters an invalid command, it is not
+supported by this system. The server will indicate
+that it is an invalid command.
+"""
+def command_invalid(client, *arguments):
+    client.send('Invalid command'.encode('utf-8'))
+
+# Opcode -> handler of the command, see commands.py
+COMMANDS = {
+    DISC: command_disc,
+    SUB: command_sub,
+    PUB: command_pub,
+    PUBR: command_pubr,
+    UNSUB: command_unsub,
+    LIST: command_list,
+    STATS: command_stats,
+    QOS: command_qos,
+    SESSION: command_session,
+    BRIDGE: command_bridge,
+    SUBFROM: command_subfrom,
+}
+
+"""
+acknowledge(client)
+
+Sends the empty reply that tells a client its publish succeeded. Every
+command gets exactly one reply, in the order the commands were sent, so
+a client can send many commands before reading any of the replies and
+still match each reply to its command.
+"""
+def acknowledge(client):
+    client.send(b'')
+
+"""
+rate_limited(client, topic, message)
+
+Returns True, and tells the client, if the rate limits refuse a publish
+of message to topic. Called once the topic is known to be valid, so no
+buckets are made for topics that do not exist.
+"""
+def rate_limited(client, topic, message):
+    if LIMITS.admit(client, topic, len(message)):
+        return False
+    client.send(f'Rate limit exceeded.'.encode('utf-8'))
+    return True
+
+"""
+broadcast(topic, message, pending)
+
+Broadcasts a message to clients in topic, and passes it on to the
+PUBLISH_HOOKS. See deliver() for pending.
+"""
+def broadcast(topic, message, pending = None):
+    deliver(topic, message, pending)
+    for hook in PUBLISH_HOOKS:
+        hook(topic, message)
+
+"""
+deliver(topic, message, pending)
+
+Delivers a message to the clients of this server subscribed to topic.
+The message is encoded into a frame once, and the same immutable frame
+is queued for every subscriber.
+
+When a set is given as pending, the writers of the subscribers are not
+woken up, the subscribers are added to pending instead. This is used
+to broadcast to many topics at once, the messages for each subscriber
+are then sent with a single write by flush_sessions(pending).
+
+When the server keeps message histories, the frame is also added to the
+history of the topic, and holds the offset of the message, see /SUBFROM.
+"""
+def deliver(topic, message, pending = None):
+    if HISTORY.size:
+        frame, subscribers = HISTORY.record(topic, message, SUBSCRIPTIONS.subscribers)
+    else:
+        frame = None
+        subscribers = SUBSCRIPTIONS.subscribers(topic)
+    METRICS.publish(topic, len(subscribers))
+    if not subscribers:
+        return
+    if frame is None:
+        frame = encode_frame(MESSAGE, f'[{topic}]: {message}'.encode('utf-8'))
+    if pending is None:
+        for client in subscribers:
+            client.enqueue(frame)
+    else:
+        for client in subscribers:
+            client.enqueue(frame, MESSAGE, False)
+        pending.update(subscribers)
+
+"""
+publish_binary(client, message)
+
+Publishes a binary message (a BinaryPublish) from a client. Like /PUB,
+the topic must exist and the client must be subscribed to it, wildcards
+are not supported. The message is never decoded: a message that was
+received whole is queued as a DATA frame, a larger one is queued as a
+stream that the client's session fills as the rest of it arrives. The
+BINARY_HOOKS get the message once all of it has arrived.
+"""
+def publish_binary(client, message):
+    topic = message.topic
+    if topic not in TOPICS:
+        client.send(f'Invalid topic.'.encode('utf-8'))
+    elif not SUBSCRIPTIONS.is_subscribed(client, topic):
+        client.send(f'You are not subscribed to this topic.'.encode('utf-8'))
+    elif not LIMITS.admit(client, topic, message.length):
+        client.send(f'Rate limit exceeded.'.encode('utf-8')) # The rest of the message is received and dropped
+    elif message.payload is not None:
+        deliver_binary(topic, message.payload)
+        binary_complete(topic, [message.payload])
+        acknowledge(client)
+    else:
+        subscribers = SUBSCRIPTIONS.subscribers(topic)
+        METRICS.publish(topic, len(subscribers))
+        if subscribers or BINARY_HOOKS:
+            stream = message.stream = client.stream_type(binary_header(DATA, topic, message.length), message.length)
+            for subscriber in subscribers:
+                stream.add_reader()
+                if not subscriber.enqueue(stream, DATA):
+                    stream.leave(0)
+            if BINARY_HOOKS:
+                stream.add_reader() # The hooks get the whole message, so it is kept until it is complete
+                message.on_complete = lambda stream: binary_complete_stream(topic, stream)
+        acknowledge(client)
+    return True
+
+"""
+binary_complete(topic, chunks)
+
+Passes a binary message published by a client of this server, given as
+a list of pieces, on to the BINARY_HOOKS.
+"""
+def binary_complete(topic, chunks):
+    for hook in BINARY_HOOKS:
+        hook(topic, chunks)
+
+"""
+binary_complete_stream(topic, stream)
 
+Passes a streamed binary message on to the BINARY_HOOKS once it is
+complete, and then lets its stream release the pieces.
 """
-broadcast(topic, message)
+def binary_complete_stream(topic, stream):
+    try:
+        binary_complete(topic, stream.chunks)
+    finally:
+        stream.leave(0)
 
-Broadcasts a message to clients in topic.
 """
-def broadcast(topic, message):
-    for client in clients:
-        if topic in client_subscriptions[clients.index( (client) )]:
-                client.send(f'[{topic}]: {message}'.encode('utf-8'))
+deliver_binary(topic, payload)
+
+Delivers a binary message that is already complete to the clients of
+this server subscribed to topic, as a single DATA frame.
+"""
+def deliver_binary(topic, payload):
+    subscribers = SUBSCRIPTIONS.subscribers(topic)
+    METRICS.publish(topic, len(subscribers))
+    if not subscribers:
+        return
+    frame = binary_header(DATA, topic, len(payload)) + payload
+    for client in subscribers:
+        client.enqueue(frame, DATA)
+
+"""
+flush_sessions(sessions)
+
+Wakes up the writers of sessions that were broadcast to with pending.
+"""
+def flush_sessions(sessions):
+    for session in sessions:
+        session.flush()
 
 """
 retain_message(topic, message)
 
 
-Retains the message for the specified topic.
+Retains the message for the specified topic, and passes it on to the
+RETAIN_HOOKS.
 """
 def retain_message(topic, message):
-    RETAINED_TOPIC_MESSAGE[TOPICS.index(topic)] = message
-    print("Retaining Message!")
+    keep_retained(topic, message)
+    for hook in RETAIN_HOOKS:
+        hook(topic, message)
+
+"""
+keep_retained(topic, message)
+
+Sets the retained message of the topic on this server and stores it.
+"""
+def keep_retained(topic, message):
+    TOPICS.retain(topic, message)
+    RETAINED.put(topic, message)
+    LOG.info("Retaining Message!")
+
+"""
+apply_retained(topic, message)
+
+Retains a message that was retained on another worker of the server.
+"""
+def apply_retained(topic, message):
+    TOPICS.add(topic)
+    keep_retained(topic, message)
+
+"""
+receive_bridged(client, batch)
+
+Applies a batch of messages that another broker sent over the bridge
+of client. Unlike a command, a batch gets no reply.
+"""
+def receive_bridged(client, batch):
+    link = BRIDGES.sessions.get(client) if BRIDGES is not None else None
+    if link is None:
+        raise FrameError('Bridged messages on a connection that is not a bridge')
+    BRIDGES.receive(link, batch.payload)
+    return True
+
+"""
+apply_bridged(topic, message, retain, pending)
+
+Publishes a message that was published on another broker to the
+clients of this server, or retains it. The topic is created if this
+server does not have it yet. See deliver() for pending.
+"""
+def apply_bridged(topic, message, retain, pending):
+    TOPICS.add(topic)
+    if retain:
+        keep_retained(topic, message)
+    else:
+        deliver(topic, message, pending)
+
+"""
+create_topic(topic)
+
+Creates a topic, and passes it on to the TOPIC_HOOKS if it is new.
+Returns True if the topic was created.
+"""
+def create_topic(topic):
+    if not TOPICS.add(topic):
+        return False
+    for hook in TOPIC_HOOKS:
+        hook(topic)
+    return True
+
+"""
+load_retained(store)
+
+Makes store the retained store of the server and loads the retained
+messages it holds. Topics that only exist in the store are created.
+"""
+def load_retained(store):
+    global RETAINED
+    RETAINED = store
+    return restore_retained(store.load())
+
+"""
+restore_retained(messages)
+
+Retains the messages of a dict of topic -> message loaded from a store,
+creating the topics that do not exist yet. Returns their number.
+"""
+def restore_retained(messages):
+    for topic, message in messages.items():
+        TOPICS.add(topic)
+        TOPICS.retain(topic, message)
+    return len(messages)
 
 # QUERY WILD CARD TOPICS
 
@@ -231,29 +737,17 @@ Returns a list of topics that match multilevel wildcard
 """
 def multilevel_topics(topic_input):
     # Input is assumed to be valid, that is, it ends with /#
-    topic_input = topic_input[:-1]
-    topic_input_length = len(topic_input)
-    topics = []
-    # topics.append(topic_input[:-1])
-    for topic in TOPICS:
-        if topic_input == topic[:topic_input_length]:
-            topics.append(topic)
-    return topics
+    return TOPICS.match(topic_input)
 
 """
 singlelevel_topics(topic_input)
 
-Returns a list of topics that match singlelevel wildcard
+Returns a list of topics that match singlelevel wildcard,
+the + matches exactly one level of the topic.
 """
 def singlelevel_topics(topic_input):
     # Input is assumed to be valid
-    front_back = topic_input.split("+")
-    topics = []
-    # topics.append(front_back[0][:-1])
-    for topic in TOPICS:
-        if front_back[0] == topic[:len(front_back[0])] and front_back[1] == topic[-len(front_back[1]):]:
-            topics.append(topic)
-    return topics
+    return TOPICS.match(topic_input)
 
 """
 client_topics(topic_list)
@@ -263,7 +757,7 @@ Returns a new list of topics that the client is subscribed to
 def client_topics(topic_list, client):
     client_topics = []
     for topic in topic_list:
-        if topic in client_subscriptions[clients.index( (client) )]:
+        if SUBSCRIPTIONS.is_subscribed(client, topic):
             client_topics.append(topic)
     return client_topics
 
@@ -280,13 +774,8 @@ def subscribe_multilevel(topic_input, client):
     topics = multilevel_topics(topic_input)
     if len(topics) != 0:
         topics_to_string = "Subscribed to: \n"
-        for topic in topics:
-            if topic not in client_subscriptions[clients.index( (client) )]:
-                topics_to_string += f'[{topic}] {RETAINED_TOPIC_MESSAGE[TOPICS.index(topic)]} \n'
-
-        for topic in topics:
-            if topic not in client_subscriptions[clients.index( (client) )]:
-                client_subscriptions[clients.index( (client) )].append(topic)
+        for topic in SUBSCRIPTIONS.subscribe_many(client, topics):
+            topics_to_string += f'[{topic}] {TOPICS.retained(topic)} \n'
         client.send(f'{topics_to_string}'.encode('utf-8'))
     else:
         client.send(f'No topic matches for {topic_input}.'.encode('utf-8'))
@@ -301,13 +790,8 @@ def subscribe_singlelevel(topic_input, client):
     topics = singlelevel_topics(topic_input)
     if len(topics) != 0:
         topics_to_string = "Subscribed to: "
-        for topic in topics:
-            if topic not in client_subscriptions[clients.index( (client) )]:
-                topics_to_string += f'[{topic}] {RETAINED_TOPIC_MESSAGE[TOPICS.index(topic)]} \n'
-
-        for topic in topics:
-            if topic not in client_subscriptions[clients.index( (client) )]:
-                client_subscriptions[clients.index( (client) )].append(topic)
+        for topic in SUBSCRIPTIONS.subscribe_many(client, topics):
+            topics_to_string += f'[{topic}] {TOPICS.retained(topic)} \n'
         client.send(f'{topics_to_string}'.encode('utf-8'))
     else:
         client.send(f'No topic matches for {topic_input}.'.encode('utf-8'))
@@ -323,14 +807,9 @@ def unsubscribe_multilevel(topic_input, client):
     topics = multilevel_topics(topic_input)
     if len(topics) != 0:
         topics_to_string = "Unsubscribed to: "
-        for topic in topics:
-            if topic in client_subscriptions[clients.index( (client) )]:
-                topics_to_string += topic + ", "
+        for topic in SUBSCRIPTIONS.unsubscribe_many(client, topics):
+            topics_to_string += topic + ", "
         topics_to_string = topics_to_string[:-2] # Removes last , "
-
-        for topic in topics:
-            if topic in client_subscriptions[clients.index( (client) )]:
-                client_subscriptions[clients.index( (client) )].remove(topic)
         client.send(f'{topics_to_string}'.encode('utf-8'))
     else:
         client.send(f'No topic matches for {topic_input}.'.encode('utf-8'))
@@ -345,14 +824,9 @@ def unsubscribe_singlelevel(topic_input, client):
     topics = singlelevel_topics(topic_input)
     if len(topics) != 0:
         topics_to_string = "Unsubscribed to: "
-        for topic in topics:
-            if topic in client_subscriptions[clients.index( (client) )]:
-                topics_to_string += topic + ", "
+        for topic in SUBSCRIPTIONS.unsubscribe_many(client, topics):
+            topics_to_string += topic + ", "
         topics_to_string = topics_to_string[:-2] # Removes last , "
-
-        for topic in topics:
-            if topic in client_subscriptions[clients.index( (client) )]:
-                client_subscriptions[clients.index( (client) )].remove(topic)
         client.send(f'{topics_to_string}'.encode('utf-8'))
     else:
         client.send(f'No topic matches for {topic_input}.'.encode('utf-8'))
@@ -369,8 +843,13 @@ def broadcast_multilevel(topic_input, message, client):
     topics = multilevel_topics(topic_input)
     topics = client_topics(topics, client)
     if len(topics) != 0:
+        if rate_limited(client, topic_input, message):
+            return
+        pending = set()
         for topic in topics:
-            broadcast(topic, message)
+            broadcast(topic, message, pending)
+        flush_sessions(pending)
+        acknowledge(client)
     else:
         client.send(f'No topic matches for {topic_input}.'.encode('utf-8'))
 
@@ -384,8 +863,13 @@ def broadcast_singlelevel(topic_input, message, client):
     topics = singlelevel_topics(topic_input)
     topics = client_topics(topics, client)
     if len(topics) != 0:
+        if rate_limited(client, topic_input, message):
+            return
+        pending = set()
         for topic in topics:
-            broadcast(topic, message)
+            broadcast(topic, message, pending)
+        flush_sessions(pending)
+        acknowledge(client)
     else:
         client.send(f'No topic matches for {topic_input}.'.encode('utf-8'))
 
@@ -401,9 +885,14 @@ def broadcast_multilevel_retain(topic_input, message, client):
     topics = multilevel_topics(topic_input)
     topics = client_topics(topics, client)
     if len(topics) != 0:
+        if rate_limited(client, topic_input, message):
+            return
+        pending = set()
         for topic in topics:
             retain_message(topic, message)
-            broadcast(topic, message)
+            broadcast(topic, message, pending)
+        flush_sessions(pending)
+        acknowledge(client)
     else:
         client.send(f'No topic matches for {topic_input}.'.encode('utf-8'))
 
@@ -417,39 +906,371 @@ def broadcast_singlelevel_retain(topic_input, message, client):
     topics = singlelevel_topics(topic_input)
     topics = client_topics(topics, client)
     if len(topics) != 0:
+        if rate_limited(client, topic_input, message):
+            return
+        pending = set()
         for topic in topics:
             retain_message(topic, message)
-            broadcast(topic, message)
+            broadcast(topic, message, pending)
+        flush_sessions(pending)
+        acknowledge(client)
     else:
         client.send(f'No topic matches for {topic_input}.'.encode('utf-8'))
 
 """
-receive()
+receive(server)
 
 This is the function that accepts client connections.
 Upon receiving a connection, the client will be added
-to a list of clients, and also given a list of subscriptions.
+to the subscription registry as a new session.
 """
-def receive():
+def receive(server):
     while True:
         try:
-            client, address = server.accept()
+            sock, address = server.accept()
             # print(client)
+            if not ADMISSION.admit():
+                refuse(sock)
+                continue
 
-            #Send connection acknoledgement message
-            client.send('CONN_ACK'.encode('utf-8')) 
-            connection_accepted = client.recv(1024).decode('utf-8')
-
-            print(connection_accepted)
-            clients.append(client)
-            client_subscriptions.append([])
-
-            # adding the client to a thread so we can have multiple clients on server concurrently
+            # adding the client to a thread so we can have multiple clients on server concurrently,
+            # the handshake is done by that thread so the next client can be accepted right away
+            client = Session(sock, address, queue_size, overflow, flush_delay)
             thread = threading.Thread(target=handle, args=(client,))
             thread.start() 
         except KeyboardInterrupt:
-            print("hello world")
+            LOG.info("hello world")
             break
 
-print(f'Server is listening on port {str(port)}')
-receive()
\ No newline at end of file
+"""
+serve_threaded(host, port)
+
+Runs the server with one thread per connected client.
+"""
+def serve_threaded(host, port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP
+    server.bind( (host, port) ) # Binding to port and localhost
+    server.listen()
+    LOG.info(f'Server is listening on port {str(port)}')
+    threading.Thread(target=retransmit, daemon=True).start()
+    threading.Thread(target=expire_sessions, daemon=True).start()
+    receive(server)
+
+"""
+retransmit()
+
+Resends the QoS 1 messages that were not acknowledged in time, for
+ever, on a thread of its own.
+"""
+def retransmit():
+    while True:
+        time.sleep(retransmit_timeout / 2)
+        resent = SUBSCRIPTIONS.retransmit(time.monotonic(), retransmit_timeout)
+        if resent:
+            METRICS.count('messages_retransmitted_total', resent)
+
+"""
+retransmit_async()
+
+The asyncio counterpart of retransmit(), a task of the event loop.
+"""
+async def retransmit_async():
+    while True:
+        await asyncio.sleep(retransmit_timeout / 2)
+        resent = SUBSCRIPTIONS.retransmit(time.monotonic(), retransmit_timeout)
+        if resent:
+            METRICS.count('messages_retransmitted_total', resent)
+
+"""
+expiry_interval()
+
+Returns the seconds between two checks for expired offline sessions,
+half the session expiry, but at least once a minute and at most ten
+times a second.
+"""
+def expiry_interval():
+    return max(min(SUBSCRIPTIONS.session_expiry / 2, 60.0), 0.1)
+
+"""
+expire_sessions()
+
+Drops the offline sessions whose clients did not come back in time,
+along with their spill files, for ever, on a thread of its own.
+"""
+def expire_sessions():
+    while True:
+        time.sleep(expiry_interval())
+        SUBSCRIPTIONS.expire_offline(time.monotonic())
+
+"""
+expire_sessions_async()
+
+The asyncio counterpart of expire_sessions(), a task of the event loop.
+"""
+async def expire_sessions_async():
+    while True:
+        await asyncio.sleep(expiry_interval())
+        SUBSCRIPTIONS.expire_offline(time.monotonic())
+
+"""
+handle_async(reader, writer)
+
+The asyncio counterpart of receive() and handle() for a single client.
+The CONN_ACK handshake and every command run as a coroutine on the event
+loop, and messages to other clients are written without blocking. A
+client that does not acknowledge CONN_ACK within handshake_timeout
+seconds is dropped.
+"""
+async def handle_async(reader, writer):
+    if not ADMISSION.admit():
+        writer.write(encode_frame(REPLY, 'Server is full.'.encode('utf-8')))
+        writer.close()
+        return
+    client = StreamSession(reader, writer, queue_size, overflow, flush_delay)
+    try:
+        #Send connection acknoledgement message
+        client.send('CONN_ACK'.encode('utf-8'))
+        connection_accepted = await asyncio.wait_for(client.receive(), handshake_timeout)
+        LOG.info(connection_accepted)
+        SUBSCRIPTIONS.connect(client)
+        METRICS.count('connections_total')
+
+        while True:
+            message = await client.receive()
+            if not dispatch(client, message):
+                disconnect_accepted = await client.receive()
+                LOG.info(disconnect_accepted)
+                break
+    except (OSError, UnicodeDecodeError, FrameError, asyncio.TimeoutError):
+        pass # Sudden disconnection or no acknowledgement in time, the client is cleaned up below
+    finally:
+        if BRIDGES is not None:
+            BRIDGES.detach(client)
+        SUBSCRIPTIONS.disconnect(client)
+        client.close()
+        ADMISSION.release()
+
+"""
+serve_asyncio(host, port, sock, bridges)
+
+Runs the server on a single asyncio event loop. All clients share one
+thread, so an idle client only costs its socket and stream buffers.
+The server listens on sock instead when it is given. Unless it is a
+worker, the server accepts bridges from other brokers, and opens one to
+every (host, port) in bridges.
+"""
+async def serve_asyncio(host, port, sock = None, bridges = ()):
+    global BRIDGES
+    if sock is None:
+        BRIDGES = Bridges(apply_bridged, flush_sessions)
+        PUBLISH_HOOKS.append(BRIDGES.publish)
+        RETAIN_HOOKS.append(BRIDGES.retain)
+        server = await asyncio.start_server(handle_async, host, port, backlog=4096)
+    else:
+        server = await asyncio.start_server(handle_async, sock=sock)
+    LOG.info(f'Server is listening on port {str(port)}')
+    for bridge_host, bridge_port in bridges:
+        BRIDGES.start(bridge_host, bridge_port, bridge_filters)
+    # The loop only keeps weak references to tasks
+    retransmitter = asyncio.get_running_loop().create_task(retransmit_async())
+    expirer = asyncio.get_running_loop().create_task(expire_sessions_async())
+    async with server:
+        await server.serve_forever()
+
+"""
+serve_workers(count, host, port, retained_log)
+
+Runs the server as count worker processes that all accept clients on
+the same port, see cluster.py. Every worker runs the asyncio mode. The
+retained log is read here, once, before the workers are forked.
+"""
+def serve_workers(count, host, port, retained_log):
+    store = None
+    if retained_log:
+        # Read once before forking, so every worker starts with the retained messages
+        store = LogRetainedStore(retained_log)
+        restore_retained(store.read())
+    context = multiprocessing.get_context('fork')
+    peers = socket_pairs(count)
+    workers = [context.Process(target=serve_worker, args=(index, host, port, peers, store, os.getpid()))
+               for index in range(count)]
+    for worker in workers:
+        worker.start()
+    for worker_peers in peers:
+        for sock in worker_peers.values():
+            sock.close()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+"""
+serve_worker(index, host, port, peers, store, parent)
+
+Runs a single worker process. The parent read the retained log (store)
+before forking, so every worker starts with its messages. Only the
+first worker writes retained messages to the log, the others learn
+about new retained messages from the other workers and never touch it.
+Every worker has its own metrics, the metrics listener of a worker is
+on metrics_port + index.
+"""
+def serve_worker(index, host, port, peers, store, parent):
+    global RETAINED
+    start_logging(log_level)
+    if metrics_port is not None:
+        serve_metrics(METRICS, 'localhost', metrics_port + index)
+    for other, worker_peers in enumerate(peers):
+        if other != index:
+            for sock in worker_peers.values():
+                sock.close()
+    if store is not None and index == 0:
+        store.start()
+        RETAINED = store
+    try:
+        asyncio.run(run_worker(host, port, list(peers[index].values()), parent))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        RETAINED.close()
+        stop_logging()
+
+"""
+run_worker(host, port, sockets, parent)
+
+Connects a worker to the other workers and serves its clients, until
+the parent process goes away.
+"""
+async def run_worker(host, port, sockets, parent):
+    cluster = Cluster(deliver, apply_retained, TOPICS.add, deliver_binary)
+    await cluster.connect(sockets)
+    PUBLISH_HOOKS.append(cluster.publish)
+    RETAIN_HOOKS.append(cluster.retain)
+    TOPIC_HOOKS.append(cluster.topic)
+    BINARY_HOOKS.append(cluster.publish_binary)
+    serving = asyncio.get_running_loop().create_task(serve_asyncio(host, port, listening_socket(host, port)))
+    while os.getppid() == parent and not serving.done():
+        await asyncio.sleep(1)
+    serving.cancel()
+
+"""
+bridge_address(address)
+
+Parses the HOST:PORT of a broker to bridge to, for argparse.
+"""
+def bridge_address(address):
+    bridge_host, separator, bridge_port = address.rpartition(':')
+    if not separator or not DECIMAL.fullmatch(bridge_port):
+        raise argparse.ArgumentTypeError(f'{address} is not HOST:PORT')
+    return bridge_host or 'localhost', int(bridge_port)
+
+"""
+main()
+
+Parses the command line and starts the server in the selected mode.
+"""
+def main():
+    global queue_size, overflow, flush_delay, log_level, metrics_port, inflight_window, retransmit_timeout, \
+        handshake_timeout, bridge_filters
+    parser = argparse.ArgumentParser(description='MQTT server')
+    parser.add_argument('--host', default=host, help='host to listen on')
+    parser.add_argument('--port', type=int, default=port, help='port to listen on')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help='threaded runs a thread per client, asyncio runs every client on one event loop')
+    parser.add_argument('--queue-size', type=int, default=queue_size,
+                        help='published messages queued for a client before the overflow policy applies')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=overflow,
+                        help='what to do with a new message when a client\'s queue is full')
+    parser.add_argument('--flush-delay', type=float, default=flush_delay * 1000, metavar='MS',
+                        help='milliseconds a client\'s writer waits to send more messages with one write')
+    parser.add_argument('--retained-log', metavar='PATH',
+                        help='keep retained messages in an append-only log so they survive restarts')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the port, each one runs the asyncio mode')
+    parser.add_argument('--match-cache', type=int, default=TOPICS.cache_size, metavar='N',
+                        help='number of wildcards whose matching topics are cached')
+    parser.add_argument('--log-level', choices=list(LEVELS), default=log_level,
+                        help='least important messages logged by the server, off logs nothing')
+    parser.add_argument('--metrics-port', type=int, default=metrics_port, metavar='PORT',
+                        help='serve Prometheus metrics on localhost:PORT/metrics')
+    parser.add_argument('--offline-queue', type=int, default=SUBSCRIPTIONS.offline_size, metavar='N',
+                        help='messages of an offline persistent session kept in memory before the rest go to disk')
+    parser.add_argument('--spill-dir', metavar='PATH',
+                        help='directory for the messages of offline sessions, the temporary directory by default')
+    parser.add_argument('--session-expiry', type=float, default=SUBSCRIPTIONS.session_expiry, metavar='SECONDS',
+                        help='seconds a persistent session is kept after its client went away')
+    parser.add_argument('--inflight', type=int, default=inflight_window, metavar='N',
+                        help='unacknowledged messages a client at QoS 1 may have')
+    parser.add_argument('--retransmit', type=float, default=retransmit_timeout * 1000, metavar='MS',
+                        help='milliseconds before an unacknowledged QoS 1 message is sent again')
+    parser.add_argument('--max-connections', type=int, metavar='N',
+                        help='most open connections, further clients are refused (per worker with --workers)')
+    parser.add_argument('--handshake-timeout', type=float, default=handshake_timeout, metavar='SECONDS',
+                        help='seconds a new client has to acknowledge CONN_ACK before it is dropped')
+    parser.add_argument('--client-rate', type=float, metavar='N',
+                        help='messages per second a client may publish')
+    parser.add_argument('--client-bytes', type=float, metavar='N',
+                        help='bytes of messages per second a client may publish')
+    parser.add_argument('--topic-rate', type=float, metavar='N',
+                        help='messages per second that may be published to a topic')
+    parser.add_argument('--topic-bytes', type=float, metavar='N',
+                        help='bytes of messages per second that may be published to a topic')
+    parser.add_argument('--history', type=int, default=HISTORY.size, metavar='N',
+                        help='messages kept for every topic for /SUBFROM, 0 keeps none')
+    parser.add_argument('--history-bytes', type=int, metavar='N',
+                        help='bytes of messages kept for every topic for /SUBFROM, no limit by default')
+    parser.add_argument('--bridge', action='append', default=[], type=bridge_address, metavar='HOST:PORT',
+                        help='forward messages to and from the broker on HOST:PORT, can be given more than once, '
+                             'implies the asyncio mode')
+    parser.add_argument('--bridge-topic', action='append', metavar='FILTER',
+                        help='topic filter forwarded over the bridges, can be given more than once, # by default')
+    args = parser.parse_args()
+    if args.inflight < 1:
+        parser.error('--inflight must be at least 1')
+    if args.history < 0:
+        parser.error('--history cannot be negative')
+    if args.history_bytes is not None and args.history_bytes < 0:
+        parser.error('--history-bytes cannot be negative')
+    if args.bridge and args.workers > 1:
+        parser.error('--bridge cannot be used with --workers')
+
+    queue_size, overflow, flush_delay = args.queue_size, args.overflow, args.flush_delay / 1000
+    log_level, metrics_port = args.log_level, args.metrics_port
+    inflight_window, retransmit_timeout = args.inflight, args.retransmit / 1000
+    TOPICS.cache_size = args.match_cache
+    SUBSCRIPTIONS.offline_size, SUBSCRIPTIONS.spill_dir = args.offline_queue, args.spill_dir
+    SUBSCRIPTIONS.session_expiry = args.session_expiry
+    bridge_filters = args.bridge_topic or bridge_filters
+    handshake_timeout, ADMISSION.max_connections = args.handshake_timeout, args.max_connections
+    LIMITS.client_messages, LIMITS.client_bytes = args.client_rate, args.client_bytes
+    LIMITS.topic_messages, LIMITS.topic_bytes = args.topic_rate, args.topic_bytes
+    HISTORY.size, HISTORY.max_bytes = args.history, args.history_bytes
+
+    if args.workers > 1:
+        serve_workers(args.workers, args.host, args.port, args.retained_log)
+        return
+
+    start_logging(log_level)
+    if metrics_port is not None:
+        serve_metrics(METRICS, 'localhost', metrics_port)
+
+    if args.retained_log:
+        start = time.perf_counter()
+        count = load_retained(LogRetainedStore(args.retained_log))
+        LOG.info(f'Loaded {count} retained messages in {time.perf_counter() - start:.3f}s')
+
+    try:
+        if args.mode == 'asyncio' or args.bridge:
+            try:
+                asyncio.run(serve_asyncio(args.host, args.port, bridges=args.bridge))
+            except KeyboardInterrupt:
+                pass
+        else:
+            serve_threaded(args.host, args.port)
+    finally:
+        RETAINED.close()
+        stop_logging()
+
+if __name__ == '__main__':
+    main()
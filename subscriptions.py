@@ -0,0 +1,1211 @@
+"""
+subscriptions.py
+
+Purpose: Keeps track of which clients are subscribed to which topics.
+Each connected client is represented by a Session, and the registry maps
+every topic to the set of sessions subscribed to it so that publishing
+only has to visit the actual subscribers of a topic. Topics are kept as
+the integer ids of the topic trie, see TopicTrie.topic_id().
+"""
+
+import asyncio
+import collections
+import itertools
+import socket
+import threading
+import time
+
+from bridge import BRIDGE_MESSAGES, BridgeBatch
+from commands import decode_command
+from framing import ACK, DATA, HEADER_SIZE, MAX_BINARY_SIZE, MESSAGE, OPCODE, PACKET_ID, PUBLISH, REPLY, TOPIC_LENGTH, \
+    FrameError, FrameParser, PacketFrame, decode_binary, encode_frame, send_frames, split_frames, with_packet_id, without_packet_id
+from metrics import METRICS
+from offline import OfflineQueue
+from payloads import AsyncPayloadStream, BinaryPublish, PayloadStream
+
+# What a session does with a new message when its outbound queue is full
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest', 'disconnect')
+
+BATCH_BYTES = 256 * 1024 # Most bytes a writer sends with a single write
+BATCH_FRAMES = 1024      # Most frames in a single write (the usual IOV_MAX)
+BUFFERED_COMMANDS = 32   # Commands an asyncio client runs before yielding to the others
+STREAM_CHUNK = 256 * 1024 # Most bytes of a streamed binary message received at once
+MAX_BACKOFF = 32         # Longest wait for a QoS 1 retransmission, in retransmission timeouts
+
+class Session:
+    """
+    Constructor for a session. A session wraps the socket of a connected
+    client along with the topics that the client is subscribed to. The
+    subscriptions are kept in a dict so that they keep the order in which
+    the client subscribed to them.
+
+    Frames to the client are not sent by the thread that produces them.
+    They are put on the session's outbound queue, which is drained by the
+    session's own writer thread, so a slow client never blocks the client
+    that published the message. At most queue_size published messages are
+    queued, overflow decides what happens to the next one. A binary
+    message that is still being received is queued as a PayloadStream,
+    and the writer sends it piece by piece before any later frame.
+
+    The writer sends every frame that is queued when it wakes up with a
+    single write. With a flush_delay (in seconds) it also waits that long
+    for more frames to arrive, unless BATCH_BYTES are already queued.
+
+    With QoS 1 (see set_qos()) published messages are delivered at least
+    once: each one is sent with a packet id and kept until the client
+    acknowledges it. Like TCP, a session keeps a single timer: when no
+    acknowledgement came for a while, every unacknowledged message is
+    sent again, and the wait doubles until the client acknowledges one.
+
+    A session with a client_id is persistent, see
+    SubscriptionRegistry.resume(). Once it is closed, the frames queued
+    for it go to its successor, the OfflineSession that took its place.
+
+    A server holds a session for every connection, so sessions have slots
+    instead of a __dict__.
+    """
+    __slots__ = ('sock', 'address', 'subscriptions', 'parser', 'queue', 'queued_bytes', 'queue_size',
+                 'overflow', 'flush_delay', 'dropped', 'frames_sent', 'writes', 'closed', 'ready',
+                 'writer_thread', 'upload', 'qos', 'window', 'inflight', 'held', 'next_packet_id',
+                 'acked_at', 'backoff', 'client_id', 'successor', 'rate_limits')
+
+    parser_size = 4096 # Initial buffer of the parser, which receives straight from the socket
+    lock_type = threading.Condition # The writer thread waits on the queue lock
+    stream_type = PayloadStream # Streams of the binary messages this session publishes
+
+    def __init__(self, sock, address = None, queue_size = 1000, overflow = 'drop-oldest', flush_delay = 0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow}')
+        self.sock = sock
+        self.address = address
+        self.subscriptions = {} # topic id -> None, ordered set of topic ids
+        self.parser = FrameParser(self.parser_size)
+        self.queue = collections.deque() # Encoded frames waiting to be sent
+        self.queued_bytes = 0
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.flush_delay = flush_delay
+        self.dropped = 0 # Messages dropped because the queue was full
+        self.frames_sent = 0
+        self.writes = 0  # Socket writes, each one sends a batch of frames
+        self.closed = False
+        self.ready = self.lock_type()
+        self.upload = None # BinaryPublish still being received, see receive()
+        self.qos = 0
+        self.window = 0          # Most unacknowledged messages at QoS 1
+        self.inflight = None     # Frames of the unacknowledged messages, oldest first
+        self.held = None         # MESSAGE frames waiting for room in the window
+        self.next_packet_id = 1  # The ids of inflight run up to this one, see acknowledge()
+        self.acked_at = 0        # When the client last acknowledged a message, see retransmit()
+        self.backoff = 1         # Retransmissions wait backoff times the timeout
+        self.client_id = None    # Set for a persistent session
+        self.successor = None    # OfflineSession that took over the subscriptions, see hand_off()
+        self.rate_limits = None  # Token buckets of the client's publishes, see limits.py
+        self.start_writer()
+
+    """
+    send(data, kind)
+
+    Queues data to be sent to the client as a single frame. Replies to
+    the client's own commands are REPLY frames, published messages are
+    MESSAGE frames.
+    """
+    def send(self, data, kind = REPLY):
+        self.enqueue(encode_frame(kind, data), kind)
+        return len(data)
+
+    """
+    enqueue(frame, kind, flush)
+
+    Puts an encoded frame, or a PayloadStream, on the outbound queue.
+    Only published messages (MESSAGE and DATA frames) are held to the
+    queue size, replies to the client's own commands are always queued,
+    and so are the batches of a bridge (BRIDGE_MESSAGES frames), which
+    hold the messages of many publishes that the other broker would never
+    get again. A bridge holds its batches back instead while the queue
+    holds too many bytes, see bridge.py. Returns False if the frame was
+    not queued.
+
+    With flush=False the writer is not woken up, so that several frames
+    can be queued and sent together. The caller must then call flush().
+    """
+    def enqueue(self, frame, kind = MESSAGE, flush = True):
+        with self.ready:
+            if self.closed:
+                return self.successor is not None and self.successor.enqueue(frame, kind, flush)
+            if kind == MESSAGE and self.qos:
+                return self.hold(frame, flush)
+            if kind != REPLY and kind != BRIDGE_MESSAGES and len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                if self.overflow == 'drop-newest':
+                    return False
+                elif self.overflow == 'drop-oldest':
+                    self.drop_oldest()
+                else:
+                    self._abort_locked()
+                    return False
+            self.queue.append(frame)
+            self.queued_bytes += len(frame)
+            if flush:
+                self.wake()
+        return True
+
+    """
+    hold(frame, flush)
+
+    Queues a MESSAGE frame for a client at QoS 1, called with the queue
+    lock held. The frame is sent right away if there is room in the
+    window, otherwise it waits in held, which counts toward the queue size.
+    """
+    def hold(self, frame, flush):
+        if not self.held and len(self.inflight) < self.window:
+            self.send_inflight(frame)
+        else:
+            if len(self.held) >= self.queue_size:
+                self.dropped += 1
+                if self.overflow == 'drop-newest':
+                    return False
+                elif self.overflow == 'drop-oldest':
+                    self.held.popleft()
+                else:
+                    self._abort_locked()
+                    return False
+            self.held.append(frame)
+        if flush:
+            self.wake()
+        return True
+
+    """
+    release()
+
+    Sends as many held frames as the window has room for, each with the
+    next packet id. Called with the queue lock held.
+    """
+    def release(self):
+        while self.held and len(self.inflight) < self.window:
+            self.send_inflight(self.held.popleft())
+
+    """
+    send_inflight(frame)
+
+    Queues a MESSAGE frame with the next packet id and keeps it until it
+    is acknowledged. Called with the queue lock held.
+    """
+    def send_inflight(self, frame):
+        if not self.inflight:
+            self.acked_at = time.monotonic() # Nothing was waiting, the timer starts now
+        frame = with_packet_id(frame, self.next_packet_id)
+        self.next_packet_id += 1
+        self.inflight.append(frame)
+        self.queue.append(frame)
+        self.queued_bytes += len(frame)
+
+    """
+    set_qos(qos, window)
+
+    Sets the quality of service of the messages published to the client,
+    0 (at most once) or 1 (at least once), with at most window messages
+    unacknowledged at QoS 1. Going back to QoS 0 forgets the messages that
+    were not acknowledged and sends the held ones as they are.
+    """
+    def set_qos(self, qos, window):
+        with self.ready:
+            self.window = window
+            if qos and not self.qos:
+                self.inflight = collections.deque()
+                self.held = collections.deque()
+            elif self.qos and not qos:
+                for frame in self.held:
+                    self.queue.append(frame)
+                    self.queued_bytes += len(frame)
+                self.inflight = self.held = None
+            self.qos = qos
+            if qos:
+                self.release()
+            self.wake()
+
+    """
+    acknowledge(packet_id)
+
+    Forgets the messages up to and including packet_id, which the client
+    received, and sends the held messages that now fit in the window.
+    """
+    def acknowledge(self, packet_id):
+        with self.ready:
+            if not self.qos:
+                return
+            acknowledged = packet_id - (self.next_packet_id - len(self.inflight)) + 1
+            if acknowledged <= 0:
+                return
+            for _ in range(min(acknowledged, len(self.inflight))):
+                self.inflight.popleft()
+            self.acked_at = time.monotonic()
+            self.backoff = 1
+            if self.held:
+                self.release()
+                self.wake()
+
+    """
+    retransmit(now, timeout)
+
+    Sends every unacknowledged message again, in order, if the client
+    acknowledged nothing for timeout seconds before now, or for twice as
+    long after every retransmission that went unacknowledged, up to
+    MAX_BACKOFF times as long. Nothing is resent
+    while frames are still queued, the client cannot have acknowledged
+    what it did not get yet. Returns the number of messages resent.
+    """
+    def retransmit(self, now, timeout):
+        if not self.inflight:
+            return 0
+        with self.ready:
+            if self.closed or self.queue or not self.inflight or now - self.acked_at < timeout * self.backoff:
+                return 0
+            for frame in self.inflight:
+                self.queue.append(frame)
+                self.queued_bytes += len(frame)
+            self.acked_at = now
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            self.wake()
+            return len(self.inflight)
+
+    """
+    inflight_count()
+
+    Returns the number of unacknowledged messages.
+    """
+    def inflight_count(self):
+        inflight = self.inflight
+        return len(inflight) if inflight is not None else 0
+
+    """
+    hand_off(offline)
+
+    Closes a persistent session whose client went away and moves the
+    messages it did not deliver to offline, the OfflineSession taking its
+    place: the queued ones, and at QoS 1 the unacknowledged and held ones.
+    Replies stay queued, the writer still sends them.
+    """
+    def hand_off(self, offline):
+        with self.ready:
+            kept = collections.deque()
+            with offline.lock:
+                for frame in self.queue:
+                    if isinstance(frame, PacketFrame):
+                        continue # Unacknowledged QOS_MESSAGE frames are taken from inflight below
+                    if isinstance(frame, PayloadStream) or frame[0] == REPLY:
+                        kept.append(frame)
+                    elif frame[0] == MESSAGE or frame[0] == DATA:
+                        # A replayed buffer holds many frames, see replay()
+                        for message in split_frames(frame):
+                            offline.queue.append(message)
+                if self.qos:
+                    for frame in self.inflight:
+                        offline.queue.append(without_packet_id(frame))
+                    for frame in self.held:
+                        offline.queue.append(frame)
+                    self.inflight.clear()
+                    self.held.clear()
+            self.queue = kept
+            self.queued_bytes = sum(len(frame) for frame in kept)
+            self.successor = offline
+            self.closed = True
+            self.wake()
+
+    """
+    replay(frames, spilled)
+
+    Queues the messages a persistent session got while its client was
+    away, see OfflineQueue.take(). At QoS 0 the frames kept in memory are
+    joined and queued along with the spilled ones as two writes, at QoS 1
+    every MESSAGE frame needs a packet id and goes through the window.
+    DATA frames are never acknowledged, like those of enqueue() they are
+    queued as they are, after the messages before them that fit in the
+    window.
+    """
+    def replay(self, frames, spilled):
+        with self.ready:
+            if self.qos:
+                for frame in itertools.chain(frames, split_frames(spilled) if spilled is not None else ()):
+                    if frame[0] == MESSAGE:
+                        self.held.append(frame)
+                    else:
+                        self.release()
+                        self.queue.append(frame)
+                        self.queued_bytes += len(frame)
+                self.release()
+            else:
+                for buffer in (b''.join(frames), spilled):
+                    if buffer:
+                        self.queue.append(buffer)
+                        self.queued_bytes += len(buffer)
+            self.wake()
+
+    """
+    drop_oldest()
+
+    Drops the oldest queued message, called with the queue lock held.
+    Replies are never dropped, a client matches them to its commands, and
+    neither are the batches of a bridge.
+    """
+    def drop_oldest(self):
+        for index, frame in enumerate(self.queue):
+            if isinstance(frame, (PayloadStream, PacketFrame)) or frame[0] != REPLY and frame[0] != BRIDGE_MESSAGES:
+                del self.queue[index]
+                self.queued_bytes -= len(frame)
+                if isinstance(frame, PayloadStream):
+                    frame.leave(0)
+                return
+
+    """
+    flush()
+
+    Wakes up the writer to send the frames queued with flush=False.
+    """
+    def flush(self):
+        with self.ready:
+            self.wake()
+
+    """
+    take_batch()
+
+    Removes and returns the buffers for a single write, called with the
+    queue lock held. A PacketFrame is sent as its header and the shared
+    payload of its message. A PayloadStream ends the batch, see
+    send_stream().
+    """
+    def take_batch(self):
+        frames = []
+        count = 0
+        size = 0
+        while self.queue and count < BATCH_FRAMES and size < BATCH_BYTES:
+            frame = self.queue.popleft()
+            count += 1
+            size += len(frame)
+            if isinstance(frame, PacketFrame):
+                frames += frame.buffers()
+                continue
+            frames.append(frame)
+            if isinstance(frame, PayloadStream):
+                break
+        self.queued_bytes -= size
+        self.frames_sent += count
+        self.writes += 1
+        METRICS.count('bytes_out_total', size)
+        return frames
+
+    """
+    queue_depth()
+
+    Returns the number of frames waiting to be sent to the client.
+    """
+    def queue_depth(self):
+        return len(self.queue)
+
+    """
+    start_writer()
+
+    Starts the writer thread of the session.
+    """
+    def start_writer(self):
+        self.writer_thread = threading.Thread(target=self.write, daemon=True)
+        self.writer_thread.start()
+
+    """
+    wake()
+
+    Wakes up the writer, called with the queue lock held.
+    """
+    def wake(self):
+        self.ready.notify()
+
+    """
+    write()
+
+    The writer thread. Sends queued frames in batches until the session
+    is closed and its queue has been drained, then closes the socket.
+    """
+    def write(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if not self.queue:
+                    break
+                if self.flush_delay:
+                    deadline = time.monotonic() + self.flush_delay
+                    while self.queued_bytes < BATCH_BYTES and not self.closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.ready.wait(remaining)
+                frames = self.take_batch()
+            try:
+                if isinstance(frames[-1], PayloadStream):
+                    self.send_stream(frames.pop(), frames)
+                else:
+                    send_frames(self.sock, frames)
+            except OSError:
+                self.abort()
+                break
+        self.sock.close()
+
+    """
+    send_stream(stream, frames)
+
+    Sends the frames queued before a streamed binary message, and then
+    the message itself as its pieces arrive. A message whose publisher
+    went away cannot be finished, which ends the session. The stream can
+    release every piece once it has been sent.
+    """
+    def send_stream(self, stream, frames):
+        frames.append(stream.header)
+        position = 0
+        done = False
+        try:
+            while not done:
+                chunks, done = stream.wait(position)
+                frames.extend(chunks)
+                if frames:
+                    send_frames(self.sock, frames)
+                    frames = []
+                stream.consumed(position, position + len(chunks))
+                position += len(chunks)
+        finally:
+            stream.leave(position)
+
+    """
+    receive()
+
+    Returns the next command received from the client, or a BinaryPublish
+    for a binary message. Commands that arrived together with an earlier
+    one are returned without touching the socket again.
+    """
+    def receive(self):
+        if self.upload is not None:
+            self.receive_payload()
+        frame = self.next_frame()
+        while frame is None:
+            if self.parser.recv_into(self.sock) == 0:
+                raise ConnectionError('Connection closed by client')
+            frame = self.next_frame()
+        return frame
+
+    """
+    next_frame()
+
+    Returns the next command or BinaryPublish that the parser holds, or
+    None. A command is returned as its text, or for an OPCODE frame as its
+    (opcode, arguments), see commands.py, and the messages another broker
+    sends over a bridge as a BridgeBatch. A binary message larger than the
+    parser's initial buffer is returned as soon as its topic has arrived,
+    the rest of it is left to receive_payload(). ACK frames are handled here, they are not commands
+    and get no reply.
+    """
+    def next_frame(self):
+        while True:
+            header = self.parser.next_header()
+            if header is not None and header[0] == PUBLISH and header[1] > self.parser.size:
+                return self.start_upload(header[1])
+            frame = self.parser.next_frame()
+            if frame is None:
+                return None
+            kind, payload = frame
+            METRICS.count('bytes_in_total', HEADER_SIZE + len(payload))
+            if kind == ACK:
+                if len(payload) != PACKET_ID.size:
+                    raise FrameError('ACK frame without a packet id')
+                self.acknowledge(PACKET_ID.unpack(payload)[0])
+                continue
+            if kind == PUBLISH:
+                topic, message = decode_binary(payload)
+                return BinaryPublish(topic, len(message), message)
+            if kind == OPCODE:
+                return decode_command(payload)
+            if kind == BRIDGE_MESSAGES:
+                return BridgeBatch(payload)
+            return payload.decode('utf-8')
+
+    """
+    start_upload(length)
+
+    Removes the header and topic of a binary message of length bytes (its
+    whole payload) from the parser, once they have arrived, and returns
+    the BinaryPublish for it. Returns None until then.
+    """
+    def start_upload(self, length):
+        if length > MAX_BINARY_SIZE:
+            raise FrameError(f'Binary message of {length} bytes is larger than {MAX_BINARY_SIZE} bytes')
+        if length < TOPIC_LENGTH.size:
+            raise FrameError('Binary frame is shorter than its topic length')
+        prefix = self.parser.peek(HEADER_SIZE + TOPIC_LENGTH.size)
+        if prefix is None:
+            return None
+        (topic_length,) = TOPIC_LENGTH.unpack_from(prefix, HEADER_SIZE)
+        if TOPIC_LENGTH.size + topic_length > length:
+            raise FrameError('Binary frame is shorter than its topic')
+        prefix = self.parser.peek(HEADER_SIZE + TOPIC_LENGTH.size + topic_length)
+        if prefix is None:
+            return None
+        self.parser.take(len(prefix))
+        METRICS.count('bytes_in_total', HEADER_SIZE + length)
+        topic = prefix[HEADER_SIZE + TOPIC_LENGTH.size:].decode('utf-8')
+        self.upload = BinaryPublish(topic, length - TOPIC_LENGTH.size - topic_length)
+        return self.upload
+
+    """
+    receive_payload()
+
+    Receives the rest of the binary message returned by the last
+    receive() into its stream. What the parser already holds is taken
+    from it, the rest is received straight into buffers of its own, which
+    are passed on to the stream as they fill up.
+    """
+    def receive_payload(self):
+        upload, self.upload = self.upload, None
+        remaining = upload.length
+        try:
+            if remaining and self.parser.pending():
+                data = self.parser.take(remaining)
+                remaining -= len(data)
+                if upload.stream is not None:
+                    upload.stream.append(data)
+            while remaining:
+                view = memoryview(bytearray(min(STREAM_CHUNK, remaining)))
+                filled = 0
+                while filled < len(view):
+                    received = self.sock.recv_into(view[filled:])
+                    if received == 0:
+                        raise ConnectionError('Connection closed by client')
+                    if upload.stream is not None:
+                        upload.stream.append(view[filled:filled + received])
+                    filled += received
+                remaining -= filled
+        except BaseException:
+            if upload.stream is not None:
+                upload.stream.finish(failed=True)
+            raise
+        finish_upload(upload)
+
+    """
+    close()
+
+    Closes the session. The writer still sends what is already queued
+    before the socket is closed.
+    """
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.wake()
+
+    """
+    abort()
+
+    Closes the session right away, dropping everything that is queued.
+    Shutting the socket down also ends the client's handler, which then
+    cleans up the session's subscriptions.
+    """
+    def abort(self):
+        with self.ready:
+            self._abort_locked()
+
+    """
+    _abort_locked()
+
+    abort() for a caller that already holds the queue lock, e.g.,
+    enqueue() when the overflow policy disconnects the client. The lock
+    of a StreamSession is not reentrant, so it must not be taken again.
+    """
+    def _abort_locked(self):
+        self.closed = True
+        for frame in self.queue:
+            if isinstance(frame, PayloadStream):
+                frame.leave(0) # Never read, its pieces need not be kept for this session
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.wake()
+        self.shut_down()
+
+    """
+    shut_down()
+
+    Shuts the connection down, which ends the client's handler.
+    """
+    def shut_down(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+"""
+finish_upload(upload)
+
+Completes the stream of a binary message that has been received whole.
+"""
+def finish_upload(upload):
+    if upload.stream is not None:
+        upload.stream.finish()
+        if upload.on_complete is not None:
+            upload.on_complete(upload.stream)
+
+class OfflineSession:
+    """
+    Constructor for the stand-in of a persistent session whose client is
+    not connected. It takes over the subscriptions of the session, so
+    publishing queues messages for it in an OfflineQueue, until the client
+    resumes the session on a new connection. From then on, the frames
+    queued for it go to its successor, the new session.
+    """
+    __slots__ = ('client_id', 'subscriptions', 'qos', 'window', 'queue', 'lock', 'successor', 'dropped',
+                 'parked_at')
+
+    def __init__(self, session, memory_size = 1000, spill_dir = None):
+        self.client_id = session.client_id
+        self.subscriptions = {} # Filled in by SubscriptionRegistry.park()
+        self.qos = session.qos
+        self.window = session.window
+        self.queue = OfflineQueue(memory_size, spill_dir)
+        self.lock = threading.Lock()
+        self.successor = None
+        self.dropped = 0 # Streamed binary messages, which cannot be queued
+        self.parked_at = time.monotonic()
+
+    """
+    enqueue(frame, kind, flush)
+
+    Queues a published message like Session.enqueue(). The frame keeps
+    its kind in its header, so a DATA frame is replayed as it is. A binary
+    message that is still being received is dropped, and so is any other
+    frame than a MESSAGE or DATA frame, which is of no use to a client
+    that comes back later.
+    """
+    def enqueue(self, frame, kind = MESSAGE, flush = True):
+        with self.lock:
+            if self.successor is not None:
+                return self.successor.enqueue(frame, kind, flush)
+            if kind != MESSAGE and kind != DATA:
+                return False
+            if self.queue is None or isinstance(frame, PayloadStream):
+                self.dropped += 1
+                return False
+            self.queue.append(frame)
+            return True
+
+    def flush(self):
+        successor = self.successor
+        if successor is not None:
+            successor.flush()
+
+    """
+    resume(session)
+
+    Hands the session state and the queued messages over to session, the
+    session of the client's new connection.
+    """
+    def resume(self, session):
+        with self.lock:
+            if self.qos and not session.qos:
+                session.set_qos(self.qos, self.window)
+            count = len(self.queue)
+            frames, spilled = self.queue.take()
+            session.replay(frames, spilled)
+            self.successor = session
+            return count
+
+    """
+    expire()
+
+    Drops the queued messages of a session whose client did not come back.
+    """
+    def expire(self):
+        with self.lock:
+            self.queue.close()
+            self.queue = None
+
+class SubscriptionRegistry:
+    """
+    Constructor for the subscription registry of the topics of a topic
+    trie. Subscriptions are kept as topic ids, so a session holds small
+    shared integers instead of its own copy of every topic name, and the
+    subscribers of a topic are found by indexing a list.
+
+    Publishing only reads the registry, and it does so without a lock:
+    routes holds a frozenset of the subscribers of every topic, which is
+    never changed. Every change (subscribing, unsubscribing, a client
+    going away) goes through a single lock instead, works on copies of the
+    sets of the topics it changes and then puts all of them in routes at
+    once, see commit(). A publisher sees either the old or the new
+    subscribers of a topic, and a client that subscribes to many topics
+    at once, or goes away, copies each of their sets only once.
+
+    A persistent session outlives its connection, see resume(). When its
+    client goes away, an OfflineSession queues its messages until the
+    client comes back or session_expiry seconds have passed. It keeps the
+    first offline_size messages in memory and spills the others to a file
+    in spill_dir.
+    """
+    def __init__(self, topics):
+        self.lock = threading.Lock()
+        self.topics_trie = topics
+        self.sessions = set()
+        self.routes = [] # topic id -> frozenset of sessions, or None, replaced whenever it grows
+        self.clients = {} # client id -> connected persistent session
+        self.offline = {} # client id -> OfflineSession, in the order their clients went away
+        self.offline_size = 1000
+        self.spill_dir = None
+        self.session_expiry = 3600.0
+
+    """
+    changing(changes, topic_id)
+
+    Returns the subscribers of a topic as a set that a batch of changes
+    can edit. The current frozenset is copied the first time the batch
+    changes the topic. Called with the lock held.
+    """
+    def changing(self, changes, topic_id):
+        subscribers = changes.get(topic_id)
+        if subscribers is None:
+            current = self.routes[topic_id] if topic_id < len(self.routes) else None
+            subscribers = changes[topic_id] = set(current) if current else set()
+        return subscribers
+
+    """
+    commit(changes)
+
+    Puts the subscribers of every topic changed by a batch of changes in
+    routes, called with the lock held. When routes has to grow, a longer
+    copy is filled in and then replaces it, so a publisher never indexes a
+    list that is being extended.
+    """
+    def commit(self, changes):
+        if not changes:
+            return
+        routes = self.routes
+        end = max(changes) + 1
+        if end > len(routes):
+            routes = routes + [None] * (end - len(routes))
+        for topic_id, subscribers in changes.items():
+            routes[topic_id] = frozenset(subscribers) if subscribers else None
+        self.routes = routes
+
+    """
+    connect(session)
+
+    Registers a newly connected session.
+    """
+    def connect(self, session):
+        with self.lock:
+            self.sessions.add(session)
+
+    """
+    disconnect(session)
+
+    Removes a session and all of its subscriptions. This only touches
+    the topics that the session was subscribed to. A persistent session
+    keeps its subscriptions, they are handed to an OfflineSession.
+    """
+    def disconnect(self, session):
+        with self.lock:
+            self.sessions.discard(session)
+            changes = {}
+            if session.client_id is not None and self.clients.get(session.client_id) is session:
+                self.park(session, changes)
+            else:
+                self.remove(session, changes)
+            self.commit(changes)
+
+    """
+    remove(session, changes)
+
+    Removes the subscriptions of a session in a batch of changes, called
+    with the lock held.
+    """
+    def remove(self, session, changes):
+        for topic_id in session.subscriptions:
+            self.changing(changes, topic_id).discard(session)
+        session.subscriptions.clear()
+
+    """
+    replace(old, new, changes)
+
+    Moves the subscriptions of session old to new in a batch of changes,
+    called with the lock held.
+    """
+    def replace(self, old, new, changes):
+        for topic_id in old.subscriptions:
+            subscribers = self.changing(changes, topic_id)
+            subscribers.discard(old)
+            subscribers.add(new)
+            new.subscriptions[topic_id] = None
+
+    """
+    park(session, changes)
+
+    Replaces a persistent session whose client went away with an
+    OfflineSession, called with the lock held.
+    """
+    def park(self, session, changes):
+        del self.clients[session.client_id]
+        offline = OfflineSession(session, self.offline_size, self.spill_dir)
+        self.replace(session, offline, changes)
+        session.subscriptions = {}
+        self.offline[session.client_id] = offline
+        session.hand_off(offline)
+        self.expire(offline.parked_at, changes)
+
+    """
+    resume(session, client_id)
+
+    Makes session the persistent session of client_id. If the client has
+    an offline session, session takes over its subscriptions and QoS, and
+    the messages queued while the client was away are sent to it. If the
+    client is still connected on another session, e.g., its old connection
+    has not timed out yet, that session is parked and closed first.
+    Returns the number of messages sent, or None for a new session.
+    """
+    def resume(self, session, client_id):
+        previous = None
+        count = None
+        with self.lock:
+            changes = {}
+            self.expire(time.monotonic(), changes)
+            if client_id in self.clients:
+                previous = self.clients[client_id]
+                self.sessions.discard(previous)
+                self.park(previous, changes)
+            session.client_id = client_id
+            self.clients[client_id] = session
+            offline = self.offline.pop(client_id, None)
+            if offline is not None:
+                self.replace(offline, session, changes)
+                # The offline messages are queued before publishers can see session
+                count = offline.resume(session)
+            self.commit(changes)
+        if previous is not None:
+            previous.abort()
+        return count
+
+    """
+    expire(now, changes)
+
+    Drops the offline sessions whose clients went away more than
+    session_expiry seconds before now, called with the lock held.
+    """
+    def expire(self, now, changes):
+        while self.offline:
+            client_id = next(iter(self.offline))
+            offline = self.offline[client_id]
+            if now - offline.parked_at < self.session_expiry:
+                break
+            del self.offline[client_id]
+            self.remove(offline, changes)
+            offline.expire()
+
+    """
+    expire_offline(now)
+
+    Drops the offline sessions that expired before now, and the messages
+    queued for them, also while no client connects or goes away. Called
+    by the server on a timer. Returns the number of sessions dropped.
+    """
+    def expire_offline(self, now):
+        if not self.offline:
+            return 0
+        with self.lock:
+            changes = {}
+            count = len(self.offline)
+            self.expire(now, changes)
+            self.commit(changes)
+            return count - len(self.offline)
+
+    """
+    offline_messages()
+
+    Returns the number of messages queued for the clients of offline
+    sessions.
+    """
+    def offline_messages(self):
+        with self.lock:
+            offline = list(self.offline.values())
+        return sum(len(session.queue or ()) for session in offline)
+
+    """
+    subscribe(session, topic)
+
+    Subscribes a session to an existing topic. Returns False if the
+    session was already subscribed to the topic.
+    """
+    def subscribe(self, session, topic):
+        return bool(self.subscribe_many(session, [topic]))
+
+    """
+    subscribe_many(session, topics)
+
+    Subscribes a session to existing topics with a single batch of
+    changes. Returns the topics the session was not subscribed to yet.
+    """
+    def subscribe_many(self, session, topics):
+        topic_ids = []
+        for topic in topics:
+            topic_id = self.topics_trie.topic_id(topic)
+            if topic_id is None:
+                raise KeyError(f'Unknown topic {topic}')
+            topic_ids.append(topic_id)
+        subscribed = []
+        with self.lock:
+            changes = {}
+            for topic, topic_id in zip(topics, topic_ids):
+                if topic_id not in session.subscriptions:
+                    session.subscriptions[topic_id] = None
+                    self.changing(changes, topic_id).add(session)
+                    subscribed.append(topic)
+            self.commit(changes)
+        return subscribed
+
+    """
+    unsubscribe(session, topic)
+
+    Unsubscribes a session from a topic. Returns False if the session was
+    not subscribed to the topic.
+    """
+    def unsubscribe(self, session, topic):
+        return bool(self.unsubscribe_many(session, [topic]))
+
+    """
+    unsubscribe_many(session, topics)
+
+    Unsubscribes a session from topics with a single batch of changes.
+    Returns the topics the session was subscribed to.
+    """
+    def unsubscribe_many(self, session, topics):
+        unsubscribed = []
+        with self.lock:
+            changes = {}
+            for topic in topics:
+                topic_id = self.topics_trie.topic_id(topic)
+                if topic_id in session.subscriptions:
+                    del session.subscriptions[topic_id]
+                    self.changing(changes, topic_id).discard(session)
+                    unsubscribed.append(topic)
+            self.commit(changes)
+        return unsubscribed
+
+    """
+    is_subscribed(session, topic)
+
+    Returns True if the session is subscribed to the topic.
+    """
+    def is_subscribed(self, session, topic):
+        topic_id = self.topics_trie.topic_id(topic)
+        return topic_id is not None and topic_id in session.subscriptions
+
+    """
+    subscribers(topic)
+
+    Returns the sessions subscribed to a topic, a frozenset that stays the
+    same while other clients subscribe or disconnect. Takes no lock.
+    """
+    def subscribers(self, topic):
+        topic_id = self.topics_trie.topic_id(topic)
+        routes = self.routes
+        if topic_id is None or topic_id >= len(routes):
+            return ()
+        return routes[topic_id] or ()
+
+    """
+    queue_stats()
+
+    Returns a list of (address, queue depth, dropped messages) tuples,
+    one for every connected session.
+    """
+    def queue_stats(self):
+        with self.lock:
+            sessions = list(self.sessions)
+        return [(session.address, session.queue_depth(), session.dropped) for session in sessions]
+
+    """
+    retransmit(now, timeout)
+
+    Resends the messages of every session that were not acknowledged
+    within timeout seconds, see Session.retransmit(). Returns the number
+    of messages resent.
+    """
+    def retransmit(self, now, timeout):
+        with self.lock:
+            sessions = list(self.sessions)
+        return sum(session.retransmit(now, timeout) for session in sessions)
+
+    """
+    inflight()
+
+    Returns the number of messages sent at QoS 1 that were not
+    acknowledged yet, over every session.
+    """
+    def inflight(self):
+        with self.lock:
+            sessions = list(self.sessions)
+        return sum(session.inflight_count() for session in sessions)
+
+    """
+    topics(session)
+
+    Returns a list of the topics a session is subscribed to.
+    """
+    def topics(self, session):
+        with self.lock:
+            topic_ids = list(session.subscriptions)
+        return [self.topics_trie.topic_name(topic_id) for topic_id in topic_ids]
+
+class StreamSession(Session):
+    """
+    Constructor for a session of the asyncio server mode. Instead of
+    a socket, the session reads from an asyncio StreamReader and writes
+    to an asyncio StreamWriter. The outbound queue is drained by a writer
+    coroutine instead of a thread.
+    """
+    __slots__ = ('reader', 'writer', 'event', 'buffered', 'writer_task')
+
+    parser_size = 512 # The StreamReader already buffers what arrives
+    lock_type = threading.Lock # The writer coroutine waits on event instead
+    stream_type = AsyncPayloadStream
+
+    def __init__(self, reader, writer, queue_size = 1000, overflow = 'drop-oldest', flush_delay = 0):
+        self.reader = reader
+        self.writer = writer
+        self.event = asyncio.Event()
+        self.buffered = 0 # Commands returned in a row without waiting for the socket
+        super().__init__(writer.get_extra_info('socket'), writer.get_extra_info('peername'),
+                         queue_size, overflow, flush_delay)
+
+    """
+    start_writer()
+
+    Starts the writer coroutine of the session.
+    """
+    def start_writer(self):
+        self.writer_task = asyncio.get_running_loop().create_task(self.write())
+
+    """
+    wake()
+
+    Wakes up the writer coroutine.
+    """
+    def wake(self):
+        self.event.set()
+
+    """
+    write()
+
+    The writer coroutine. Writes queued frames in batches and waits for
+    the transport to drain, so a slow client only ever holds up its own
+    queue.
+    """
+    async def write(self):
+        try:
+            while True:
+                if not self.queue:
+                    if self.closed:
+                        break
+                    self.event.clear()
+                    await self.event.wait()
+                    continue
+                if self.flush_delay and self.queued_bytes < BATCH_BYTES and not self.closed:
+                    await asyncio.sleep(self.flush_delay)
+                frames = self.take_batch()
+                if isinstance(frames[-1], PayloadStream):
+                    await self.send_stream(frames.pop(), frames)
+                else:
+                    self.writer.writelines(frames)
+                await self.writer.drain()
+        except OSError:
+            self.abort()
+        finally:
+            self.writer.close()
+
+    """
+    send_stream(stream, frames)
+
+    Coroutine version of Session.send_stream(). The transport copies
+    what it cannot send right away into its own buffer, so the pieces are
+    written one at a time, each once the transport has drained.
+    """
+    async def send_stream(self, stream, frames):
+        frames.append(stream.header)
+        position = 0
+        done = False
+        try:
+            self.writer.writelines(frames)
+            while not done:
+                chunks, done = await stream.wait(position)
+                for chunk in chunks:
+                    await self.writer.drain()
+                    self.writer.write(chunk)
+                stream.consumed(position, position + len(chunks))
+                position += len(chunks)
+        finally:
+            stream.leave(position)
+
+    """
+    receive()
+
+    Coroutine returning the next command received from the client. A
+    client that sends many commands at once would otherwise have them all
+    handled without ever yielding to the event loop, so every
+    BUFFERED_COMMANDS commands the other clients get their turn, e.g.,
+    the writers that deliver the messages these commands publish.
+    """
+    async def receive(self):
+        if self.upload is not None:
+            await self.receive_payload()
+        frame = self.next_frame()
+        if frame is not None:
+            self.buffered += 1
+            if self.buffered >= BUFFERED_COMMANDS:
+                self.buffered = 0
+                await asyncio.sleep(0)
+        else:
+            self.buffered = 0
+        while frame is None:
+            data = await self.reader.read(64 * 1024)
+            if not data:
+                raise ConnectionError('Connection closed by client')
+            self.parser.feed(data)
+            frame = self.next_frame()
+        return frame
+
+    """
+    receive_payload()
+
+    Coroutine version of Session.receive_payload(). The StreamReader
+    has no recv_into(), so the pieces are the bytes it returns, which are
+    passed on to the stream as they are.
+    """
+    async def receive_payload(self):
+        upload, self.upload = self.upload, None
+        remaining = upload.length
+        try:
+            if remaining and self.parser.pending():
+                data = self.parser.take(remaining)
+                remaining -= len(data)
+                if upload.stream is not None:
+                    upload.stream.append(data)
+            while remaining:
+                data = await self.reader.read(min(STREAM_CHUNK, remaining))
+                if not data:
+                    raise ConnectionError('Connection closed by client')
+                remaining -= len(data)
+                if upload.stream is not None:
+                    upload.stream.append(data)
+        except BaseException:
+            if upload.stream is not None:
+                upload.stream.finish(failed=True)
+            raise
+        finish_upload(upload)
+
+    """
+    shut_down()
+
+    Closes the transport right away, see abort().
+    """
+    def shut_down(self):
+        self.writer.transport.abort()
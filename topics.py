@@ -0,0 +1,256 @@
+"""
+topics.py
+
+Purpose: Holds the topic table of the MQTT server. Topics are stored in
+a trie that is split on the '/' level separator, so wildcard lookups only
+walk the part of the tree that can match instead of every known topic.
+The topics matching a wildcard are also kept in a small LRU cache, since
+publishers tend to use the same few wildcards over and over.
+"""
+
+import collections
+import sys
+import threading
+import types
+
+NO_CHILDREN = types.MappingProxyType({}) # Shared by every node without children
+
+class TopicNode:
+    """
+    A single level in the topic trie. A node is only a real topic when
+    `topic` is set, intermediate levels (e.g., WEATHER/WISCONSIN when only
+    WEATHER/WISCONSIN/NINE was created) are not topics themselves.
+
+    There is a node for every level of every topic, so nodes have slots
+    instead of a __dict__, and the nodes without children share the
+    read-only NO_CHILDREN until their first child is added.
+    """
+    __slots__ = ('children', 'topic', 'id', 'retained')
+
+    def __init__(self):
+        self.children = NO_CHILDREN # level name -> TopicNode
+        self.topic = None    # Full topic name when this node is a topic
+        self.id = None       # Topic id when this node is a topic, see TopicTrie.topic_id()
+        self.retained = ""   # Retained message for the topic
+
+"""
+topic_matches(topic_filter, topic)
+
+Returns True if a topic matches a topic filter, with the same wildcards
+as TopicTrie.match().
+"""
+def topic_matches(topic_filter, topic):
+    if '+' not in topic_filter and '#' not in topic_filter:
+        return topic_filter == topic
+    levels = topic.split('/')
+    filter_levels = topic_filter.split('/')
+    if filter_levels[-1] == '#':
+        filter_levels.pop()
+        if len(levels) <= len(filter_levels):
+            return False
+    elif len(levels) != len(filter_levels):
+        return False
+    for wanted, level in zip(filter_levels, levels):
+        if wanted != '+' and wanted != level:
+            return False
+    return True
+
+class TopicTrie:
+    """
+    Constructor for the topic trie. The trie can be seeded with an
+    iterable of topic names, which are added in order.
+
+    match() keeps the topics of up to cache_size topic filters, and of at
+    most cache_topics topics in all, dropping the least recently used
+    filter first. Adding a topic only drops the filters that match it, so
+    the cache stays warm while new topics are created elsewhere.
+
+    Every topic also gets a small integer id, in the order the topics were
+    created. The subscription registry keeps ids instead of topic names,
+    so the name of a topic is only stored once, in `names`.
+    """
+    def __init__(self, topics = (), cache_size = 1024, cache_topics = 100000):
+        self.root = TopicNode()
+        self.count = 0
+        self.names = [] # topic id -> topic name
+        self.cache = collections.OrderedDict() # topic filter -> tuple of topics
+        self.cache_size = cache_size
+        self.cache_topics = cache_topics
+        self.cached_topics = 0 # Topics held by the cache, counted once per filter
+        self.cache_lock = threading.Lock() # Also held while a topic is added, see add()
+        self.generation = 0    # Incremented by every add, see match()
+        self.hits = 0
+        self.misses = 0
+        for topic in topics:
+            self.add(topic)
+
+    """
+    add(topic)
+
+    Adds a topic to the trie. Returns True if the topic was created and
+    False if it already existed. Level names are interned, since the same
+    levels (e.g., WEATHER) tend to appear below many parents.
+
+    Topics are added under cache_lock, so clients creating topics at the
+    same time cannot lose each other's nodes. Lookups take no lock, a
+    node only becomes a topic once its id is set.
+    """
+    def add(self, topic):
+        with self.cache_lock:
+            node = self.root
+            for level in topic.split('/'):
+                child = node.children.get(level)
+                if child is None:
+                    if node.children is NO_CHILDREN:
+                        node.children = {}
+                    child = node.children[sys.intern(level)] = TopicNode()
+                node = child
+            if node.topic is not None:
+                return False
+            node.id = len(self.names)
+            self.names.append(topic)
+            node.topic = topic
+            self.count += 1
+            self._invalidate(topic)
+        return True
+
+    """
+    find(topic)
+
+    Returns the node of the topic, or None if the topic does not exist.
+    """
+    def find(self, topic):
+        node = self.root
+        for level in topic.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node if node.topic is not None else None
+
+    """
+    topic_id(topic)
+
+    Returns the id of an existing topic, or None if the topic does not
+    exist.
+    """
+    def topic_id(self, topic):
+        node = self.find(topic)
+        return node.id if node is not None else None
+
+    """
+    topic_name(topic_id)
+
+    Returns the name of the topic with an id.
+    """
+    def topic_name(self, topic_id):
+        return self.names[topic_id]
+
+    """
+    retained(topic)
+
+    Returns the retained message of a topic. Topics without a retained
+    message hold the empty string.
+    """
+    def retained(self, topic):
+        return self.find(topic).retained
+
+    """
+    retain(topic, message)
+
+    Sets the retained message of an existing topic.
+    """
+    def retain(self, topic, message):
+        self.find(topic).retained = message
+
+    """
+    match(topic_filter)
+
+    Returns a tuple of the topics matching a topic filter. The single-level
+    wildcard + matches exactly one level, and a trailing # matches every
+    topic below its parent level (the parent itself is not included). The
+    result comes from the cache when it can, see _walk().
+    """
+    def match(self, topic_filter):
+        with self.cache_lock:
+            topics = self.cache.get(topic_filter)
+            if topics is not None:
+                self.cache.move_to_end(topic_filter)
+                self.hits += 1
+                return topics
+            self.misses += 1
+            generation = self.generation
+        topics = tuple(self._walk(topic_filter))
+        with self.cache_lock:
+            # A topic added during the walk may be missing from the result
+            if generation == self.generation and topic_filter not in self.cache \
+                    and len(topics) <= self.cache_topics:
+                self.cache[topic_filter] = topics
+                self.cached_topics += len(topics)
+                while len(self.cache) > self.cache_size or self.cached_topics > self.cache_topics:
+                    self.cached_topics -= len(self.cache.popitem(last=False)[1])
+        return topics
+
+    """
+    _invalidate(topic)
+
+    Drops the cached topic filters that match a new topic, called with
+    cache_lock held.
+    """
+    def _invalidate(self, topic):
+        self.generation += 1
+        stale = [topic_filter for topic_filter in self.cache if topic_matches(topic_filter, topic)]
+        for topic_filter in stale:
+            self.cached_topics -= len(self.cache.pop(topic_filter))
+
+    """
+    _walk(topic_filter)
+
+    Returns the list of topics matching a topic filter, walking only the
+    nodes that can still match it.
+    """
+    def _walk(self, topic_filter):
+        levels = topic_filter.split('/')
+        last = len(levels) - 1
+        nodes = [self.root]
+        for index, level in enumerate(levels):
+            if level == '#' and index == last:
+                topics = []
+                for node in nodes:
+                    self._collect(node, topics)
+                return topics
+            next_nodes = []
+            for node in nodes:
+                if level == '+':
+                    next_nodes.extend(node.children.values())
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+            if not next_nodes:
+                return []
+            nodes = next_nodes
+        return [node.topic for node in nodes if node.topic is not None]
+
+    """
+    _collect(node, topics)
+
+    Appends every topic below node (in depth-first order) to topics.
+    """
+    def _collect(self, node, topics):
+        stack = list(reversed(node.children.values()))
+        while stack:
+            node = stack.pop()
+            if node.topic is not None:
+                topics.append(node.topic)
+            stack.extend(reversed(node.children.values()))
+
+    def __contains__(self, topic):
+        return self.find(topic) is not None
+
+    def __iter__(self):
+        topics = []
+        self._collect(self.root, topics)
+        return iter(topics)
+
+    def __len__(self):
+        return self.count